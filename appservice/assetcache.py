@@ -0,0 +1,232 @@
+"""Shared cache of Cockpit static assets across sessions
+
+Most of what a Cockpit page load fetches (base1/cockpit.js, CSS, fonts) is identical for every session. This
+caches such responses in the multiplexer, keyed by the Cockpit version and the path below the session prefix,
+and answers them without involving the session pod.
+
+Cache hits never go to the session pod, so only paths whose content cannot differ between sessions qualify:
+content-addressed package files (cockpit/$<checksum>/...; the checksum covers the package content), and
+cockpit-ws' own files (cockpit/static/...), which come from the session image. Everything else, in particular
+cockpit/@<host>/... which the target's cockpit-bridge serves from its own packages, always gets proxied.
+
+Of these, only responses which upstream declares as shareable get cached: 200 with an ETag, without
+"Cache-Control: no-cache/no-store/private", Set-Cookie, or Vary on anything but Accept-Encoding. Conditional
+requests get answered locally with 304, against the stored upstream ETag.
+
+Hits do not get revalidated with the session pod: a $<checksum> path changes whenever the content does, and
+cockpit/static/ files only change with the cockpit-ws image, which COCKPIT_VERSION in the key covers. A
+conditional request per hit would cost the round trip to the pod that the cache exists to save.
+
+The in-memory cache is bounded by ASSET_CACHE_SIZE bytes; with ASSET_CACHE_DIR, evicted entries get moved to
+that directory, bounded by ASSET_CACHE_DISK_SIZE bytes. File I/O runs in the default executor.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+import metrics
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# all session pods run the same cockpit-ws image; bump this when deploying a different version
+COCKPIT_VERSION = os.getenv('COCKPIT_VERSION', 'default')
+MEMORY_SIZE = int(os.getenv('ASSET_CACHE_SIZE', str(64 * 1024 * 1024)))
+DISK_DIR = os.getenv('ASSET_CACHE_DIR')
+DISK_SIZE = int(os.getenv('ASSET_CACHE_DISK_SIZE', str(512 * 1024 * 1024)))
+# don't buffer bigger responses
+MAX_ENTRY_SIZE = int(os.getenv('ASSET_CACHE_MAX_ENTRY', str(4 * 1024 * 1024)))
+
+# paths below the session prefix whose content is the same for all sessions, see above
+SHARED_PATH_RE = re.compile(r'cockpit/(\$[0-9a-f]+|static)/')
+
+# response headers which must not be replayed from the cache
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'date'}
+
+LOOKUPS = metrics.Counter('webconsole_asset_cache_lookups_total',
+                          'Asset cache lookups, by result (memory/disk hit, miss)', ['result'])
+NOT_MODIFIED = metrics.Counter('webconsole_asset_cache_not_modified_total',
+                               'Conditional requests answered from the asset cache with 304')
+STORES = metrics.Counter('webconsole_asset_cache_stores_total', 'Responses added to the asset cache')
+EVICTIONS = metrics.Counter('webconsole_asset_cache_evictions_total',
+                            'Entries dropped from the asset cache, by tier', ['tier'])
+SIZE = metrics.Gauge('webconsole_asset_cache_bytes', 'Size of the cached assets, by tier', ['tier'])
+
+Key = Tuple[str, str, str]
+
+
+class Asset(NamedTuple):
+    etag: str
+    headers: List[Tuple[str, str]]
+    body: bytes
+
+    def response(self, request: Request) -> Response:
+        """Response for a GET/HEAD request, honoring If-None-Match"""
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match and (if_none_match.strip() == '*' or
+                              self.etag in (tag.strip() for tag in if_none_match.split(','))):
+            NOT_MODIFIED.inc()
+            return Response(status_code=304, headers={'etag': self.etag})
+
+        response = Response(b'' if request.method == 'HEAD' else self.body, status_code=200)
+        # keep the upstream headers as they are, including content-length and content-encoding
+        response.raw_headers = [(k.encode('latin-1'), v.encode('latin-1')) for k, v in self.headers]
+        return response
+
+
+class DiskEntry(NamedTuple):
+    path: str
+    etag: str
+    headers: List[Tuple[str, str]]
+    size: int
+
+
+class AssetCache:
+    def __init__(self, memory_size: int = MEMORY_SIZE, disk_dir: Optional[str] = DISK_DIR,
+                 disk_size: int = DISK_SIZE):
+        self.memory: LRUCache[Key, Asset] = LRUCache(memory_size, sizeof=lambda asset: len(asset.body),
+                                                     on_evict=self._spill)
+        self.disk_dir = disk_dir
+        self.disk: LRUCache[Key, DiskEntry] = LRUCache(disk_size, sizeof=lambda entry: entry.size,
+                                                       on_evict=self._drop_file)
+        # evicted assets whose file is being written; still served from here meanwhile
+        self.spilling: Dict[Key, Asset] = {}
+        self.spill_tasks: Set[asyncio.Task] = set()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(request: Request, subpath: str) -> Key:
+        """Cache key for a request to subpath (the part after the session prefix)"""
+        if request.url.query:
+            subpath += '?' + request.url.query
+        encoding = 'gzip' if 'gzip' in request.headers.get('accept-encoding', '') else ''
+        return (COCKPIT_VERSION, subpath, encoding)
+
+    @staticmethod
+    def cacheable_request(request: Request, subpath: str) -> bool:
+        return (request.method in ('GET', 'HEAD') and 'range' not in request.headers and
+                SHARED_PATH_RE.match(subpath) is not None)
+
+    @staticmethod
+    def cacheable_response(status: int, headers: List[Tuple[str, str]]) -> bool:
+        if status != 200:
+            return False
+        names = {name.lower(): value for name, value in headers}
+        if 'etag' not in names or 'set-cookie' in names:
+            return False
+        cache_control = names.get('cache-control', '').lower()
+        if any(directive in cache_control for directive in ('no-cache', 'no-store', 'private')):
+            return False
+        vary = {v.strip().lower() for v in names.get('vary', '').split(',') if v.strip()}
+        if vary - {'accept-encoding'}:
+            return False
+        try:
+            return int(names['content-length']) <= MAX_ENTRY_SIZE
+        except (KeyError, ValueError):
+            return False
+
+    def _update_size(self) -> None:
+        SIZE.labels('memory').set(self.memory.size)
+        SIZE.labels('disk').set(self.disk.size)
+
+    def _spill(self, key: Key, asset: Asset) -> None:
+        EVICTIONS.labels('memory').inc()
+        if not self.disk_dir:
+            return
+        self.spilling[key] = asset
+        task = asyncio.create_task(self._write(key, asset))
+        self.spill_tasks.add(task)
+        task.add_done_callback(self.spill_tasks.discard)
+
+    async def _write(self, key: Key, asset: Asset) -> None:
+        path = os.path.join(self.disk_dir, hashlib.sha256(json.dumps(key).encode()).hexdigest())
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, _write_file, path, asset.body)
+        except OSError as e:
+            logger.warning('failed to write asset cache file %s: %s', path, e)
+            return
+        finally:
+            if self.spilling.get(key) is asset:
+                del self.spilling[key]
+        # unless it got looked up or stored again meanwhile; then the file just gets overwritten on the next spill
+        if key not in self.memory:
+            self.disk.put(key, DiskEntry(path, asset.etag, asset.headers, len(asset.body)))
+            self._update_size()
+
+    def _drop_file(self, key: Key, entry: DiskEntry) -> None:
+        EVICTIONS.labels('disk').inc()
+        try:
+            os.unlink(entry.path)
+        except OSError as e:
+            logger.warning('failed to remove asset cache file %s: %s', entry.path, e)
+
+    async def lookup(self, key: Key) -> Optional[Asset]:
+        asset = self.memory.get(key)
+        if asset is not None:
+            LOOKUPS.labels('memory').inc()
+            return asset
+
+        asset = self.spilling.get(key)
+        if asset is not None:
+            LOOKUPS.labels('memory').inc()
+            self.memory.put(key, asset)
+            self._update_size()
+            return asset
+
+        entry = self.disk.pop(key)
+        if entry is not None:
+            try:
+                body = await asyncio.get_running_loop().run_in_executor(None, _take_file, entry.path)
+            except OSError as e:
+                logger.warning('failed to read asset cache file %s: %s', entry.path, e)
+            else:
+                LOOKUPS.labels('disk').inc()
+                asset = Asset(entry.etag, entry.headers, body)
+                self.memory.put(key, asset)
+                self._update_size()
+                return asset
+
+        LOOKUPS.labels('miss').inc()
+        return None
+
+    def store(self, key: Key, headers: List[Tuple[str, str]], body: bytes) -> Asset:
+        headers = [(name, value) for name, value in headers if name.lower() not in HOP_BY_HOP_HEADERS]
+        etag = next(value for name, value in headers if name.lower() == 'etag')
+        old = self.disk.pop(key)
+        if old is not None:
+            self._drop_file(key, old)
+        asset = Asset(etag, headers, body)
+        self.memory.put(key, asset)
+        STORES.inc()
+        self._update_size()
+        return asset
+
+
+def _take_file(path: str) -> bytes:
+    """Read and remove a file"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    os.unlink(path)
+    return data
+
+
+def _write_file(path: str, data: bytes) -> None:
+    """Write a file atomically, so that concurrent writers and readers never see a partial one"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,68 @@
+"""Fan-out of session status changes to local listeners
+
+SessionStore reports every change once (see multiplexer.session_changed()); StatusBroadcaster passes it on to
+everything in this process which watches that session: /events streams of any number of browser tabs, and
+wait_status() callers. There is one entry per watched session, shared by all of its listeners, and it goes
+away with the last listener.
+"""
+
+import asyncio
+from typing import AsyncIterator, Dict, Optional
+
+from sessionstore import Status
+
+
+class _Watch:
+    __slots__ = ('status', 'changed', 'listeners')
+
+    def __init__(self, status: Status):
+        self.status = status
+        # replaced on every change, so that listeners wait for the next one
+        self.changed = asyncio.Event()
+        self.listeners = 0
+
+
+class StatusBroadcaster:
+    def __init__(self):
+        self.watches: Dict[str, _Watch] = {}
+
+    @property
+    def listeners(self) -> int:
+        return sum(watch.listeners for watch in self.watches.values())
+
+    def publish(self, key: str, status: Status) -> None:
+        watch = self.watches.get(key)
+        if watch is not None and watch.status != status:
+            watch.status = status
+            watch.changed.set()
+            watch.changed = asyncio.Event()
+
+    async def listen(self, key: str, status: Status, final: Optional[Status] = None,
+                     keepalive: Optional[float] = None) -> AsyncIterator[Optional[Status]]:
+        """Yield the current status, and then every change, until the final status
+
+        status is the current status, for when nobody watches key yet. With keepalive, yield None after that
+        many seconds without a change. Intermediate statuses may get skipped if they change faster than the
+        consumer reads them.
+        """
+        watch = self.watches.get(key)
+        if watch is None:
+            watch = self.watches[key] = _Watch(status)
+        watch.listeners += 1
+        try:
+            last = watch.status
+            yield last
+            while last != final:
+                changed = watch.changed
+                if watch.status != last:
+                    last = watch.status
+                    yield last
+                    continue
+                try:
+                    await asyncio.wait_for(changed.wait(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            watch.listeners -= 1
+            if watch.listeners == 0 and self.watches.get(key) is watch:
+                del self.watches[key]
@@ -0,0 +1,73 @@
+"""Size-bounded LRU cache"""
+
+import collections
+import time
+from typing import Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class LRUCache(Generic[K, V]):
+    """Least recently used cache, bounded by the total size of its values
+
+    `sizeof(value)` defines the size of a value (1 by default, i.e. the cache is bounded by its number of
+    entries). `on_evict(key, value)` gets called for entries which get dropped to make room. With `ttl`, entries
+    expire that many seconds after they were put.
+    """
+    def __init__(self, max_size: int, sizeof: Callable[[V], int] = lambda value: 1,
+                 on_evict: Optional[Callable[[K, V], None]] = None, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.ttl = ttl
+        self.size = 0
+        # key → (value, size, expiry time)
+        self._entries: 'collections.OrderedDict[K, Tuple[V, int, float]]' = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._entries
+
+    def get(self, key: K) -> Optional[V]:
+        try:
+            value, _, expires = self._entries[key]
+        except KeyError:
+            return None
+        if self.ttl is not None and expires < time.monotonic():
+            self.pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V) -> None:
+        """Add or replace an entry
+
+        Values which are bigger than the whole cache are not stored.
+        """
+        self.pop(key)
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else 0.0
+        self._entries[key] = (value, size, expires)
+        self.size += size
+        while self.size > self.max_size:
+            old_key, (old_value, old_size, _) = self._entries.popitem(last=False)
+            self.size -= old_size
+            if self.on_evict is not None:
+                self.on_evict(old_key, old_value)
+
+    def pop(self, key: K) -> Optional[V]:
+        try:
+            value, size, _ = self._entries.pop(key)
+        except KeyError:
+            return None
+        self.size -= size
+        return value
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
@@ -0,0 +1,103 @@
+"""Replica membership and session ownership
+
+Multiplexer replicas share all session state through Redis (see sessionstore), so any replica can serve any
+request. For sticky routing, each replica announces itself in Redis with a heartbeat, and every session gets
+an owner replica by rendezvous (highest random weight) hashing over the live replicas: all replicas agree on
+the owner, and when a replica joins or leaves, only the sessions of that replica move.
+
+The owner is advertised in the X-Webconsole-Owner header of the /sessions/new response and at
+/sessions/{id}/owner, so that a load balancer can route a session's bridge and browser connections to the
+same replica, and spread the relay load.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+from typing import Dict, Optional, Tuple
+
+import redis.asyncio
+import redis.exceptions
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# advertise session owners for sticky routing
+SESSION_AFFINITY = os.getenv('SESSION_AFFINITY', '') in ('1', 'true')
+# unique name of this replica; defaults to the host (pod) name
+REPLICA_ID = os.getenv('REPLICA_ID') or socket.gethostname()
+# host:port at which a load balancer can reach this replica
+REPLICA_ADDRESS = os.getenv('REPLICA_ADDRESS', f'{socket.gethostname()}:8080')
+HEARTBEAT_INTERVAL = float(os.getenv('REPLICA_HEARTBEAT_INTERVAL', '5'))
+# replicas which missed heartbeats for that long are considered gone
+HEARTBEAT_TTL = 3 * HEARTBEAT_INTERVAL
+
+REPLICA_KEY_PREFIX = 'replica:'
+
+REPLICAS = metrics.Gauge('webconsole_replicas', 'Live multiplexer replicas, as seen by this replica')
+OWNED = metrics.Counter('webconsole_session_requests_owned_total',
+                        'Session requests, by whether this replica owns the session', ['owner'])
+
+
+def _weight(replica_id: str, session_id: str) -> bytes:
+    return hashlib.blake2b(f'{replica_id}/{session_id}'.encode(), digest_size=8).digest()
+
+
+class Cluster:
+    def __init__(self, redis_client: redis.asyncio.Redis, replica_id: str = REPLICA_ID,
+                 address: str = REPLICA_ADDRESS):
+        self.redis = redis_client
+        self.replica_id = replica_id
+        self.address = address
+        # replica id → address; always contains ourselves
+        self.replicas: Dict[str, str] = {replica_id: address}
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        try:
+            await self.redis.delete(REPLICA_KEY_PREFIX + self.replica_id)
+        except redis.exceptions.RedisError as e:
+            logger.warning('failed to unregister replica %s: %s', self.replica_id, e)
+
+    async def heartbeat(self) -> None:
+        """Announce ourselves, and refresh the list of live replicas"""
+        await self.redis.set(REPLICA_KEY_PREFIX + self.replica_id, self.address, ex=round(HEARTBEAT_TTL))
+        keys = [key async for key in self.redis.scan_iter(match=REPLICA_KEY_PREFIX + '*')]
+        addresses = await self.redis.mget(keys) if keys else []
+        replicas = {key.decode()[len(REPLICA_KEY_PREFIX):]: address.decode()
+                    for key, address in zip(keys, addresses) if address is not None}
+        replicas[self.replica_id] = self.address
+        if replicas.keys() != self.replicas.keys():
+            logger.info('live replicas: %s', ', '.join(sorted(replicas)))
+        self.replicas = replicas
+        REPLICAS.set(len(replicas))
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.heartbeat()
+            except redis.exceptions.RedisError as e:
+                logger.warning('replica heartbeat failed: %s', e)
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def owner(self, session_id: str) -> Tuple[str, str]:
+        """Return (replica id, address) of the replica which owns session_id"""
+        replica_id = max(self.replicas, key=lambda replica_id: _weight(replica_id, session_id))
+        return replica_id, self.replicas[replica_id]
+
+    def record_lookup(self, session_id: str) -> None:
+        """Count a request for session_id in OWNED, by whether this replica owns it
+
+        Requests for remote sessions work, as any replica can serve any session; many of them mean that the load
+        balancer does not route by the owner header.
+        """
+        owned = self.owner(session_id)[0] == self.replica_id
+        OWNED.labels('local' if owned else 'remote').inc()
@@ -0,0 +1,125 @@
+"""permessage-deflate policy for the multiplexer's websockets
+
+uvicorn only has a global switch for compression, which accepts it on every websocket with zlib's default
+window and memory level: ~300 KiB of zlib state per connection. Instead, WebSocketProtocol accepts it per
+route, according to WS_DEFLATE_BRIDGE (the target's bridge connection, `…/ws`) and WS_DEFLATE_WEB (Cockpit's
+websocket from the browser, `…/web/…`), and with a smaller window and memory level. Compression only happens
+when the client offers it; the connector does unless called with --compression none.
+
+The connections to the session pods never use compression; they stay in the cluster, and the relay passes
+decompressed messages on anyway.
+"""
+
+import os
+import re
+import time
+from typing import List, Optional, Sequence, Tuple
+
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol as UvicornWebSocketProtocol
+from websockets.datastructures import Headers
+from websockets.extensions.base import Extension, ServerExtensionFactory
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+from websockets.frames import Frame
+
+import config
+import metrics
+from relay import DOWN, UP
+
+# accept compression on a route (1) or not (0)
+POLICY = {
+    'bridge': os.getenv('WS_DEFLATE_BRIDGE', '1') in ('1', 'true'),
+    'web': os.getenv('WS_DEFLATE_WEB', '1') in ('1', 'true'),
+}
+# LZ77 window of both directions, as a power of two (9 to 15); zlib's default is 15, i.e. 32 KiB; compressing
+# takes 4 times the window size, decompressing 1 time
+WINDOW_BITS = int(os.getenv('WS_DEFLATE_WINDOW_BITS', '12'))
+# zlib's memLevel for compressing (1 to 9; zlib's default is 8), which takes 2 ** (MEM_LEVEL + 9) bytes
+MEM_LEVEL = int(os.getenv('WS_DEFLATE_MEM_LEVEL', '5'))
+
+ROUTE_RE = re.compile(re.escape(config.ROUTE_WSS) + r'/sessions/[^/]+/(ws|web)(/|$)')
+
+CONNECTIONS = metrics.Counter('webconsole_ws_connections_total',
+                              'Accepted websockets, by route and negotiated compression (deflate, none)',
+                              ['route', 'compression'])
+DEFLATE_BYTES = metrics.Counter('webconsole_ws_deflate_bytes_total',
+                                'Payload bytes of compressed websocket frames, by route, direction, and form '
+                                '(compressed, uncompressed)', ['route', 'direction', 'form'])
+DEFLATE_SECONDS = metrics.Counter('webconsole_ws_deflate_seconds_total',
+                                  'Time spent compressing (down) and decompressing (up) websocket frames',
+                                  ['route', 'direction'])
+
+
+def route_of(path: str) -> Optional[str]:
+    """The POLICY route of a websocket request path, or None for unknown ones"""
+    match = ROUTE_RE.match(path)
+    if match is None:
+        return None
+    return 'bridge' if match.group(1) == 'ws' else 'web'
+
+
+class MeteredExtension(Extension):
+    """Wraps a negotiated extension to count bytes and time for DEFLATE_BYTES and DEFLATE_SECONDS
+
+    encode() and decode() return control frames and uncompressed messages as they are, so everything
+    else went through zlib. The calls are synchronous, so their duration is CPU time.
+    """
+    def __init__(self, extension: Extension, route: str):
+        self.extension = extension
+        self.name = extension.name
+        self.sent = (DEFLATE_BYTES.labels(route, DOWN, 'uncompressed'),
+                     DEFLATE_BYTES.labels(route, DOWN, 'compressed'), DEFLATE_SECONDS.labels(route, DOWN))
+        self.received = (DEFLATE_BYTES.labels(route, UP, 'uncompressed'),
+                         DEFLATE_BYTES.labels(route, UP, 'compressed'), DEFLATE_SECONDS.labels(route, UP))
+
+    def encode(self, frame: Frame) -> Frame:
+        start = time.perf_counter()
+        encoded = self.extension.encode(frame)
+        if encoded is not frame:
+            uncompressed, compressed, seconds = self.sent
+            seconds.inc(time.perf_counter() - start)
+            uncompressed.inc(len(frame.data))
+            compressed.inc(len(encoded.data))
+        return encoded
+
+    def decode(self, frame: Frame, *, max_size: Optional[int] = None) -> Frame:
+        start = time.perf_counter()
+        decoded = self.extension.decode(frame, max_size=max_size)
+        if decoded is not frame:
+            uncompressed, compressed, seconds = self.received
+            seconds.inc(time.perf_counter() - start)
+            uncompressed.inc(len(decoded.data))
+            compressed.inc(len(frame.data))
+        return decoded
+
+
+class MeteredDeflateFactory(ServerPerMessageDeflateFactory):
+    """permessage-deflate with WINDOW_BITS and MEM_LEVEL, whose connections count into the route's metrics"""
+    def __init__(self, route: str):
+        super().__init__(server_max_window_bits=WINDOW_BITS, client_max_window_bits=WINDOW_BITS,
+                         compress_settings={'memLevel': MEM_LEVEL})
+        self.route = route
+
+    def process_request_params(self, params: Sequence[Tuple[str, Optional[str]]],
+                               accepted_extensions: Sequence[Extension]):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, MeteredExtension(extension, self.route)
+
+
+# route → extension factories to offer
+FACTORIES = {route: [MeteredDeflateFactory(route)] if enabled else [] for route, enabled in POLICY.items()}
+
+
+class WebSocketProtocol(UvicornWebSocketProtocol):
+    """uvicorn's websockets protocol, which negotiates compression according to POLICY
+
+    For uvicorn.Config(ws=...).
+    """
+    def process_extensions(self, headers: Headers,
+                           available_extensions: Optional[Sequence[ServerExtensionFactory]]
+                           ) -> Tuple[Optional[str], List[Extension]]:
+        # the handshake has read the request line at this point
+        route = route_of(self.path)
+        header, extensions = super().process_extensions(headers, FACTORIES.get(route, []))
+        if route is not None:
+            CONNECTIONS.labels(route, 'deflate' if extensions else 'none').inc()
+        return header, extensions
@@ -0,0 +1,137 @@
+"""Per-org admission control for session creation
+
+Two limits, both shared by all replicas through Redis:
+
+ - ORG_MAX_SESSIONS: number of sessions of an org which are not closed (sessionstore keeps them in the
+   org:<org_id>:active set), plus the ones being created
+ - ORG_SESSION_RATE: number of session creations of an org per ORG_SESSION_RATE_WINDOW seconds, counted in
+   fixed windows (ratelimit:<org_id>:<window number>)
+
+A session only joins the active set once its pod is up, which takes seconds. So admitting a session reserves a
+slot for it in org:<org_id>:pending (a sorted set of slot IDs by expiry time), and the caller releases the slot
+once the session is in the active set, or failed. A decision is one MULTI/EXEC round trip which reserves the
+slots and counts both sets, so concurrent requests of an org can't overshoot ORG_MAX_SESSIONS; they may get
+rejected while a session is briefly counted in both sets. Slots of a replica which died before releasing them
+expire after ORG_RESERVATION_TTL seconds.
+
+Rejected attempts count against the rate, so that a script which keeps retrying stays limited. 0 disables a
+limit. If Redis fails, requests get admitted.
+"""
+
+import dataclasses
+import logging
+import math
+import os
+import time
+import uuid
+from typing import List, Optional
+
+import redis.asyncio
+import redis.exceptions
+
+import metrics
+from sessionstore import org_active_key
+
+logger = logging.getLogger(__name__)
+
+MAX_SESSIONS = int(os.getenv('ORG_MAX_SESSIONS', '0'))
+RATE = int(os.getenv('ORG_SESSION_RATE', '0'))
+RATE_WINDOW = int(os.getenv('ORG_SESSION_RATE_WINDOW', '60'))
+# Retry-After when an org has too many sessions; the reaper or the user closing one frees a slot
+FULL_RETRY_AFTER = int(os.getenv('ORG_FULL_RETRY_AFTER', '30'))
+# seconds after which an unreleased slot reservation expires; longer than creating a session (batch) takes
+RESERVATION_TTL = int(os.getenv('ORG_RESERVATION_TTL', '600'))
+
+DECISIONS = metrics.Counter('webconsole_org_limiter_decisions_total',
+                            'Session creation admission decisions, by result '
+                            '(allowed, rate_limited, too_many_sessions)',
+                            ['result'])
+DECISION_TIME = metrics.Histogram('webconsole_org_limiter_seconds', 'Duration of an admission decision')
+
+
+def org_pending_key(org_id: int) -> str:
+    return f'org:{org_id}:pending'
+
+
+@dataclasses.dataclass
+class Admission:
+    """Result of OrgLimiter.admit()"""
+    org_id: int
+    # None if admitted, otherwise the number of seconds after which to retry
+    retry_after: Optional[int] = None
+    # reserved ORG_MAX_SESSIONS slots which are not released yet
+    slots: List[str] = dataclasses.field(default_factory=list)
+
+
+class OrgLimiter:
+    def __init__(self, redis_client: redis.asyncio.Redis, max_sessions: int = MAX_SESSIONS, rate: int = RATE,
+                 window: int = RATE_WINDOW, reservation_ttl: int = RESERVATION_TTL):
+        self.redis = redis_client
+        self.max_sessions = max_sessions
+        self.rate = rate
+        self.window = window
+        self.reservation_ttl = reservation_ttl
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_sessions > 0 or self.rate > 0
+
+    async def admit(self, org_id: int, count: int = 1) -> Admission:
+        """Check whether org_id may create count sessions now, and reserve slots for them if so
+
+        Pass the result to release() for each session once it is created or failed.
+        """
+        if not self.enabled:
+            return Admission(org_id)
+
+        now = time.time()
+        window = int(now // self.window)
+        rate_key = f'ratelimit:{org_id}:{window}'
+        pending_key = org_pending_key(org_id)
+        slots = [str(uuid.uuid4()) for _ in range(count)] if self.max_sessions > 0 else []
+        with DECISION_TIME.time():
+            try:
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    pipe.incrby(rate_key, count)
+                    pipe.expire(rate_key, self.window)
+                    if slots:
+                        pipe.zremrangebyscore(pending_key, '-inf', now)
+                        pipe.zadd(pending_key, {slot: now + self.reservation_ttl for slot in slots})
+                        pipe.expire(pending_key, self.reservation_ttl)
+                        pipe.zcard(pending_key)
+                        pipe.scard(org_active_key(org_id))
+                    results = await pipe.execute()
+            except redis.exceptions.RedisError as e:
+                logger.warning('org limiter: Redis failed, admitting request: %s', e)
+                DECISIONS.labels('allowed').inc()
+                return Admission(org_id)
+
+        admission = Admission(org_id, slots=slots)
+        created = results[0]
+        if slots and results[-2] + results[-1] > self.max_sessions:
+            logger.debug('org %s has %i active and %i pending sessions (including %i new ones), rejecting',
+                         org_id, results[-1], results[-2], count)
+            DECISIONS.labels('too_many_sessions').inc()
+            admission.retry_after = FULL_RETRY_AFTER
+        elif self.rate > 0 and created > self.rate:
+            logger.debug('org %s created %i sessions in this window, rejecting', org_id, created)
+            DECISIONS.labels('rate_limited').inc()
+            admission.retry_after = max(1, math.ceil((window + 1) * self.window - now))
+        else:
+            DECISIONS.labels('allowed').inc()
+            return admission
+
+        await self.release(admission, count)
+        return admission
+
+    async def release(self, admission: Admission, count: int = 1) -> None:
+        """Give up count of the admission's reserved slots"""
+        slots = admission.slots[:count]
+        del admission.slots[:count]
+        if not slots:
+            return
+        try:
+            await self.redis.zrem(org_pending_key(admission.org_id), *slots)
+        except redis.exceptions.RedisError as e:
+            # they expire eventually
+            logger.warning('org limiter: releasing %i slots failed: %s', len(slots), e)
@@ -0,0 +1,334 @@
+"""Minimal Prometheus metrics
+
+This avoids a dependency on prometheus_client; it only supports what the multiplexer needs, and renders the
+text exposition format for the /metrics route.
+
+With several worker processes (see workers), each one has its own values. After share(), a worker writes them
+to a common directory every SHARE_INTERVAL seconds, and render() merges those of all workers: counters and
+histograms get summed, gauges get a "worker" label. The other workers' values are up to SHARE_INTERVAL old.
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SHARE_INTERVAL = float(os.getenv('METRICS_SHARE_INTERVAL', '5'))
+
+REGISTRY: List['Metric'] = []
+# (directory, worker) after share()
+_share: Optional[Tuple[str, str]] = None
+
+logger = logging.getLogger(__name__)
+
+# label values → value of one metric; see Metric.state()
+State = Dict[Tuple[str, ...], Any]
+
+# default latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.append(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values) -> object:
+        key = tuple(str(v) for v in values)
+        assert len(key) == len(self.labelnames), f'{self.name}: expected labels {self.labelnames}'
+        try:
+            return self._children[key]
+        except KeyError:
+            child = self._children[key] = self._new_child()
+            return child
+
+    def _unlabelled(self):
+        assert not self.labelnames, f'{self.name} needs labels'
+        return self.labels()
+
+    def state(self) -> State:
+        """Current values, JSON serializable"""
+        raise NotImplementedError
+
+    def merge(self, states: Dict[str, State]) -> Tuple[Tuple[str, ...], State]:
+        """(label names, state) for the states of all workers (worker → state)"""
+        raise NotImplementedError
+
+    def samples(self, labelnames: Tuple[str, ...], state: State) -> List[str]:
+        raise NotImplementedError
+
+    def render(self, states: Optional[Dict[str, State]] = None) -> str:
+        """Exposition of the current values, or of the merged states of all workers"""
+        labelnames, state = (self.labelnames, self.state()) if states is None else self.merge(states)
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines += self.samples(labelnames, state)
+        return '\n'.join(lines)
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1) -> None:
+        self._unlabelled().inc(amount)
+
+    def state(self) -> State:
+        return {key: child.value for key, child in self._children.items()}
+
+    def merge(self, states: Dict[str, State]) -> Tuple[Tuple[str, ...], State]:
+        total: State = {}
+        for state in states.values():
+            for key, value in state.items():
+                total[key] = total.get(key, 0) + value
+        return self.labelnames, total
+
+    def samples(self, labelnames: Tuple[str, ...], state: State) -> List[str]:
+        return [f'{self.name}{_format_labels(labelnames, key)} {_format_value(value)}'
+                for key, value in state.items()]
+
+
+class Gauge(Counter):
+    """Gauge which gets set explicitly, or computed on rendering with a callback
+
+    The callback returns either a number, or (for labelled gauges) a dict of label values tuple → number.
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], object]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value: float) -> None:
+        self._unlabelled().set(value)
+
+    def dec(self, amount: float = 1) -> None:
+        self._unlabelled().dec(amount)
+
+    def state(self) -> State:
+        if self.function is not None:
+            result = self.function()
+            if not isinstance(result, dict):
+                result = {(): result}
+            return {tuple(str(v) for v in key): value for key, value in result.items()}
+        return super().state()
+
+    def merge(self, states: Dict[str, State]) -> Tuple[Tuple[str, ...], State]:
+        # a sum would be wrong for values which every worker has in full, like sessions by status
+        return self.labelnames + ('worker',), {key + (worker,): value for worker, state in sorted(states.items())
+                                               for key, value in state.items()}
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    @contextlib.contextmanager
+    def time(self) -> Iterator[None]:
+        """Observe the duration of a with: block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._unlabelled().observe(value)
+
+    def time(self) -> ContextManager[None]:
+        return self._unlabelled().time()
+
+    def state(self) -> State:
+        # per bucket counts, then sum and count
+        return {key: child.counts + [child.sum, child.count] for key, child in self._children.items()}
+
+    def merge(self, states: Dict[str, State]) -> Tuple[Tuple[str, ...], State]:
+        total: State = {}
+        for state in states.values():
+            for key, values in state.items():
+                total[key] = [a + b for a, b in zip(total[key], values)] if key in total else list(values)
+        return self.labelnames, total
+
+    def samples(self, labelnames: Tuple[str, ...], state: State) -> List[str]:
+        lines = []
+        for key, values in state.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                labels = _format_labels(labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(values[-2])}')
+            lines.append(f'{self.name}_count{labels} {values[-1]}')
+        return lines
+
+
+class RouteMetricsMiddleware:
+    """ASGI middleware which observes the duration of HTTP requests
+
+    `histogram` needs the labels (route, status); route is the name of the handler function which the router
+    picked, or "none" for unrouted requests.
+    """
+    def __init__(self, app, histogram: Histogram):
+        self.app = app
+        self.histogram = histogram
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            endpoint = scope.get('endpoint')
+            route = getattr(endpoint, '__name__', 'none')
+            self.histogram.labels(route, status).observe(time.perf_counter() - start)
+
+
+def share(directory: str, worker: int) -> None:
+    """Share this worker's metrics with the other workers through directory; see publish()"""
+    global _share
+    _share = (directory, str(worker))
+
+
+def is_shared() -> bool:
+    return _share is not None
+
+
+def snapshot() -> Dict[str, State]:
+    """Current state of all metrics, by name"""
+    return {metric.name: metric.state() for metric in REGISTRY}
+
+
+def _write_snapshot(path: str, data: Dict[str, State]) -> None:
+    serialized = json.dumps({name: [[list(key), value] for key, value in state.items()]
+                             for name, state in data.items()})
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(serialized)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_shared() -> Dict[str, Dict[str, State]]:
+    """Last published snapshots of the other workers, by worker; blocking"""
+    directory, worker = _share
+    result = {}
+    for name in os.listdir(directory):
+        other, ext = os.path.splitext(name)
+        if ext != '.json' or other == worker:
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('failed to read metrics of worker %s: %s', other, e)
+            continue
+        result[other] = {metric: {tuple(key): value for key, value in samples} for metric, samples in data.items()}
+    return result
+
+
+async def publish() -> None:
+    """Write this worker's snapshot for the other workers every SHARE_INTERVAL seconds"""
+    directory, worker = _share
+    path = os.path.join(directory, worker + '.json')
+    while True:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, _write_snapshot, path, snapshot())
+        except OSError as e:
+            logger.warning('failed to write metrics to %s: %s', path, e)
+        await asyncio.sleep(SHARE_INTERVAL)
+
+
+def render(others: Optional[Dict[str, Dict[str, State]]] = None) -> str:
+    """Exposition of all metrics; merged with others (worker → snapshot, see read_shared()) after share()"""
+    if _share is None:
+        return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+    snapshots = dict(others or {})
+    snapshots[_share[1]] = snapshot()
+    return '\n'.join(metric.render({worker: data.get(metric.name, {}) for worker, data in snapshots.items()})
+                     for metric in REGISTRY) + '\n'
@@ -1,20 +1,20 @@
-import async_timeout
 import asyncio
 import base64
 import enum
+import functools
+import heapq
 import json
 import logging
 import os
-import socket
+import tempfile
 import uuid
-from typing import Dict, List, Tuple, Union
+from typing import Collection, Dict, List, Optional, Set, Tuple, Union
 
 import httpx
 import redis.exceptions
 import redis.asyncio
 import uvicorn
 import websockets
-import websockets.exceptions
 
 from starlette.applications import Starlette
 from starlette.authentication import (
@@ -28,58 +28,140 @@ from starlette.authentication import (
 from starlette.exceptions import HTTPException
 from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.background import BackgroundTask
-from starlette.concurrency import run_until_first_complete
 from starlette.requests import HTTPConnection, Request
-from starlette.responses import FileResponse, HTMLResponse, PlainTextResponse, JSONResponse, StreamingResponse
+from starlette.responses import PlainTextResponse, JSONResponse, StreamingResponse
 from starlette.websockets import WebSocket
 
 import config
+import deflate
+import metrics
+from assetcache import DISK_DIR as ASSET_CACHE_DIR, AssetCache
+from broadcast import StatusBroadcaster
+from cache import LRUCache
+from cluster import SESSION_AFFINITY, Cluster
+from limiter import Admission, OrgLimiter
+import orchestrator
+from proxy import SessionProxy
+from reaper import Reaper
+from relay import DOWN, UP, WebSocketRelay
+from sessionstore import Session, SessionStore, Status
+from static import StaticFile
+from warmpool import WARM_POOL_MAX, WARM_POOL_SIZE, WarmPool
+import workers
 
-API_URL = os.environ['API_URL']
-SESSION_INSTANCE_DOMAIN = os.getenv('SESSION_INSTANCE_DOMAIN', '')
-PODMAN_SOCKET = '/run/podman/podman.sock'
-K8S_SERVICE_ACCOUNT = '/run/secrets/kubernetes.io/serviceaccount'
 MY_DIR = os.path.dirname(__file__)
-
-
-class Backend(enum.Enum):
-    PODMAN = 0
-    K8S = 1
-
+# return from /sessions/new right away with status 'provisioning', instead of waiting for the session pod
+ASYNC_PROVISIONING = os.getenv('SESSION_ASYNC_PROVISIONING', '') in ('1', 'true')
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '50'))
+# number of distinct x-rh-identity headers to remember, and for how long (in seconds)
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', '10000'))
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', '60'))
+# page size of GET /sessions, and the maximum number of sessions per page or bulk status request
+LIST_PAGE_SIZE = 100
+LIST_MAX_SIZE = 1000
+# maximum number of sessions of one /sessions/batch request, and how many of them get created at the same time
+SESSION_BATCH_MAX = int(os.getenv('SESSION_BATCH_MAX', '500'))
+SESSION_BATCH_CONCURRENCY = int(os.getenv('SESSION_BATCH_CONCURRENCY', '20'))
+# seconds between keepalive comments on /events streams, so that proxies don't time out idle ones
+EVENTS_KEEPALIVE = float(os.getenv('SESSION_EVENTS_KEEPALIVE', '15'))
+# how long a session waits for a dropped resumable bridge connection (see RESUME_HEADER) to come back
+RESUME_GRACE = float(os.getenv('SESSION_RESUME_GRACE', '60'))
+# the connector sends this to ask for a resumable bridge connection; the session pod gets RESUME_GRACE in it
+RESUME_HEADER = 'x-webconsole-resume'
+# websocket-session.py closes a resumable bridge connection with this code when a newer one replaced it
+RESUME_SUPERSEDED = 4000
+
+AUTH_CACHE_LOOKUPS = metrics.Counter('webconsole_auth_cache_lookups_total',
+                                     'x-rh-identity header cache lookups, by result (hit, miss)', ['result'])
+REQUEST_TIME = metrics.Histogram('webconsole_http_request_seconds', 'HTTP request duration, by route and status',
+                                 ['route', 'status'])
+SESSION_NEW_PHASE_TIME = metrics.Histogram('webconsole_session_new_phase_seconds',
+                                           'Duration of the phases of /sessions/new (acquire, create, ready, redis)',
+                                           ['phase'])
+SESSIONS_BY_STATUS = metrics.Gauge('webconsole_sessions', 'Known sessions, by status', ['status'],
+                                   function=lambda: {(status.value,): count for status, count
+                                                     in SESSIONS.sessions.count_by_status().items()})
+WAITERS = metrics.Gauge('webconsole_status_waiters',
+                        'Local listeners for session status changes (/events streams and waiters)',
+                        function=lambda: STATUS.listeners)
 
 #
-# global state
+# global state; all of it gets created in init(), separately in each worker process
 #
 
-# session_id → {
-#     status: wait_target or running,
-#     ip: session container address,
-#     org_id: numeric org id from x-rh-identity header
-# }
-SESSIONS: Dict[str, Dict[str, Union[str, int]]] = {}
-WAIT_RUNNING_FUTURES: Dict[str, List[asyncio.Future]] = {}
-# file name → content
-STATIC_HTML: Dict[str, str] = {}
-BACKEND = None
+REDIS: redis.asyncio.Redis = None
+
+# session_id → Session, see SessionStore
+SESSIONS: SessionStore = None
+# file name → placeholder pages and their stylesheet
+STATIC: Dict[str, StaticFile] = {}
+BACKEND: orchestrator.Orchestrator = None
+POOL: Optional[WarmPool] = None
+# replica membership, for session affinity
+CLUSTER: Optional[Cluster] = None
+REAPER: Reaper = None
+# per-org admission control for session creation
+LIMITER: OrgLimiter = None
+# fire-and-forget tasks, see background(); the event loop only keeps weak references
+BACKGROUND_TASKS: Set[asyncio.Task] = set()
+PROXY = SessionProxy()
+# session status changes for /events streams and wait_status()
+STATUS = StatusBroadcaster()
+ASSETS: AssetCache = None
 logger = logging.getLogger('multiplexer')
 app = Starlette()
 
 
-def init():
-    global REDIS, STATIC_HTML, BACKEND
+def background_done(task: asyncio.Task) -> None:
+    BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('background task %s failed', task.get_coro().__qualname__, exc_info=task.exception())
+
+
+def background(coro) -> asyncio.Task:
+    """Run coro in a task which stays referenced until it finishes, and log its failure"""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(background_done)
+    return task
 
-    REDIS = redis.asyncio.Redis(host=os.environ['REDIS_SERVICE_HOST'],
-                                port=int(os.environ.get('REDIS_SERVICE_PORT', '6379')))
+
+def init(worker: int = 0, worker_count: int = 1):
+    """Set up the global state of this process
+
+    With several workers, each one gets its own share of the warm pool and its own asset cache directory.
+    """
+    global REDIS, SESSIONS, BACKEND, POOL, CLUSTER, ASSETS, REAPER, LIMITER
+
+    # session updates hold a connection for a few round trips (WATCH/MULTI); wait for a free one instead of
+    # failing under load
+    REDIS = redis.asyncio.Redis(connection_pool=redis.asyncio.BlockingConnectionPool(
+        host=os.environ['REDIS_SERVICE_HOST'],
+        port=int(os.environ.get('REDIS_SERVICE_PORT', '6379')),
+        socket_keepalive=True,
+        max_connections=REDIS_MAX_CONNECTIONS))
+    SESSIONS = SessionStore(REDIS, on_change=session_changed)
+    LIMITER = OrgLimiter(REDIS)
+    if SESSION_AFFINITY:
+        CLUSTER = Cluster(REDIS)
+    css = StaticFile.load(os.path.join(MY_DIR, 'patternfly.css'))
+    STATIC[css.name] = css
     for html_name in ('wait-session.html', 'closed-session.html', 'unknown-session.html'):
-        with open(os.path.join(MY_DIR, html_name)) as f:
-            STATIC_HTML[html_name] = f.read()
+        with open(os.path.join(MY_DIR, html_name), 'rb') as f:
+            # reference the stylesheet by version, so that browsers can cache it
+            html = f.read().replace(b'href="patternfly.css"', f'href="patternfly.css?v={css.version}"'.encode())
+        STATIC[html_name] = StaticFile(html_name, html)
 
-    if os.path.exists(K8S_SERVICE_ACCOUNT):
-        BACKEND = Backend.K8S
-    elif os.path.exists(PODMAN_SOCKET):
-        BACKEND = Backend.PODMAN
-    else:
-        raise NotImplementedError('cannot create sessions without kubernetes or podman')
+    disk_dir = ASSET_CACHE_DIR
+    if disk_dir and worker_count > 1:
+        disk_dir = os.path.join(disk_dir, str(worker))
+    ASSETS = AssetCache(disk_dir=disk_dir)
+
+    BACKEND = orchestrator.from_environment()
+    if WARM_POOL_SIZE > 0:
+        POOL = WarmPool(BACKEND, REDIS, size=-(-WARM_POOL_SIZE // worker_count),
+                        max_size=-(-WARM_POOL_MAX // worker_count))
+    REAPER = Reaper(SESSIONS, BACKEND)
 
 
 #
@@ -100,6 +182,8 @@ class AuthScope(str, enum.Enum):
 
 class XRHIdentityUser(SimpleUser):
     """User/System information from x-rh-identity header
+
+    These get shared between all requests with the same header, so don't modify them.
     """
     def __init__(
         self, username: Union[int, uuid.UUID], org_id: int, identity_type: str, extra: dict
@@ -108,28 +192,21 @@ class XRHIdentityUser(SimpleUser):
         self.org_id = org_id
         self.identity_type = identity_type
         self.extra = extra
+        self._display_name = f"{identity_type} {username} (org: {org_id})"
 
     @property
     def display_name(self) -> str:
-        return f"{self.identity_type} {self.username} (org: {self.org_id})"
-
+        return self._display_name
 
-class XRHIdentityAuthBackend(AuthenticationBackend):
-    """Authenticate User/System by x-rh-identity header
-    """
-    async def authenticate(self, conn):
-        try:
-            hdr_b64 = conn.headers["x-rh-identity"]
-        except KeyError:
-            # no header, unauthenticated
-            return AuthCredentials(), UnauthenticatedUser()
 
-        try:
-            hdr = json.loads(base64.b64decode(hdr_b64))
-            identity = hdr["identity"]
-        except (ValueError, KeyError, TypeError):
-            raise AuthenticationError("Invalid x-rh-identity header")
+def parse_identity(hdr_b64: str) -> Tuple[AuthCredentials, XRHIdentityUser]:
+    """Parse x-rh-identity header into credentials and user
 
+    Raises AuthenticationError for invalid headers.
+    """
+    try:
+        hdr = json.loads(base64.b64decode(hdr_b64))
+        identity = hdr["identity"]
         org_id = int(identity["org_id"])
         identity_type = identity["type"]
 
@@ -147,13 +224,84 @@ class XRHIdentityAuthBackend(AuthenticationBackend):
             )
         else:
             raise AuthenticationError("Invalid x-rh-identity header")
+    except (ValueError, KeyError, TypeError):
+        raise AuthenticationError("Invalid x-rh-identity header")
+
+    return AuthCredentials([AuthScope.authenticated, scope]), user
+
+
+class XRHIdentityAuthBackend(AuthenticationBackend):
+    """Authenticate User/System by x-rh-identity header
 
-        logger.info("Authenticated %r", user.display_name)
+    A page load sends dozens of requests with the same header, so parsed headers (including invalid ones) are
+    cached for AUTH_CACHE_TTL seconds.
+    """
+    def __init__(self, cache_size: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL):
+        # raw header → (credentials, user) or AuthenticationError
+        self.cache: LRUCache[str, Union[Tuple[AuthCredentials, XRHIdentityUser], AuthenticationError]] = \
+            LRUCache(cache_size, ttl=ttl)
+
+    async def authenticate(self, conn):
+        try:
+            hdr_b64 = conn.headers["x-rh-identity"]
+        except KeyError:
+            # no header, unauthenticated
+            return AuthCredentials(), UnauthenticatedUser()
 
-        return AuthCredentials([AuthScope.authenticated, scope]), user
+        result = self.cache.get(hdr_b64)
+        if result is None:
+            AUTH_CACHE_LOOKUPS.labels('miss').inc()
+            try:
+                result = parse_identity(hdr_b64)
+                logger.info("Authenticated %r", result[1].display_name)
+            except AuthenticationError as e:
+                result = e
+            self.cache.put(hdr_b64, result)
+        else:
+            AUTH_CACHE_LOOKUPS.labels('hit').inc()
+
+        if isinstance(result, AuthenticationError):
+            raise AuthenticationError(*result.args)
+        return result
+
+
+class ConnectionHeaderFixMiddleware:
+    """Repair the broken Connection: header from 3scale; see https://issues.redhat.com/browse/RHCLOUD-21326
+
+    3scale sends "Connection: Upgrade" without an Upgrade: header on plain HTTP requests. Drop the bogus
+    "upgrade" token, so that it does not get forwarded to the session pods. This works on the ASGI scope, so it
+    is independent of the HTTP protocol implementation (h11 or httptools).
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            headers = scope['headers']
+            connection_idx = None
+            for i, (name, value) in enumerate(headers):
+                if name == b'upgrade':
+                    connection_idx = None
+                    break
+                if name == b'connection' and b'upgrade' in value.lower():
+                    connection_idx = i
+            if connection_idx is not None:
+                tokens = [token for token in headers[connection_idx][1].split(b',')
+                          if token.strip().lower() != b'upgrade']
+                headers = list(headers)
+                if tokens:
+                    headers[connection_idx] = (b'connection', b','.join(tokens).strip())
+                else:
+                    del headers[connection_idx]
+                scope = dict(scope, headers=headers)
+                logger.debug('fixing broken Connection: header on %s', scope['path'])
+
+        await self.app(scope, receive, send)
 
 
 app.add_middleware(AuthenticationMiddleware, backend=XRHIdentityAuthBackend())
+app.add_middleware(metrics.RouteMetricsMiddleware, histogram=REQUEST_TIME)
+app.add_middleware(ConnectionHeaderFixMiddleware)
 
 
 @app.route(f'{config.ROUTE_API}/ping')
@@ -161,179 +309,294 @@ async def handle_ping(request: Request):
     return PlainTextResponse('pong')
 
 
-async def new_session_podman(sessionid):
-    name = f'session-{sessionid}'
-    body = {
-        'image': 'localhost/webconsoleapp',
-        'name': name,
-        # for local debugging
-        # 'command': ['sleep', 'infinity'],
-        'command': ['/cockpit-ws-session.sh'],
-        'env': {'API_URL': API_URL, 'ROUTE_WSS': config.ROUTE_WSS, 'SESSION_ID':  sessionid},
-        'netns': {'nsmode': 'bridge'},
-        # deprecated; use this with podman ≥ 4: 'Networks': {'consoledot': {}},
-        'cni_networks': ['consoledot'],
-    }
-
-    async with httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(uds=PODMAN_SOCKET)) as podman:
-        response = await podman.post('http://none/v1.12/libpod/containers/create', data=json.dumps(body).encode())
-        status = response.status_code
-        content = response.text
-
-        if status >= 200 and status < 300:
-            logger.debug('/new: creating container succeeded with %i: %s; starting container', status, content)
-            response = await podman.post(f'http://none/v1.12/libpod/containers/{name}/start')
-            status = response.status_code
-            content = response.text
-
-    return status, content
-
-
-async def new_session_k8s(sessionid):
-    name = f'session-{sessionid}'
-    with open(os.path.join(K8S_SERVICE_ACCOUNT, 'namespace')) as f:
-        namespace = f.read().strip()
-    with open(os.path.join(K8S_SERVICE_ACCOUNT, 'token')) as f:
-        authorization = 'Bearer ' + f.read().strip()
-
-    async with httpx.AsyncClient(verify=os.path.join(K8S_SERVICE_ACCOUNT, 'ca.crt')) as http:
-        response = await http.post(f'https://kubernetes.default.svc/api/v1/namespaces/{namespace}/pods',
-                                   headers={
-                                       'Authorization': authorization,
-                                       'Content-Type': 'application/yaml'
-                                   },
-                                   data=f'''
-apiVersion: v1
-kind: Pod
-metadata:
-  name: {name}
-  labels:
-    app: webconsoleapp-session
-spec:
-  hostname: {name}
-  # subdomain must match Service name in webconsoleapp-k8s.yaml
-  subdomain: webconsoleapp-sessions
-  restartPolicy: Never
-  containers:
-  - name: ws
-    # FIXME: make this dynamic
-    image: image-registry.openshift-image-registry.svc:5000/cockpit-dev/webconsoleapp
-    # command: ["sleep", "infinity"]
-    command: ['/cockpit-ws-session.sh']
-    ports:
-      - name: ws
-        containerPort: 8080
-      - name: web
-        containerPort: 9090
-    env:
-      - name: API_URL
-        value: {API_URL}
-      - name: ROUTE_WSS
-        value: {config.ROUTE_WSS}
-      - name: SESSION_ID
-        value: {sessionid}
-'''.encode())
-        return response.status_code, response.text
+@app.route(f'{config.ROUTE_API}/metrics')
+async def handle_metrics(request: Request):
+    others = None
+    if metrics.is_shared():
+        others = await asyncio.get_running_loop().run_in_executor(None, metrics.read_shared)
+    return PlainTextResponse(metrics.render(others), media_type=metrics.CONTENT_TYPE)
 
 
-@app.route(f'{config.ROUTE_API}/sessions/new', methods=['POST'])
-@requires([AuthScope.authenticated, AuthScope.user])
-async def handle_session_new(request: Request):
-    global SESSIONS
+async def new_session(org_id: int) -> Tuple[str, Status]:
+    """Create a session for org_id
 
+    Returns (session id, status). Raises HTTPException if creating the session pod fails; the pod gets deleted
+    then.
+    """
     sessionid = str(uuid.uuid4())
     assert sessionid not in SESSIONS
 
-    if BACKEND == Backend.K8S:
-        logger.debug('new_session: creating %s with k8s', sessionid)
-        pod_status, content = await new_session_k8s(sessionid)
-    elif BACKEND == Backend.PODMAN:
-        logger.debug('new_session: creating %s with podman', sessionid)
-        pod_status, content = await new_session_podman(sessionid)
-    else:
-        raise NotImplementedError(f'unknown backend {BACKEND}')
+    if POOL is not None:
+        with SESSION_NEW_PHASE_TIME.labels('acquire').time():
+            pod = await POOL.acquire(sessionid)
+        if pod is not None:
+            with SESSION_NEW_PHASE_TIME.labels('redis').time():
+                await SESSIONS.update(sessionid, ip=pod.ip, status=Status.WAIT_TARGET, org_id=org_id, pod=pod.name)
+            return sessionid, Status.WAIT_TARGET
+
+    logger.debug('new_session: creating %s with %s', sessionid, BACKEND.name)
+    pod_name = f'session-{sessionid}'
+    try:
+        with SESSION_NEW_PHASE_TIME.labels('create').time():
+            pod_status, content = await BACKEND.create_session(sessionid)
+    except httpx.HTTPError as e:
+        # the request may have gone through
+        await REAPER.delete_pod(pod_name)
+        raise HTTPException(502, f'creating session container failed: {e}')
 
     logger.debug('new_session result status %i, content: %s', pod_status, content)
 
-    if pod_status >= 200 and pod_status < 300:
-        loop = asyncio.get_running_loop()
-        session_hostname = f'session-{sessionid}{SESSION_INSTANCE_DOMAIN}'
-        # resolve and cache IPv4 addresses now, to avoid DNS lag/trouble during proxying
-        for retry in range(30):
+    if pod_status < 200 or pod_status >= 300:
+        raise HTTPException(pod_status, f'creating session container failed: {content}')
+
+    # the session is not in Redis until the end, so nothing else would clean up the pod
+    try:
+        if ASYNC_PROVISIONING:
+            with SESSION_NEW_PHASE_TIME.labels('redis').time():
+                await SESSIONS.update(sessionid, ip='', status=Status.PROVISIONING, org_id=org_id, pod=pod_name)
+            background(finish_provisioning(sessionid, pod_name))
+            return sessionid, Status.PROVISIONING
+
+        # get the pod address now, to avoid DNS lag/trouble during proxying
+        with SESSION_NEW_PHASE_TIME.labels('ready').time():
+            addr = await BACKEND.wait_ready(pod_name)
+        if addr is None:
+            raise HTTPException(500, 'timed out waiting for session container to become ready')
+
+        with SESSION_NEW_PHASE_TIME.labels('redis').time():
+            await SESSIONS.update(sessionid, ip=addr, status=Status.WAIT_TARGET, org_id=org_id, pod=pod_name)
+    except httpx.HTTPError as e:
+        await REAPER.delete_pod(pod_name)
+        raise HTTPException(502, f'waiting for session container failed: {e}')
+    except BaseException:
+        await REAPER.delete_pod(pod_name)
+        raise
+    return sessionid, Status.WAIT_TARGET
+
+
+async def admit(org_id: int, count: int = 1) -> Admission:
+    """Raises 429 if the org may not create count sessions now
+
+    Release the admission with LIMITER.release() as the sessions get created.
+    """
+    admission = await LIMITER.admit(org_id, count)
+    if admission.retry_after is not None:
+        raise HTTPException(429, 'too many sessions for this organization',
+                            headers={'Retry-After': str(admission.retry_after)})
+    return admission
+
+
+@app.route(f'{config.ROUTE_API}/sessions/new', methods=['POST'])
+@requires([AuthScope.authenticated, AuthScope.user])
+async def handle_session_new(request: Request):
+    admission = await admit(request.user.org_id)
+    try:
+        sessionid, status = await new_session(request.user.org_id)
+    finally:
+        await LIMITER.release(admission)
+    return JSONResponse({'id': sessionid, 'status': status.value}, headers=owner_headers(sessionid))
+
+
+@app.route(f'{config.ROUTE_API}/sessions/batch', methods=['POST'])
+@requires([AuthScope.authenticated, AuthScope.user])
+async def handle_session_batch(request: Request):
+    """Create several sessions: {"count": n} or {"labels": [...]}
+
+    Streams one JSON line per session as soon as it is ready, in completion order: the session's "index" or
+    "label", plus "id" and "status" (and "owner" with session affinity), or "error" and "code".
+    """
+    try:
+        body = await request.json()
+        labels = body.get('labels')
+        count = len(labels) if labels is not None else int(body['count'])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPException(400, 'expected {"count": n} or {"labels": [...]}')
+    if labels is not None and not (isinstance(labels, list) and all(isinstance(label, str) for label in labels)):
+        raise HTTPException(400, 'labels must be a list of strings')
+    if not 0 < count <= SESSION_BATCH_MAX:
+        raise HTTPException(400, f'can create between 1 and {SESSION_BATCH_MAX} sessions at once')
+
+    org_id = request.user.org_id
+    admission = await admit(org_id, count)
+    limit = asyncio.Semaphore(SESSION_BATCH_CONCURRENCY)
+
+    async def create(key: str, value: Union[int, str]) -> Dict[str, Union[int, str]]:
+        async with limit:
             try:
-                info = await loop.getaddrinfo(
-                    session_hostname, 8080, family=socket.AF_INET, type=socket.SOCK_STREAM
-                )
-            except socket.gaierror as e:
-                logger.debug('resolving %s failed, attempt #%i: %s', session_hostname, retry, e)
-                await asyncio.sleep(1)
-                continue
-
-            if not info:
-                logger.debug('getaddrinfo(%s) returned empty result, attempt #%i', session_hostname, retry)
-                await asyncio.sleep(1)
-                continue
-
-            # first result, sockaddr field, first entry is IPv4 address
-            addr = info[0][4][0]
-
-            logger.debug('session pod %s resolves to %s', session_hostname, addr)
-            SESSIONS[sessionid] = {'ip': addr, 'status': None, 'org_id': request.user.org_id}
-            await update_session(sessionid, 'wait_target')
-            response = JSONResponse({'id': sessionid})
-            break
+                sessionid, status = await new_session(org_id)
+            except HTTPException as e:
+                return {key: value, 'error': e.detail, 'code': e.status_code}
+            except httpx.HTTPError as e:
+                logger.warning('batch: creating session failed: %s', e)
+                return {key: value, 'error': str(e), 'code': 500}
+            finally:
+                await LIMITER.release(admission)
+        result = {key: value, 'id': sessionid, 'status': status.value}
+        if CLUSTER is not None:
+            result['owner'] = CLUSTER.owner(sessionid)[1]
+        return result
+
+    async def results():
+        items = [('label', label) for label in labels] if labels is not None else \
+            [('index', index) for index in range(count)]
+        tasks = [asyncio.create_task(create(key, value)) for key, value in items]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done) + '\n'
+        finally:
+            # client went away
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # tasks which got cancelled before they started
+            await LIMITER.release(admission, len(admission.slots))
+
+    return StreamingResponse(results(), media_type='application/x-ndjson')
+
+
+def owner_headers(sessionid: str) -> Dict[str, str]:
+    """Response headers which tell the load balancer where to route the session to"""
+    if CLUSTER is None:
+        return {}
+    return {'X-Webconsole-Owner': CLUSTER.owner(sessionid)[1]}
+
+
+async def finish_provisioning(sessionid: str, pod_name: str):
+    """Move an asynchronously provisioned session to wait_target once its pod is ready, or to closed"""
+    try:
+        addr = await BACKEND.wait_ready(pod_name)
+    except httpx.HTTPError as e:
+        logger.warning('session %s: waiting for session pod failed: %s', sessionid, e)
+        addr = None
+    try:
+        if addr is None:
+            await update_session(sessionid, Status.CLOSED)
         else:
-            response = PlainTextResponse('timed out waiting for session container to resolve in DNS', status_code=500)
-    else:
-        response = PlainTextResponse(f'creating session container failed: {content}', status_code=pod_status)
+            await SESSIONS.update(sessionid, ip=addr, status=Status.WAIT_TARGET)
+    except redis.exceptions.RedisError as e:
+        # the reaper expires the session eventually
+        logger.error('session %s: updating status after provisioning failed: %s', sessionid, e)
+
+
+def session_json(session: Session) -> Dict[str, Union[str, int]]:
+    return {'id': session.id, 'status': session.status.value, 'created': session.created, 'updated': session.updated}
 
-    return response
+
+@app.route(f'{config.ROUTE_API}/sessions')
+@requires([AuthScope.authenticated])
+async def handle_session_list(request: Request):
+    """List the sessions of the caller's org, ordered by ID
+
+    `status` (repeated or comma separated) filters by status, `limit` sets the page size, and `cursor` continues
+    after the `next` value of the previous page.
+    """
+    try:
+        statuses = {Status(status) for value in request.query_params.getlist('status')
+                    for status in value.split(',') if status}
+        limit = int(request.query_params.get('limit', LIST_PAGE_SIZE))
+    except ValueError:
+        raise HTTPException(400, 'invalid status or limit')
+    if not 0 < limit <= LIST_MAX_SIZE:
+        raise HTTPException(400, f'limit must be between 1 and {LIST_MAX_SIZE}')
+    cursor = request.query_params.get('cursor', '')
+
+    # the org index keeps this independent of the number of sessions of other orgs
+    page = heapq.nsmallest(limit + 1, (session for session in SESSIONS.sessions.by_org(request.user.org_id)
+                                       if session.id > cursor and (not statuses or session.status in statuses)),
+                           key=lambda session: session.id)
+    return JSONResponse({
+        'sessions': [session_json(session) for session in page[:limit]],
+        'next': page[limit - 1].id if len(page) > limit else None,
+    })
+
+
+@app.route(f'{config.ROUTE_API}/sessions/status', methods=['POST'])
+@requires([AuthScope.authenticated])
+async def handle_session_bulk_status(request: Request):
+    """Statuses of several sessions: {"ids": [...]} → {"statuses": {id: status}, "errors": {id: HTTP status}}"""
+    try:
+        session_ids = (await request.json())['ids']
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(400, 'expected {"ids": [...]}')
+    if not isinstance(session_ids, list) or not all(isinstance(session_id, str) for session_id in session_ids):
+        raise HTTPException(400, 'ids must be a list of strings')
+    if len(session_ids) > LIST_MAX_SIZE:
+        raise HTTPException(400, f'at most {LIST_MAX_SIZE} ids per request')
+
+    statuses = {}
+    errors = {}
+    for session_id, session in (await SESSIONS.lookup_many(session_ids)).items():
+        try:
+            statuses[session_id] = check_session(session, request).status.value
+        except HTTPException as e:
+            errors[session_id] = e.status_code
+    return JSONResponse({'statuses': statuses, 'errors': errors})
 
 
 @app.route(f'{config.ROUTE_API}/sessions/{{sessionid}}/status')
 @requires([AuthScope.authenticated])
 async def handle_session_status(request: Request):
-    _, session = get_session(request)
-    return PlainTextResponse(session['status'])
+    _, session = await get_session(request)
+    return PlainTextResponse(session.status.value)
 
 
-@app.route(f'{config.ROUTE_API}/sessions/{{sessionid}}/wait-running')
+@app.route(f'{config.ROUTE_API}/sessions/{{sessionid}}/owner')
 @requires([AuthScope.authenticated])
-async def handle_session_wait_running(request: Request):
-    sessionid, _ = get_session(request)
-    f = asyncio.get_running_loop().create_future()
-    WAIT_RUNNING_FUTURES.setdefault(sessionid, []).append(f)
-    # watch_redis() resolves f
-    return PlainTextResponse(await f)
-
-
-async def ws_up2down(recv_ws: WebSocket, send_ws: websockets.WebSocketClientProtocol):
-    while True:
-        msg = await recv_ws.receive()
-        if msg['type'] == 'websocket.receive':
-            data = msg.get('text') or msg.get('bytes')
-            await send_ws.send(data)
-        elif msg['type'] == 'websocket.disconnect':
-            break
+async def handle_session_owner(request: Request):
+    sessionid, _ = await get_session(request)
+    if CLUSTER is None:
+        raise HTTPException(404, 'session affinity is not enabled')
+    replica, address = CLUSTER.owner(sessionid)
+    return JSONResponse({'replica': replica, 'address': address})
+
 
+@app.route(f'{config.ROUTE_API}/sessions/{{sessionid}}/events')
+@requires([AuthScope.authenticated])
+async def handle_session_events(request: Request):
+    """Server-Sent Events stream of the session status, starting with the current one
 
-async def ws_down2up(recv_ws: websockets.WebSocketClientProtocol, send_ws: WebSocket):
-    while True:
+    Each status is a "status" event; the stream ends after "closed".
+    """
+    sessionid, _ = await get_session(request)
+
+    async def events():
+        # tell EventSource to not reconnect too eagerly after a replica restart
+        yield b'retry: 2000\n\n'
+        # the status may have changed while sending the response start; take the current one, and start
+        # listening without awaiting anything in between, so that no change gets lost
+        session = SESSIONS.get(sessionid)
+        listener = STATUS.listen(sessionid, session.status if session is not None else Status.CLOSED,
+                                 final=Status.CLOSED, keepalive=EVENTS_KEEPALIVE)
         try:
-            data = await recv_ws.recv()
-        except websockets.exceptions.ConnectionClosed as e:
-            logger.info('%s closed: %s', send_ws.url.path, e)
-            break
+            async for status in listener:
+                if status is None:
+                    yield b': keepalive\n\n'
+                else:
+                    yield f'event: status\ndata: {status.value}\n\n'.encode()
+        finally:
+            # the client went away, or the session closed
+            await listener.aclose()
+
+    # X-Accel-Buffering: don't let nginx based gateways hold back events
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route(f'{config.ROUTE_API}/sessions/{{sessionid}}/wait-running')
+@requires([AuthScope.authenticated])
+async def handle_session_wait_running(request: Request):
+    sessionid, _ = await get_session(request)
+    return PlainTextResponse((await wait_status(sessionid, (Status.RUNNING,))).value)
 
-        if isinstance(data, str):
-            await send_ws.send_text(data)
-        else:
-            await send_ws.send_bytes(data)
 
+async def websocket_forward(upstream_ws: WebSocket, target_url: str, coalesce: bool = False,
+                            headers: Optional[List[Tuple[str, str]]] = None) -> WebSocketRelay:
+    """Relay upstream_ws to target_url until one side closes
 
-async def websocket_forward(upstream_ws: WebSocket, target_url: str):
+    Returns the finished relay, which tells how the connection ended.
+    """
     await upstream_ws.accept()
-    headers = []
+    headers = headers or []
     origin = None
     for k, v in upstream_ws.scope['headers']:
         if k == b'origin':
@@ -347,12 +610,18 @@ async def websocket_forward(upstream_ws: WebSocket, target_url: str):
         subprotocols=upstream_ws.scope['subprotocols'],
         origin=origin,
         extra_headers=headers,
+        # the session pods are in the cluster; see deflate for the upstream side
+        compression=None,
     )
-    await run_until_first_complete(
-        (ws_up2down, {'recv_ws': upstream_ws, 'send_ws': downstream_ws}),
-        (ws_down2up, {'recv_ws': downstream_ws, 'send_ws': upstream_ws}),
-    )
-    await downstream_ws.close()
+    relay = WebSocketRelay(upstream_ws, downstream_ws, coalesce=coalesce)
+    try:
+        await relay.run()
+    finally:
+        await downstream_ws.close()
+    if relay.ended == DOWN:
+        # uvicorn keeps the connection open after the handler returns
+        await upstream_ws.close()
+    return relay
 
 
 @app.websocket_route(f'{config.ROUTE_WSS}/sessions/{{sessionid}}/ws')
@@ -360,15 +629,79 @@ async def websocket_forward(upstream_ws: WebSocket, target_url: str):
 async def handle_session_id_bridge(websocket: WebSocket):
     '''reverse-proxy bridge websocket to session pod'''
     try:
-        sessionid, session = get_session(websocket)
+        sessionid, session = await get_session(websocket)
     except HTTPException as e:
         await websocket.close(e.status_code, e.detail)
         return
 
-    if session['status'] == 'wait_target':
-        asyncio.create_task(update_session(sessionid, 'running'))
-    await websocket_forward(websocket, f'ws://{session["ip"]}:8080{websocket.url.path}')
-    await update_session(sessionid, 'closed')
+    if session.status == Status.PROVISIONING:
+        try:
+            await asyncio.wait_for(wait_status(sessionid, (Status.WAIT_TARGET, Status.RUNNING, Status.CLOSED)),
+                                   orchestrator.READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        session = SESSIONS.get(sessionid)
+        if session is None or session.status not in (Status.WAIT_TARGET, Status.RUNNING):
+            await websocket.close(1011, 'session failed to start')
+            return
+
+    target_url = f'ws://{session.ip}:8080{websocket.url.path}'
+    if RESUME_HEADER in websocket.headers:
+        await resumable_bridge(websocket, sessionid, target_url)
+        return
+    if session.status == Status.RECONNECTING:
+        await websocket.close(1008, 'session can only be resumed')
+        return
+
+    if session.status == Status.WAIT_TARGET:
+        background(update_session(sessionid, Status.RUNNING))
+    # the bridge websocket carries a byte stream, so frames can be coalesced
+    await websocket_forward(websocket, target_url, coalesce=True)
+    await update_session(sessionid, Status.CLOSED)
+
+
+async def resumable_bridge(websocket: WebSocket, sessionid: str, target_url: str):
+    """Relay a bridge connection which may drop and come back
+
+    The connector and websocket-session.py in the session pod keep unacknowledged data and replay it when the
+    connection resumes, so all this does is to keep the session in status reconnecting for RESUME_GRACE
+    seconds when the target side drops. The connection may come back through any replica.
+    """
+    # every connection bumps the session version, so that a relay which ends late can't override a newer one
+    session = await update_session(sessionid, Status.RUNNING)
+    if session is None:
+        await websocket.close(1008, 'session is closed')
+        return
+
+    try:
+        relay = await websocket_forward(websocket, target_url, coalesce=True,
+                                        headers=[(RESUME_HEADER, str(RESUME_GRACE))])
+    except (OSError, websockets.exceptions.WebSocketException) as e:
+        logger.warning('session %s: connecting to session pod failed: %s', sessionid, e)
+        await update_session(sessionid, Status.CLOSED)
+        # websocket_forward accepted the connection already; tell the connector not to retry
+        await websocket.close(1008, 'session is closed')
+        return
+
+    if relay.downstream.close_code == RESUME_SUPERSEDED:
+        logger.debug('session %s: bridge connection got replaced by a newer one', sessionid)
+        return
+    # a clean close from the connector ends the session
+    if relay.ended == UP and relay.upstream_close_code != 1000:
+        reconnecting = await SESSIONS.update(sessionid, if_version=session.version, status=Status.RECONNECTING)
+        # otherwise a newer connection already took over
+        if reconnecting is not None:
+            logger.info('session %s: bridge connection dropped, waiting %is for it to resume',
+                        sessionid, RESUME_GRACE)
+            background(expire_reconnecting(sessionid, reconnecting.version))
+        return
+    await update_session(sessionid, Status.CLOSED)
+
+
+async def expire_reconnecting(sessionid: str, version: int):
+    await asyncio.sleep(RESUME_GRACE)
+    if await SESSIONS.update(sessionid, if_version=version, status=Status.CLOSED) is not None:
+        logger.info('session %s: bridge connection did not resume, closing', sessionid)
 
 
 @app.websocket_route(f'{config.ROUTE_WSS}/sessions/{{sessionid}}/web/{{path:path}}')
@@ -376,17 +709,17 @@ async def handle_session_id_bridge(websocket: WebSocket):
 async def handle_session_id_ws(websocket: WebSocket):
     '''reverse-proxy cockpit websocket to session pod'''
     try:
-        sessionid, session = get_session(websocket)
+        sessionid, session = await get_session(websocket)
     except HTTPException as e:
         await websocket.close(e.status_code, e.detail)
         return
-    await websocket_forward(websocket, f'ws://{session["ip"]}:9090{websocket.url.path}')
-    await update_session(sessionid, 'closed')
+    await websocket_forward(websocket, f'ws://{session.ip}:9090{websocket.url.path}')
+    await update_session(sessionid, Status.CLOSED)
 
 
 @app.route(f'{config.ROUTE_WSS}/sessions/{{sessionid}}/web/patternfly.css', methods=['GET', 'HEAD'])
 async def handle_session_id_css(upstream_req):
-    return FileResponse(os.path.join(MY_DIR, 'patternfly.css'))
+    return STATIC['patternfly.css'].response(upstream_req)
 
 
 @app.route(f'{config.ROUTE_WSS}/sessions/{{sessionid}}/web/{{path:path}}', methods=['GET', 'HEAD'])
@@ -396,73 +729,113 @@ async def handle_session_id_http(request: Request):
 
     upstream_req = request
     try:
-        _, session = get_session(upstream_req)
+        _, session = await get_session(upstream_req)
     except HTTPException:
-        return HTMLResponse(STATIC_HTML['unknown-session.html'])
+        return STATIC['unknown-session.html'].response(upstream_req)
+
+    if session.status == Status.CLOSED:
+        return STATIC['closed-session.html'].response(upstream_req)
+    elif session.status != Status.RUNNING:
+        return STATIC['wait-session.html'].response(upstream_req)
 
-    if session['status'] == 'closed':
-        return HTMLResponse(STATIC_HTML['closed-session.html'])
-    elif session['status'] != 'running':
-        return HTMLResponse(STATIC_HTML['wait-session.html'])
+    cache_key = None
+    if ASSETS.cacheable_request(upstream_req, upstream_req.path_params['path']):
+        cache_key = ASSETS.key(upstream_req, upstream_req.path_params['path'])
+        asset = await ASSETS.lookup(cache_key)
+        if asset is not None:
+            return asset.response(upstream_req)
 
-    target_url = f'http://{session["ip"]}:9090{upstream_req.url.path}'
+    target_url = f'http://{session.ip}:9090{upstream_req.url.path}'
 
-    client = httpx.AsyncClient()
-    downstream_req = client.build_request(
+    downstream_req = PROXY.client.build_request(
         method=upstream_req.method,
         url=target_url,
         headers=upstream_req.headers.items(),
         params=upstream_req.query_params,
-        cookies=upstream_req.cookies,
     )
-    downstream_response = await client.send(downstream_req, stream=True)
+    try:
+        downstream_response = await PROXY.send(downstream_req)
+    except httpx.TransportError as e:
+        logger.warning('proxying %s failed: %s', target_url, e)
+        return PlainTextResponse(f'cannot connect to session: {e}', status_code=502)
+
+    if (cache_key is not None and upstream_req.method == 'GET' and
+            ASSETS.cacheable_response(downstream_response.status_code, downstream_response.headers.items())):
+        try:
+            body = b''.join([chunk async for chunk in downstream_response.aiter_raw()])
+        finally:
+            await downstream_response.aclose()
+        return ASSETS.store(cache_key, downstream_response.headers.items(), body).response(upstream_req)
+
     return StreamingResponse(
         downstream_response.aiter_raw(),
+        status_code=downstream_response.status_code,
         headers=dict(downstream_response.headers),
         background=BackgroundTask(downstream_response.aclose)
     )
 
 
-async def watch_redis(channel):
-    global SESSIONS
-    while True:
-        try:
-            async with async_timeout.timeout(1):
-                message = await channel.get_message(ignore_subscribe_messages=True)
-                if message is not None and message['channel'] == b'sessions':
-                    logger.debug('got redis sessions update: %s', message['data'])
-                    try:
-                        SESSIONS = json.loads(message['data'].decode())
-                    except json.decoder.JSONDecodeError as e:
-                        logger.warning('invalid JSON, starting without sessions: %s', e)
-                        SESSIONS = {}
-
-                    # resolve wait-running futures
-                    logger.debug('watch_redis WAIT_RUNNING_FUTURES before: %s', WAIT_RUNNING_FUTURES)
-                    for sessionid, wait_futures in WAIT_RUNNING_FUTURES.items():
-                        if SESSIONS.get(sessionid, {}).get('status') != 'running':
-                            continue
-
-                        for f in wait_futures.copy():
-                            logger.debug('session %s status is running, resolving wait-running', sessionid)
-                            f.set_result(None)
-                            wait_futures.remove(f)
-                    logger.debug('watch_redis WAIT_RUNNING_FUTURES after: %s', WAIT_RUNNING_FUTURES)
-
-                await asyncio.sleep(0.01)
-        except asyncio.TimeoutError:
-            pass
+async def wait_status(sessionid: str, statuses: Collection[Status]) -> Status:
+    """Wait until the session has one of the given statuses
+
+    Returns that status, or closed if the session closes or disappears first.
+    """
+    session = SESSIONS.get(sessionid)
+    listener = STATUS.listen(sessionid, session.status if session is not None else Status.CLOSED,
+                             final=Status.CLOSED)
+    try:
+        async for status in listener:
+            if status in statuses:
+                break
+    finally:
+        # unregister right away, not when the generator gets garbage collected
+        await listener.aclose()
+    return status
+
+
+def session_changed(sessionid):
+    """Called by SessionStore for every changed session"""
+    session = SESSIONS.get(sessionid)
+    # removed sessions are as good as closed
+    status = session.status if session is not None else Status.CLOSED
+
+    STATUS.publish(sessionid, status)
+
+    if status == Status.CLOSED and session is not None and session.addr:
+        # drop idle keep-alive connections to the session pod
+        background(PROXY.evict(session.ip))
 
 
 @app.on_event('startup')
-async def init_sessions():
-    global SESSIONS
+async def init_clients():
+    PROXY.start()
+    BACKEND.start()
+    if POOL is not None:
+        POOL.start()
+    if CLUSTER is not None:
+        CLUSTER.start()
+    REAPER.start()
+    if metrics.is_shared():
+        app.state.metrics_task = asyncio.create_task(metrics.publish())
+
+
+@app.on_event('shutdown')
+async def close_clients():
+    await REAPER.stop()
+    if CLUSTER is not None:
+        await CLUSTER.stop()
+    if POOL is not None:
+        await POOL.stop()
+    await PROXY.stop()
+    await BACKEND.stop()
 
-    pubsub = REDIS.pubsub()
+
+@app.on_event('startup')
+async def init_sessions():
     # wait for Redis service to be up
     for retry in range(10):
         try:
-            await pubsub.subscribe('sessions')
+            pubsub = await SESSIONS.subscribe()
             break
         except redis.exceptions.ConnectionError as e:
             logger.warning('Failed to connect to Redis, retry %i: %s', retry, e)
@@ -470,82 +843,59 @@ async def init_sessions():
     else:
         raise RuntimeError('timed out trying to connect to Redis')
 
-    asyncio.create_task(watch_redis(pubsub))
+    app.state.watch_redis_task = asyncio.create_task(SESSIONS.watch(pubsub))
+    await SESSIONS.load()
 
-    sessions = await REDIS.get('sessions')
-    if sessions is None:
-        SESSIONS = {}
-    else:
-        try:
-            SESSIONS = json.loads(sessions)
-        except json.decoder.JSONDecodeError:
-            SESSIONS = {}
 
-    logger.debug('initial sessions: %s', SESSIONS)
+async def update_session(session_id: str, status: Status) -> Optional[Session]:
+    """Change the status of a session
+
+    Returns None if the current status does not allow that change, e.g. for already closed sessions.
+    """
+    return await SESSIONS.update(session_id, status=status)
 
 
-async def update_session(session_id, status):
-    global SESSIONS
-    SESSIONS[session_id]['status'] = status
-    dumped_sessions = json.dumps(SESSIONS)
-    await REDIS.set('sessions', dumped_sessions)
-    await REDIS.publish('sessions', dumped_sessions)
+def check_session(session: Optional[Session], conn: HTTPConnection) -> Session:
+    """Check that the session exists and belongs to the requester's organization
 
+    Raises 404 for unknown sessions, and 403 for sessions of another organization
+    """
+    if session is None:
+        raise HTTPException(404, 'unknown session ID')
+    if session.org_id != conn.user.org_id:
+        raise HTTPException(403, 'invalid session ID')
+    return session
 
-def get_session(conn: HTTPConnection) -> Tuple[str, Dict[str, Union[str, int]]]:
+
+async def get_session(conn: HTTPConnection) -> Tuple[str, Session]:
     """Get session from request/websocket
 
     Raises 404 for unknown session ids
     Raises 403 if session belongs to another organization
 
-    Returns sessionid, session dict
+    Returns sessionid, Session
     """
-    global SESSIONS
     sessionid = conn.path_params['sessionid']
-    try:
-        session = SESSIONS[sessionid]
-    except KeyError:
-        raise HTTPException(404, 'unknown session ID')
+    session = check_session(await SESSIONS.lookup(sessionid), conn)
 
-    if session['org_id'] != conn.user.org_id:
-        raise HTTPException(403, 'invalid session ID')
+    if CLUSTER is not None:
+        CLUSTER.record_lookup(sessionid)
 
     return sessionid, session
 
 
-# Terrifying hack around broken 3scale Connection: header; see https://issues.redhat.com/browse/RHCLOUD-21326
-# uvicorn's H11Protocol.handle_events() can't be tapped into, so we need to monkey-patch
-# h11.Connection.next_event() to deliver non-broken headers; otherwise uvicorn refuses these paths with
-# "Unsupported upgrade request".
-import h11  # noqa: E402
-h11.Connection.next_event_real = h11.Connection.next_event
-
-
-def hack_h11_con_next_event(self):
-    res = h11.Connection.next_event_real(self)
-    if type(res) == h11.Request:
-        connection_idx = None
-        has_upgrade = False
-        for i, (name, value) in enumerate(res.headers):
-            if name == b'connection' and b'Upgrade' in value:
-                connection_idx = i
-            if name == b'upgrade':
-                has_upgrade = True
-
-        if connection_idx is not None and not has_upgrade:
-            res.headers._full_items[connection_idx] = (
-                    res.headers._full_items[connection_idx][0],  # raw name
-                    res.headers._full_items[connection_idx][1],  # normalized name
-                    res.headers._full_items[connection_idx][2].replace(b'Upgrade', b''))  # value
-            logger.debug('hack_h11_con_next_event on %s: fixing broken Connection: header', res.target)
-
-    return res
-
+def run_worker(worker: int, worker_count: int, metrics_dir: Optional[str] = None) -> None:
+    init(worker, worker_count)
+    if worker_count > 1 and metrics_dir:
+        metrics.share(metrics_dir, worker)
+    # uvloop and httptools if available
+    config = uvicorn.Config(app, loop='auto', http='auto', ws=deflate.WebSocketProtocol)
+    server = uvicorn.Server(config)
+    server.run(sockets=[workers.listen_socket('0.0.0.0', 8080, reuse_port=worker_count > 1)])
 
-h11.Connection.next_event = hack_h11_con_next_event
-# End hack
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.DEBUG)
-    init()
-    uvicorn.run(app, host='0.0.0.0', port=8080)
+    logging.basicConfig(level=logging.DEBUG, format='%(processName)s %(levelname)s:%(name)s:%(message)s')
+    # workers merge their metrics through this directory
+    with tempfile.TemporaryDirectory(prefix='multiplexer-metrics-') as metrics_dir:
+        workers.supervise(functools.partial(run_worker, metrics_dir=metrics_dir))
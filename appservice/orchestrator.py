@@ -0,0 +1,367 @@
+"""Session pod/container creation through the podman or Kubernetes API
+
+The orchestrators keep a long-lived HTTP client to the API server (HTTP/2 for Kubernetes if the h2 module is
+available, keep-alive otherwise), so that creating a session does not pay for a new connection or TLS
+handshake.
+
+Pod readiness comes from the API (Kubernetes pod watch, podman inspect/events) instead of polling DNS, and
+gets confirmed with a TCP probe of the session pod port.
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import os
+import re
+import ssl
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+
+import httpx
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+API_URL = os.environ['API_URL']
+# how long to wait for a new session pod to become ready, in seconds
+READY_TIMEOUT = float(os.getenv('SESSION_READY_TIMEOUT', '60'))
+# how many pod creation API calls may run at the same time
+API_CONCURRENCY = int(os.getenv('ORCHESTRATOR_CONCURRENCY', '16'))
+PODMAN_SOCKET = os.getenv('PODMAN_SOCKET', '/run/podman/podman.sock')
+K8S_SERVICE_ACCOUNT = '/run/secrets/kubernetes.io/serviceaccount'
+K8S_API = 'https://kubernetes.default.svc'
+
+POD_PHASE_TIME = metrics.Histogram('webconsole_pod_phase_seconds',
+                                   'Duration of pod creation API calls and readiness, by phase '
+                                   '(queue, create, start, ready)',
+                                   ['phase'])
+
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+class PodInfo(NamedTuple):
+    name: str
+    # warm pool pod (bound or not)
+    pool: bool
+    # creation time, as Unix time
+    created: float
+
+
+def parse_timestamp(value: Union[int, float, str]) -> float:
+    """Convert an API time stamp (Unix time, or RFC 3339 with optional fractional seconds) to Unix time"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    # Python's parser only understands up to microseconds, while Go emits nanoseconds
+    m = re.fullmatch(r'([0-9-]+T[0-9:]+)(\.[0-9]+)?(Z|[+-][0-9:]+)', value)
+    if m is None:
+        raise ValueError(f'invalid time stamp {value!r}')
+    zone = '+00:00' if m.group(3) == 'Z' else m.group(3)
+    seconds = datetime.datetime.fromisoformat(m.group(1) + zone).timestamp()
+    return seconds + float('0' + (m.group(2) or ''))
+
+
+class Orchestrator:
+    """Common interface of the session backends
+
+    Call start() at application startup and stop() at shutdown.
+    """
+    name = ''
+
+    def __init__(self):
+        self.client: Optional[httpx.AsyncClient] = None
+        self.api_calls: Optional[asyncio.Semaphore] = None
+
+    def _create_client(self) -> httpx.AsyncClient:
+        raise NotImplementedError
+
+    def start(self) -> None:
+        self.client = self._create_client()
+        self.api_calls = asyncio.Semaphore(API_CONCURRENCY)
+
+    async def stop(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def create_pod(self, name: str, env: Dict[str, str], pool: bool = False) -> Tuple[int, str]:
+        """Create and start a session pod/container running cockpit-ws-session.sh
+
+        env gets added to the common environment. `pool` marks warm pool pods which are not yet bound to a
+        session.
+
+        At most ORCHESTRATOR_CONCURRENCY creations run at the same time; further ones wait for their turn.
+
+        Returns (HTTP status, response text) of the API call.
+        """
+        with POD_PHASE_TIME.labels('queue').time():
+            await self.api_calls.acquire()
+        try:
+            return await self._create_pod(name, env, pool)
+        finally:
+            self.api_calls.release()
+
+    async def _create_pod(self, name: str, env: Dict[str, str], pool: bool) -> Tuple[int, str]:
+        raise NotImplementedError
+
+    async def delete_pod(self, name: str) -> Tuple[int, str]:
+        """Delete a session pod/container
+
+        Returns (HTTP status, response text) of the API call.
+        """
+        raise NotImplementedError
+
+    async def list_pods(self) -> List[PodInfo]:
+        """All session pods/containers, including warm pool ones
+
+        Raises httpx.HTTPError on failures.
+        """
+        raise NotImplementedError
+
+    async def create_session(self, sessionid: str) -> Tuple[int, str]:
+        return await self.create_pod(f'session-{sessionid}', {'SESSION_ID': sessionid})
+
+    async def wait_address(self, name: str) -> Optional[str]:
+        """Wait until the session pod is running
+
+        Returns its IP address, or None if it failed.
+        """
+        raise NotImplementedError
+
+    async def wait_ready(self, name: str, port: int = 8080, timeout: float = READY_TIMEOUT) -> Optional[str]:
+        """Wait until the session pod is running and listens on port
+
+        Returns its IP address, or None if it failed or timed out.
+        """
+        start = time.monotonic()
+        try:
+            addr = await asyncio.wait_for(self.wait_address(name), timeout)
+            if addr is None:
+                logger.warning('session pod %s failed to start', name)
+                return None
+            await asyncio.wait_for(probe(addr, port), timeout - (time.monotonic() - start))
+        except asyncio.TimeoutError:
+            logger.warning('timed out waiting for session pod %s to become ready', name)
+            return None
+
+        POD_PHASE_TIME.labels('ready').observe(time.monotonic() - start)
+        logger.debug('session pod %s is ready at %s after %.2fs', name, addr, time.monotonic() - start)
+        return addr
+
+
+async def probe(addr: str, port: int) -> None:
+    """Wait until addr:port accepts TCP connections, with exponential backoff"""
+    delay = 0.05
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(addr, port)
+            writer.close()
+            await writer.wait_closed()
+            return
+        except OSError as e:
+            logger.debug('probing %s:%i failed: %s', addr, port, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1)
+
+
+def session_env(env: Dict[str, str]) -> Dict[str, str]:
+    return dict({'API_URL': API_URL, 'ROUTE_WSS': config.ROUTE_WSS}, **env)
+
+
+class PodmanOrchestrator(Orchestrator):
+    name = 'podman'
+
+    def _create_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(base_url='http://none/v1.12/libpod',
+                                 transport=httpx.AsyncHTTPTransport(uds=PODMAN_SOCKET))
+
+    async def _create_pod(self, name: str, env: Dict[str, str], pool: bool) -> Tuple[int, str]:
+        body = {
+            'image': 'localhost/webconsoleapp',
+            'name': name,
+            # for local debugging
+            # 'command': ['sleep', 'infinity'],
+            'command': ['/cockpit-ws-session.sh'],
+            'env': session_env(env),
+            'labels': {'webconsoleapp-pool': str(pool).lower()},
+            'netns': {'nsmode': 'bridge'},
+            # deprecated; use this with podman ≥ 4: 'Networks': {'consoledot': {}},
+            'cni_networks': ['consoledot'],
+        }
+
+        with POD_PHASE_TIME.labels('create').time():
+            response = await self.client.post('/containers/create', content=json.dumps(body).encode())
+        status = response.status_code
+        content = response.text
+
+        if status >= 200 and status < 300:
+            logger.debug('/new: creating container succeeded with %i: %s; starting container', status, content)
+            with POD_PHASE_TIME.labels('start').time():
+                response = await self.client.post(f'/containers/{name}/start')
+            status = response.status_code
+            content = response.text
+
+        return status, content
+
+    async def delete_pod(self, name: str) -> Tuple[int, str]:
+        response = await self.client.delete(f'/containers/{name}', params={'force': 'true'})
+        return response.status_code, response.text
+
+    async def list_pods(self) -> List[PodInfo]:
+        # session containers are the ones with a pool label
+        filters = json.dumps({'label': ['webconsoleapp-pool']})
+        response = await self.client.get('/containers/json', params={'all': 'true', 'filters': filters})
+        response.raise_for_status()
+        return [PodInfo(container['Names'][0], container['Labels'].get('webconsoleapp-pool') == 'true',
+                        parse_timestamp(container['Created']))
+                for container in response.json()]
+
+    async def _inspect_address(self, name: str) -> Tuple[str, Optional[str]]:
+        """Return (container status, IP address)"""
+        response = await self.client.get(f'/containers/{name}/json')
+        response.raise_for_status()
+        info = response.json()
+        network = info['NetworkSettings']
+        addr = network.get('IPAddress')
+        for net in (network.get('Networks') or {}).values():
+            addr = addr or net.get('IPAddress')
+        return info['State']['Status'], addr or None
+
+    async def wait_address(self, name: str) -> Optional[str]:
+        status, addr = await self._inspect_address(name)
+        if status == 'running' and addr:
+            return addr
+
+        filters = json.dumps({'container': [name], 'type': ['container']})
+        async with self.client.stream('GET', '/events', params={'stream': 'true', 'filters': filters},
+                                      timeout=None) as response:
+            lines = response.aiter_lines()
+            # check again, the container may have started while we subscribed
+            status, addr = await self._inspect_address(name)
+            while not (status == 'running' and addr):
+                if status in ('exited', 'stopped'):
+                    return None
+                try:
+                    line = await lines.__anext__()
+                except StopAsyncIteration:
+                    return None
+                logger.debug('podman event for %s: %s', name, line)
+                status, addr = await self._inspect_address(name)
+        return addr
+
+
+class K8sOrchestrator(Orchestrator):
+    name = 'k8s'
+
+    def __init__(self):
+        super().__init__()
+        with open(os.path.join(K8S_SERVICE_ACCOUNT, 'namespace')) as f:
+            self.namespace = f.read().strip()
+        self.token_path = os.path.join(K8S_SERVICE_ACCOUNT, 'token')
+        self._token_mtime = None
+        self._authorization = ''
+
+    def _create_client(self) -> httpx.AsyncClient:
+        ssl_context = ssl.create_default_context(cafile=os.path.join(K8S_SERVICE_ACCOUNT, 'ca.crt'))
+        return httpx.AsyncClient(base_url=f'{K8S_API}/api/v1/namespaces/{self.namespace}',
+                                 verify=ssl_context, http2=HTTP2)
+
+    @property
+    def authorization(self) -> str:
+        """Authorization header value
+
+        The service account token gets rotated by the kubelet, so re-read it whenever the file changes.
+        """
+        mtime = os.stat(self.token_path).st_mtime_ns
+        if mtime != self._token_mtime:
+            with open(self.token_path) as f:
+                self._authorization = 'Bearer ' + f.read().strip()
+            self._token_mtime = mtime
+            logger.debug('(re-)loaded service account token')
+        return self._authorization
+
+    @staticmethod
+    def pod_manifest(name: str, env: Dict[str, str], pool: bool = False) -> Dict[str, Any]:
+        return {
+            'apiVersion': 'v1',
+            'kind': 'Pod',
+            'metadata': {
+                'name': name,
+                'labels': {'app': 'webconsoleapp-session', 'webconsoleapp-pool': str(pool).lower()},
+            },
+            'spec': {
+                'hostname': name,
+                # subdomain must match Service name in webconsoleapp-k8s.yaml
+                'subdomain': 'webconsoleapp-sessions',
+                'restartPolicy': 'Never',
+                'containers': [{
+                    'name': 'ws',
+                    # FIXME: make this dynamic
+                    'image': 'image-registry.openshift-image-registry.svc:5000/cockpit-dev/webconsoleapp',
+                    # 'command': ['sleep', 'infinity'],
+                    'command': ['/cockpit-ws-session.sh'],
+                    'ports': [
+                        {'name': 'ws', 'containerPort': 8080},
+                        {'name': 'web', 'containerPort': 9090},
+                    ],
+                    'env': [{'name': k, 'value': v} for k, v in session_env(env).items()],
+                }],
+            },
+        }
+
+    async def _create_pod(self, name: str, env: Dict[str, str], pool: bool) -> Tuple[int, str]:
+        with POD_PHASE_TIME.labels('create').time():
+            response = await self.client.post('/pods',
+                                              headers={
+                                                  'Authorization': self.authorization,
+                                                  'Content-Type': 'application/json',
+                                              },
+                                              content=json.dumps(self.pod_manifest(name, env, pool)).encode())
+        return response.status_code, response.text
+
+    async def delete_pod(self, name: str) -> Tuple[int, str]:
+        response = await self.client.delete(f'/pods/{name}', headers={'Authorization': self.authorization})
+        return response.status_code, response.text
+
+    async def list_pods(self) -> List[PodInfo]:
+        response = await self.client.get('/pods', params={'labelSelector': 'app=webconsoleapp-session'},
+                                         headers={'Authorization': self.authorization})
+        response.raise_for_status()
+        return [PodInfo(pod['metadata']['name'], pod['metadata'].get('labels', {}).get('webconsoleapp-pool') == 'true',
+                        parse_timestamp(pod['metadata']['creationTimestamp']))
+                for pod in response.json()['items']]
+
+    async def wait_address(self, name: str) -> Optional[str]:
+        params = {'watch': 'true', 'fieldSelector': f'metadata.name={name}'}
+        async with self.client.stream('GET', '/pods', params=params, headers={'Authorization': self.authorization},
+                                      timeout=None) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if event['type'] == 'DELETED':
+                    return None
+                status = event['object'].get('status', {})
+                if status.get('phase') in ('Succeeded', 'Failed'):
+                    return None
+                ready = any(c['type'] == 'Ready' and c['status'] == 'True' for c in status.get('conditions', []))
+                if ready and status.get('podIP'):
+                    return status['podIP']
+        return None
+
+
+def from_environment() -> Orchestrator:
+    """Pick the orchestrator which is available in this environment"""
+    if os.path.exists(K8S_SERVICE_ACCOUNT):
+        return K8sOrchestrator()
+    elif os.path.exists(PODMAN_SOCKET):
+        return PodmanOrchestrator()
+    else:
+        raise NotImplementedError('cannot create sessions without kubernetes or podman')
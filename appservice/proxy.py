@@ -0,0 +1,116 @@
+"""Pooled HTTP client for reverse-proxying to session pods"""
+
+import http.cookiejar
+import logging
+import os
+import time
+from typing import Dict, Tuple
+
+import httpx
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# connection limits per session pod
+MAX_CONNECTIONS = int(os.getenv('PROXY_MAX_CONNECTIONS_PER_POD', '20'))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('PROXY_MAX_KEEPALIVE_PER_POD', '10'))
+KEEPALIVE_EXPIRY = float(os.getenv('PROXY_KEEPALIVE_EXPIRY', '30'))
+TIMEOUT = float(os.getenv('PROXY_TIMEOUT', '30'))
+
+REQUESTS = metrics.Counter('webconsole_proxy_requests_total',
+                           'HTTP requests proxied to session pods, by response status', ['status'])
+ERRORS = metrics.Counter('webconsole_proxy_errors_total', 'Failed HTTP requests to session pods')
+RESPONSE_TIME = metrics.Histogram('webconsole_proxy_response_seconds',
+                                  'Time until the response headers from the session pod arrived')
+POOLS = metrics.Gauge('webconsole_proxy_pools', 'Number of session pod connection pools')
+
+
+class PerHostTransport(httpx.AsyncBaseTransport):
+    """Dispatch requests to a separate keep-alive connection pool per host
+
+    This keeps the connection limits per session pod, and allows dropping the pool of a particular pod
+    once its session is gone.
+    """
+    def __init__(self, limits: httpx.Limits):
+        self.limits = limits
+        self.pools: Dict[Tuple[bytes, int], httpx.AsyncHTTPTransport] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        key = (request.url.raw_host, request.url.port)
+        try:
+            pool = self.pools[key]
+        except KeyError:
+            logger.debug('creating connection pool for %s:%s', request.url.host, request.url.port)
+            pool = self.pools[key] = httpx.AsyncHTTPTransport(limits=self.limits)
+            POOLS.set(len(self.pools))
+        return await pool.handle_async_request(request)
+
+    async def evict(self, host: str) -> None:
+        """Close the connection pools to host (any port)"""
+        raw_host = host.encode()
+        for key in [key for key in self.pools if key[0] == raw_host]:
+            logger.debug('closing connection pool for %s:%s', host, key[1])
+            await self.pools.pop(key).aclose()
+        POOLS.set(len(self.pools))
+
+    async def aclose(self) -> None:
+        pools = list(self.pools.values())
+        self.pools.clear()
+        POOLS.set(0)
+        for pool in pools:
+            await pool.aclose()
+
+
+class NoCookieJar(http.cookiejar.CookieJar):
+    """Cookie jar which never stores anything
+
+    The client is shared by all sessions, and pod IPs get reused; cookies which a session pod sets are for the
+    browser, which sends them back in its own Cookie header.
+    """
+    def set_cookie(self, cookie: http.cookiejar.Cookie) -> None:
+        pass
+
+    def extract_cookies(self, response, request) -> None:
+        pass
+
+
+class SessionProxy:
+    """Application wide HTTP client for session pods
+
+    Create with start() at application startup, and release with stop() at shutdown.
+    """
+    def __init__(self):
+        self.transport = None
+        self.client = None
+
+    def start(self) -> None:
+        self.transport = PerHostTransport(httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                                       max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                                                       keepalive_expiry=KEEPALIVE_EXPIRY))
+        self.client = httpx.AsyncClient(transport=self.transport, timeout=TIMEOUT, cookies=NoCookieJar())
+
+    async def stop(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+            self.transport = None
+
+    async def evict(self, host: str) -> None:
+        if self.transport is not None:
+            await self.transport.evict(host)
+
+    async def send(self, request: httpx.Request) -> httpx.Response:
+        """Send request, and return the streaming response
+
+        The caller must close the response.
+        """
+        start = time.monotonic()
+        try:
+            response = await self.client.send(request, stream=True)
+        except httpx.HTTPError:
+            ERRORS.inc()
+            raise
+        RESPONSE_TIME.observe(time.monotonic() - start)
+        REQUESTS.labels(response.status_code).inc()
+        return response
@@ -0,0 +1,152 @@
+"""Expiry of old sessions, and deletion of their pods
+
+Closed sessions get removed SESSION_CLOSED_TTL seconds after they closed, and sessions which never got a bridge
+connection (provisioning or wait_target) SESSION_IDLE_TTL seconds after their last change. The same applies to
+reconnecting sessions, in case the replica which waited for their bridge to resume went away. Removing a session
+deletes its Redis entry (compare-and-set on its version, so that a session which changes in the meantime
+survives) and then its pod.
+
+Session pods which no session refers to, and which are older than REAPER_ORPHAN_GRACE seconds (to not race
+with session creation), get deleted as well. That includes unbound warm pool pods, unless a live pool claims
+them (see warmpool). Orphans are only looked for once the sessions are loaded, and not while they get reloaded
+after a Redis reconnect.
+
+All replicas and workers run a reaper, but a Redis lock lets only one of them do a pass per REAPER_INTERVAL.
+Each pass handles at most REAPER_BATCH sessions and orphans, with REAPER_CONCURRENCY parallel API calls.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import List, Optional, Tuple
+
+import httpx
+import redis.exceptions
+
+import metrics
+from orchestrator import Orchestrator
+from sessionstore import SessionStore, Status
+from warmpool import claimed_pods
+
+logger = logging.getLogger(__name__)
+
+CLOSED_TTL = float(os.getenv('SESSION_CLOSED_TTL', '3600'))
+IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', '1800'))
+ORPHAN_GRACE = float(os.getenv('REAPER_ORPHAN_GRACE', '600'))
+# seconds between passes; 0 disables the reaper
+INTERVAL = float(os.getenv('REAPER_INTERVAL', '60'))
+BATCH = int(os.getenv('REAPER_BATCH', '100'))
+CONCURRENCY = int(os.getenv('REAPER_CONCURRENCY', '4'))
+
+LOCK_KEY = 'reaper:lock'
+
+REAPED = metrics.Counter('webconsole_reaped_total', 'Removed sessions and pods, by reason (closed, idle, orphan)',
+                         ['reason'])
+DELETE_FAILURES = metrics.Counter('webconsole_reaper_delete_failures_total', 'Failed pod deletions')
+PASS_TIME = metrics.Histogram('webconsole_reaper_pass_seconds', 'Duration of a reaper pass')
+
+
+class Reaper:
+    def __init__(self, sessions: SessionStore, backend: Orchestrator, interval: float = INTERVAL,
+                 closed_ttl: float = CLOSED_TTL, idle_ttl: float = IDLE_TTL, orphan_grace: float = ORPHAN_GRACE,
+                 batch: int = BATCH, concurrency: int = CONCURRENCY):
+        self.sessions = sessions
+        self.backend = backend
+        self.interval = interval
+        self.closed_ttl = closed_ttl
+        self.idle_ttl = idle_ttl
+        self.orphan_grace = orphan_grace
+        self.batch = batch
+        self.concurrency = concurrency
+        self.api_calls: Optional[asyncio.Semaphore] = None
+        # lock owner, for debugging
+        self.name = f'{socket.gethostname()}/{os.getpid()}'
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.api_calls = asyncio.Semaphore(self.concurrency)
+        if self.interval > 0:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def expired(self, now: float) -> List[Tuple[str, int, str]]:
+        """(session id, version, reason) of the sessions to remove, oldest first"""
+        registry = self.sessions.sessions
+        candidates = [(now - session.updated, session.id, session.version, 'closed')
+                      for session in registry.by_status(Status.CLOSED) if now - session.updated > self.closed_ttl]
+        candidates += [(now - session.updated, session.id, session.version, 'idle')
+                       for status in (Status.PROVISIONING, Status.WAIT_TARGET, Status.RECONNECTING)
+                       for session in registry.by_status(status) if now - session.updated > self.idle_ttl]
+        candidates.sort(reverse=True)
+        return [(session_id, version, reason) for _, session_id, version, reason in candidates[:self.batch]]
+
+    async def delete_pod(self, name: str) -> bool:
+        async with self.api_calls:
+            try:
+                status, content = await self.backend.delete_pod(name)
+            except httpx.HTTPError as e:
+                status, content = 0, str(e)
+        # already gone is fine
+        if status == 404 or 200 <= status < 300:
+            return True
+        logger.warning('deleting pod %s failed with %i: %s', name, status, content)
+        DELETE_FAILURES.inc()
+        return False
+
+    async def reap_session(self, session_id: str, version: int, reason: str) -> None:
+        session = self.sessions.get(session_id)
+        pod = session.pod if session is not None else None
+        if not await self.sessions.delete(session_id, version):
+            logger.debug('session %s changed, not removing it', session_id)
+            return
+        logger.debug('removed %s session %s', reason, session_id)
+        REAPED.labels(reason).inc()
+        # if this fails, the orphan detection tries again
+        if pod:
+            await self.delete_pod(pod)
+
+    async def reap_orphans(self, now: float) -> None:
+        if self.sessions.loading or not self.sessions.loaded:
+            # the local registry may not know all sessions yet
+            logger.debug('sessions are loading, not looking for orphan pods')
+            return
+        try:
+            pods = await self.backend.list_pods()
+        except httpx.HTTPError as e:
+            logger.warning('listing session pods failed: %s', e)
+            return
+        used = {session.pod for session in self.sessions.sessions.values()}
+        # after listing the pods, so that pods which got bound meanwhile are still claimed
+        used |= await claimed_pods(self.sessions.redis)
+        orphans = [pod.name for pod in pods if pod.name not in used and now - pod.created > self.orphan_grace]
+        if orphans:
+            logger.info('deleting %i orphan pods', len(orphans[:self.batch]))
+        results = await asyncio.gather(*(self.delete_pod(name) for name in orphans[:self.batch]))
+        REAPED.labels('orphan').inc(sum(results))
+
+    async def run_once(self) -> bool:
+        """Do a pass, unless another replica or worker did one recently
+
+        Returns whether this did a pass.
+        """
+        if not await self.sessions.redis.set(LOCK_KEY, self.name, nx=True, px=int(self.interval * 1000)):
+            return False
+        with PASS_TIME.time():
+            now = time.time()
+            await asyncio.gather(*(self.reap_session(*candidate) for candidate in self.expired(now)))
+            await self.reap_orphans(now)
+        return True
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except redis.exceptions.RedisError as e:
+                logger.warning('reaper pass failed: %s', e)
@@ -0,0 +1,225 @@
+"""WebSocket relay between the multiplexer's ASGI websocket and a session pod websocket
+
+Each direction has a reader which queues frames into a byte-bounded buffer, and a writer which sends them on.
+When the buffer is full, the reader stops reading, so that a slow receiver pushes back to the sender instead
+of piling up memory. For byte-stream websockets (the bridge connection), the writer can coalesce queued small
+binary frames into one.
+"""
+
+import asyncio
+import collections
+import logging
+import os
+from typing import Deque, Optional, Set, Union
+
+import websockets
+import websockets.exceptions
+from starlette.websockets import WebSocket
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# per-direction buffer limit, in bytes
+BUFFER_SIZE = int(os.getenv('RELAY_BUFFER_SIZE', str(1024 * 1024)))
+# maximum size of a coalesced frame
+COALESCE_SIZE = int(os.getenv('RELAY_COALESCE_SIZE', str(64 * 1024)))
+
+UP = 'up'  # browser/target → session pod
+DOWN = 'down'  # session pod → browser/target
+
+MESSAGES = metrics.Counter('webconsole_relay_messages_total', 'Relayed websocket messages', ['direction'])
+BYTES = metrics.Counter('webconsole_relay_bytes_total', 'Relayed websocket payload bytes', ['direction'])
+FRAMES = metrics.Counter('webconsole_relay_frames_sent_total',
+                         'Sent websocket frames, after coalescing', ['direction'])
+ACTIVE = metrics.Gauge('webconsole_relay_connections', 'Active websocket relays',
+                       function=lambda: len(RELAYS))
+
+# all currently running relays
+RELAYS: Set['WebSocketRelay'] = set()
+
+Frame = Union[bytes, str]
+EOF = None
+
+
+class RelayStats:
+    __slots__ = ('messages', 'bytes', 'frames')
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.frames = 0
+
+    def __repr__(self):
+        return f'{self.messages} messages, {self.bytes} bytes, {self.frames} frames'
+
+
+class FrameBuffer:
+    """Byte-bounded FIFO of frames between one reader and one writer"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.frames: Deque[Optional[Frame]] = collections.deque()
+        self.size = 0
+        self._readable: Optional[asyncio.Future] = None
+        self._writable: Optional[asyncio.Future] = None
+
+    @staticmethod
+    def _wake(waiter: Optional[asyncio.Future]) -> None:
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def put(self, frame: Optional[Frame]) -> None:
+        while self.size >= self.limit:
+            self._writable = asyncio.get_running_loop().create_future()
+            await self._writable
+        self.frames.append(frame)
+        if frame is not None:
+            self.size += len(frame)
+        self._wake(self._readable)
+
+    async def wait(self) -> None:
+        """Wait until there is at least one frame"""
+        while not self.frames:
+            self._readable = asyncio.get_running_loop().create_future()
+            await self._readable
+
+    def pop(self) -> Optional[Frame]:
+        frame = self.frames.popleft()
+        if frame is not None:
+            self.size -= len(frame)
+            if self.size < self.limit:
+                self._wake(self._writable)
+        return frame
+
+
+class WebSocketRelay:
+    """Relay between an accepted ASGI websocket (upstream) and a websockets client connection (downstream)
+
+    With `coalesce`, consecutive queued binary frames get merged; only use this for websockets which carry a byte
+    stream, where frame boundaries don't matter.
+    """
+    def __init__(self, upstream: WebSocket, downstream: websockets.WebSocketClientProtocol,
+                 coalesce: bool = False, buffer_size: int = BUFFER_SIZE, coalesce_size: int = COALESCE_SIZE):
+        self.upstream = upstream
+        self.downstream = downstream
+        self.coalesce = coalesce
+        self.coalesce_size = coalesce_size
+        self.buffers = {UP: FrameBuffer(buffer_size), DOWN: FrameBuffer(buffer_size)}
+        self.stats = {UP: RelayStats(), DOWN: RelayStats()}
+        # which side closed first (UP or DOWN), and with which code for upstream
+        self.ended: Optional[str] = None
+        self.upstream_close_code: Optional[int] = None
+
+    async def read_upstream(self) -> None:
+        buffer = self.buffers[UP]
+        receive = self.upstream.receive
+        try:
+            while True:
+                message = await receive()
+                if message['type'] != 'websocket.receive':
+                    self.upstream_close_code = message.get('code')
+                    break
+                data = message.get('bytes')
+                await buffer.put(message.get('text', '') if data is None else data)
+        finally:
+            await buffer.put(EOF)
+
+    async def read_downstream(self) -> None:
+        buffer = self.buffers[DOWN]
+        recv = self.downstream.recv
+        try:
+            while True:
+                await buffer.put(await recv())
+        except websockets.exceptions.ConnectionClosed as e:
+            logger.info('%s closed: %s', self.upstream.url.path, e)
+        finally:
+            await buffer.put(EOF)
+
+    def _next(self, buffer: FrameBuffer) -> Optional[Frame]:
+        """Get the next frame to send, coalescing consecutive binary frames if enabled"""
+        frame = buffer.pop()
+        if not self.coalesce or not isinstance(frame, bytes) or not buffer.frames:
+            return frame
+
+        parts = [frame]
+        size = len(frame)
+        while buffer.frames:
+            next_frame = buffer.frames[0]
+            if not isinstance(next_frame, bytes) or size + len(next_frame) > self.coalesce_size:
+                break
+            parts.append(buffer.pop())
+            size += len(next_frame)
+        return b''.join(parts) if len(parts) > 1 else frame
+
+    async def write_downstream(self) -> None:
+        await self._write(UP, self.downstream.send)
+
+    async def write_upstream(self) -> None:
+        send = self.upstream.send
+
+        async def send_frame(frame: Frame) -> None:
+            if isinstance(frame, bytes):
+                await send({'type': 'websocket.send', 'bytes': frame})
+            else:
+                await send({'type': 'websocket.send', 'text': frame})
+
+        await self._write(DOWN, send_frame)
+
+    async def _write(self, direction: str, send) -> None:
+        buffer = self.buffers[direction]
+        stats = self.stats[direction]
+        messages = MESSAGES.labels(direction)
+        nbytes = BYTES.labels(direction)
+        frames = FRAMES.labels(direction)
+
+        while True:
+            await buffer.wait()
+            # send what is queued right now (up to a limit), then account for it in one go
+            batch_messages = batch_bytes = batch_frames = 0
+            while buffer.frames and batch_frames < 64:
+                queued = len(buffer.frames)
+                frame = self._next(buffer)
+                if frame is EOF:
+                    break
+                batch_messages += queued - len(buffer.frames)
+                await send(frame)
+                batch_bytes += len(frame)
+                batch_frames += 1
+            stats.messages += batch_messages
+            stats.bytes += batch_bytes
+            stats.frames += batch_frames
+            messages.inc(batch_messages)
+            nbytes.inc(batch_bytes)
+            frames.inc(batch_frames)
+            if frame is EOF:
+                return
+
+    async def run(self) -> str:
+        """Relay until one side closes the connection
+
+        Returns which side that was: UP for upstream, DOWN for downstream.
+        """
+        RELAYS.add(self)
+        tasks = [asyncio.create_task(coro) for coro in (
+            self.read_upstream(), self.read_downstream(), self.write_downstream(), self.write_upstream())]
+        writers = tasks[2:]
+        try:
+            done, _ = await asyncio.wait(writers, return_when=asyncio.FIRST_COMPLETED)
+            # a writer finishes when the side it reads from closed, or fails when the side it sends to did
+            self.ended = UP if writers[0] in done else DOWN
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    exc = task.exception()
+                    if not isinstance(exc, (websockets.exceptions.ConnectionClosed, OSError, RuntimeError)):
+                        raise exc
+                    logger.debug('%s: relay ended: %s', self.upstream.url.path, exc)
+                    self.ended = DOWN if task is writers[0] else UP
+            return self.ended
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            RELAYS.discard(self)
+            logger.debug('%s: relay finished; up: %s; down: %s',
+                         self.upstream.url.path, self.stats[UP], self.stats[DOWN])
@@ -2,6 +2,11 @@
 # cockpit session container entry point
 set -eux
 
+# warm pool pods get bound to a session later
+if [ -z "${SESSION_ID:-}" ]; then
+    SESSION_ID=$(/session-bind.py)
+fi
+
 # we cannot write to /etc as unprivileged user on k8s
 mkdir -p /tmp/conf/cockpit
 printf "[Webservice]\nUrlRoot=${ROUTE_WSS}/sessions/${SESSION_ID}/web\nOrigins = ${API_URL}\n" > /tmp/conf/cockpit/cockpit.conf
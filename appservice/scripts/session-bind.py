@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# Warm pool pods get started without a SESSION_ID; wait until the multiplexer binds them to a session.
+# Serves POST /bind with a JSON {"session_id": ...} body on the cockpit-ws port, authenticated with the
+# pod's BIND_TOKEN, then prints the session ID and exits.
+import http.server
+import json
+import logging
+import os
+import re
+import sys
+
+logger = logging.getLogger(__name__)
+
+PORT = 9090
+SESSION_ID_RE = re.compile(r'^[0-9a-f-]{36}$')
+
+
+class BindHandler(http.server.BaseHTTPRequestHandler):
+    session_id = None
+
+    def do_POST(self):
+        if self.path != '/bind' or self.headers.get('Authorization') != f'Bearer {os.environ["BIND_TOKEN"]}':
+            self.send_error(403)
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            session_id = body['session_id']
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400)
+            return
+        if not SESSION_ID_RE.match(session_id):
+            self.send_error(400)
+            return
+
+        BindHandler.session_id = session_id
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    server = http.server.HTTPServer(('', PORT), BindHandler)
+    while BindHandler.session_id is None:
+        server.handle_request()
+    server.server_close()
+    logger.info('bound to session %s', BindHandler.session_id)
+    print(BindHandler.session_id)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 import asyncio
+import collections
+import itertools
+import json
 import logging
 import os
 import sys
@@ -8,33 +11,315 @@ import websockets
 
 logger = logging.getLogger(__name__)
 
+# the multiplexer sets this on resumable bridge connections, to the number of seconds to wait for a dropped
+# connection to come back
+RESUME_HEADER = 'X-Webconsole-Resume'
+# close code for a resumable connection which a newer one replaced; the multiplexer knows it as well
+RESUME_SUPERSEDED = 4000
+# maximum unacknowledged output of a resumable connection, in bytes; beyond that, stop reading stdin
+RESUME_BUFFER = 4 * 1024 * 1024
+# acknowledge received data after that many bytes
+ACK_INTERVAL = 64 * 1024
+# maximum message size when replaying buffered data
+REPLAY_SIZE = 64 * 1024
+
+# bounds for reading stdin: start small for interactive traffic, and grow while cockpit-ws produces output
+# faster than we send it, so that bulk transfers go out in fewer, larger messages
+READ_MIN = 4096
+READ_MAX = 256 * 1024
+# stop reading the websocket while more than that many bytes wait for cockpit-ws to read stdout
+WRITE_HIGH_WATER = 1024 * 1024
+# maximum number of buffers per writev() call
+IOV_MAX = os.sysconf('SC_IOV_MAX') if 'SC_IOV_MAX' in os.sysconf_names else 1024
+
+
+class ResumableStream:
+    """Byte stream over a series of websocket connections
+
+    Binary messages carry the data, text messages acknowledgements: {"ack": <bytes received so far>}. Each
+    side sends one right after connecting, and then after every ACK_INTERVAL received bytes. Sent data stays
+    buffered until the peer acknowledges it, and gets replayed from the acknowledged offset after reconnecting.
+    The connector has the same implementation.
+    """
+    def __init__(self, limit=RESUME_BUFFER):
+        self.limit = limit
+        self.chunks = collections.deque()
+        # offset of the first buffered byte
+        self.acked = 0
+        self.size = 0
+        self.received = 0
+        # the current connection, once it caught up with the buffered data
+        self.ws = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    async def send(self, data):
+        """Queue data, and send it if connected
+
+        Waits while too much data is unacknowledged.
+        """
+        while self.size >= self.limit:
+            self.writable.clear()
+            await self.writable.wait()
+        self.chunks.append(data)
+        self.size += len(data)
+        ws = self.ws
+        if ws is not None:
+            try:
+                await ws.send(data)
+            except websockets.exceptions.ConnectionClosed:
+                # gets replayed on the next connection
+                pass
+
+    def ack(self, offset):
+        if not self.acked <= offset <= self.acked + self.size:
+            raise ValueError(f'cannot resume at offset {offset}, have {self.acked} to {self.acked + self.size}')
+        drop = offset - self.acked
+        self.acked = offset
+        self.size -= drop
+        while drop > 0:
+            chunk = self.chunks[0]
+            if len(chunk) <= drop:
+                self.chunks.popleft()
+            else:
+                self.chunks[0] = chunk[drop:]
+            drop -= len(chunk)
+        if self.size < self.limit:
+            self.writable.set()
+
+    def buffered(self, offset, limit):
+        """Up to limit buffered bytes from offset on"""
+        skip = offset - self.acked
+        parts = []
+        size = 0
+        for chunk in self.chunks:
+            if skip >= len(chunk):
+                skip -= len(chunk)
+                continue
+            parts.append(chunk[skip:skip + limit - size])
+            size += len(parts[-1])
+            skip = 0
+            if size >= limit:
+                break
+        return b''.join(parts)
+
+    async def run(self, ws, deliver):
+        """Carry the stream over ws until it closes
+
+        deliver(data) gets called for received data.
+        """
+        await ws.send(json.dumps({'ack': self.received}))
+        self.ack(json.loads(await ws.recv())['ack'])
+        # replay what the peer did not get; more may get queued meanwhile
+        sent = self.acked
+        while sent < self.acked + self.size:
+            data = self.buffered(sent, REPLAY_SIZE)
+            await ws.send(data)
+            sent += len(data)
+        self.ws = ws
+
+        try:
+            unacked = 0
+            async for message in ws:
+                if isinstance(message, str):
+                    self.ack(json.loads(message)['ack'])
+                    continue
+                await deliver(message)
+                self.received += len(message)
+                unacked += len(message)
+                if unacked >= ACK_INTERVAL:
+                    await ws.send(json.dumps({'ack': self.received}))
+                    unacked = 0
+        finally:
+            if self.ws is ws:
+                self.ws = None
+
+
+class PipeWriter:
+    """Non-blocking writer for a pipe
+
+    write() queues data, which gets flushed with writev() at the next event loop iteration and then whenever
+    the pipe becomes writable again; so messages which arrive close together, or while the reader is busy, go
+    out in one system call, and partial writes just leave the rest queued. drain() waits while more than
+    high_water bytes are queued.
+    """
+    def __init__(self, fd, high_water=WRITE_HIGH_WATER):
+        os.set_blocking(fd, False)
+        self.fd = fd
+        self.high_water = high_water
+        self.loop = asyncio.get_event_loop()
+        self.chunks = collections.deque()
+        self.size = 0
+        self.scheduled = False
+        self.waiting_writable = False
+        self.drained = None
+        self.error = None
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.chunks.append(data)
+        self.size += len(data)
+        if not self.scheduled and not self.waiting_writable:
+            self.scheduled = True
+            self.loop.call_soon(self._flush)
+
+    async def drain(self):
+        while self.size > self.high_water and self.error is None:
+            self.drained = self.loop.create_future()
+            await self.drained
+        if self.error is not None:
+            raise self.error
+
+    def _flush(self):
+        self.scheduled = False
+        try:
+            while self.chunks:
+                written = os.writev(self.fd, list(itertools.islice(self.chunks, IOV_MAX)))
+                self.size -= written
+                while written > 0:
+                    chunk = self.chunks[0]
+                    if len(chunk) <= written:
+                        self.chunks.popleft()
+                    else:
+                        self.chunks[0] = memoryview(chunk)[written:]
+                    written -= len(chunk)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            # e.g. EPIPE when cockpit-ws went away
+            self.error = e
+            self.chunks.clear()
+            self.size = 0
+
+        waiting = bool(self.chunks)
+        if waiting != self.waiting_writable:
+            if waiting:
+                self.loop.add_writer(self.fd, self._flush)
+            else:
+                self.loop.remove_writer(self.fd)
+            self.waiting_writable = waiting
+        if self.size <= self.high_water and self.drained is not None and not self.drained.done():
+            self.drained.set_result(None)
+
+
+# state of a resumable session: its stream, the current connection, and the timer for when none comes back
+resumable = None
+resumable_connection = None
+resumable_expiry = None
+
+
+stdout = None
+
+
+async def stdin_reader():
+    # wrap stdin in an asyncio stream
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader(limit=READ_MAX, loop=loop)
+    protocol = asyncio.StreamReaderProtocol(reader)
+    await loop.connect_read_pipe(lambda: protocol, sys.stdin.buffer)
+    return reader
+
+
+async def read_chunks(reader):
+    """Yield data from reader as it arrives, in bigger chunks while it keeps coming"""
+    size = READ_MIN
+    while True:
+        # returns whatever is available right away, so interactive output does not wait for a full buffer
+        data = await reader.read(size)
+        if not data:
+            return
+        if len(data) == size:
+            # more is probably waiting already
+            size = min(size * 2, READ_MAX)
+        elif len(data) < size // 4:
+            size = max(size // 2, READ_MIN)
+        yield data
+
+
+async def write_stdout(message):
+    global stdout
+
+    if stdout is None:
+        stdout = PipeWriter(sys.stdout.fileno())
+    stdout.write(message)
+    await stdout.drain()
+
 
 async def ws2out(ws):
     try:
         async for message in ws:
-            os.write(1, message)
+            await write_stdout(message)
     except websockets.exceptions.ConnectionClosed as e:
         logger.info('ws2out: websocket connection got closed: %s', e)
         return
 
 
 async def in2ws(reader, ws):
-    while True:
-        message = await reader.read(4096)
-        if not message:
-            logger.info('in -> ws: EOF')
-            await ws.close()
-            break
+    async for message in read_chunks(reader):
         await ws.send(message)
+    logger.info('in -> ws: EOF')
+    await ws.close()
+
+
+async def in2stream(reader, server):
+    global resumable_connection
+
+    async for message in read_chunks(reader):
+        await resumable.send(message)
+    logger.info('in -> ws: EOF')
+    connection, resumable_connection = resumable_connection, None
+    if connection is not None:
+        await connection.close()
+    server.close()
+
+
+async def expire(server, grace):
+    await asyncio.sleep(grace)
+    logger.info('bridge connection did not resume within %is', grace)
+    server.close()
+
+
+async def resumable_handler(ws):
+    global resumable, resumable_connection, resumable_expiry
+
+    grace = float(ws.request_headers[RESUME_HEADER])
+    if resumable is None:
+        resumable = ResumableStream()
+        asyncio.create_task(in2stream(await stdin_reader(), ws.ws_server))
+    if resumable_expiry is not None:
+        resumable_expiry.cancel()
+        resumable_expiry = None
+    previous = resumable_connection
+    resumable_connection = ws
+    if previous is not None:
+        logger.info('replacing bridge connection')
+        await previous.close(RESUME_SUPERSEDED, 'replaced by a newer connection')
+
+    try:
+        await resumable.run(ws, write_stdout)
+    except websockets.exceptions.ConnectionClosed as e:
+        logger.info('bridge connection got closed: %s', e)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning('cannot resume bridge connection: %s', e)
+        await ws.close(1002, 'invalid resume handshake')
+    except OSError as e:
+        logger.info('writing to cockpit-ws failed: %s', e)
+        resumable_connection = None
+        ws.ws_server.close()
+
+    if resumable_connection is ws:
+        resumable_connection = None
+        logger.info('waiting %is for the bridge connection to resume', grace)
+        resumable_expiry = asyncio.create_task(expire(ws.ws_server, grace))
 
 
 async def handler(ws):
-    # wrap stdin in an asyncio stream
-    loop = asyncio.get_event_loop()
-    reader = asyncio.StreamReader(loop=loop)
-    protocol = asyncio.StreamReaderProtocol(reader)
-    await loop.connect_read_pipe(lambda: protocol, sys.stdin.buffer)
+    if RESUME_HEADER in ws.request_headers:
+        await resumable_handler(ws)
+        return
 
+    reader = await stdin_reader()
     ws2out_task = asyncio.create_task(ws2out(ws))
     in2ws_task = asyncio.create_task(in2ws(reader, ws))
     _done, pending = await asyncio.wait([ws2out_task, in2ws_task],
@@ -0,0 +1,444 @@
+import asyncio
+import collections
+import dataclasses
+import enum
+import ipaddress
+import logging
+import struct
+import time
+from typing import Callable, DefaultDict, Dict, Iterable, Iterator, List, Optional, Set, Union
+
+import redis.asyncio
+import redis.exceptions
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Redis layout:
+#   session:<id>         the session in wire encoding (see Session.encode())
+#   org:<org_id>:sessions set of session ids which belong to that org
+#   org:<org_id>:active  set of the org's session ids which are not closed
+#   sessions             pub/sub channel with per-session events: b'S' + wire encoding of the new state, or
+#                        b'D' + version + id for removed sessions
+SESSION_KEY_PREFIX = 'session:'
+CHANNEL = 'sessions'
+
+
+class Status(str, enum.Enum):
+    # the wire encoding uses the index of the status in this list, so only ever append
+    PROVISIONING = 'provisioning'
+    WAIT_TARGET = 'wait_target'
+    RUNNING = 'running'
+    CLOSED = 'closed'
+    # the target's bridge connection dropped, and the session waits for it to resume
+    RECONNECTING = 'reconnecting'
+
+
+_STATUSES = list(Status)
+
+# allowed status changes (None: new session); once closed, a session stays closed
+TRANSITIONS = {
+    None: {Status.PROVISIONING, Status.WAIT_TARGET},
+    Status.PROVISIONING: {Status.WAIT_TARGET, Status.CLOSED},
+    Status.WAIT_TARGET: {Status.RUNNING, Status.CLOSED},
+    Status.RUNNING: {Status.RECONNECTING, Status.CLOSED},
+    Status.RECONNECTING: {Status.RUNNING, Status.CLOSED},
+    Status.CLOSED: set(),
+}
+
+# version, org_id, created, updated, status index, address length
+_HEADER = struct.Struct('!IqIIBB')
+_DELETED = struct.Struct('!I')
+
+PUBLISH_TIME = metrics.Histogram('webconsole_session_publish_seconds',
+                                 'Duration of writing and publishing a session update to Redis')
+APPLY_TIME = metrics.Histogram('webconsole_session_apply_seconds',
+                               'Duration of applying a session event from Redis')
+CONFLICTS = metrics.Counter('webconsole_session_update_conflicts_total',
+                            'Session updates which had to be retried because another replica changed the session')
+REJECTED = metrics.Counter('webconsole_session_transitions_rejected_total',
+                           'Session status changes which were not allowed from the current status')
+
+
+def session_key(session_id: str) -> str:
+    return SESSION_KEY_PREFIX + session_id
+
+
+def org_index_key(org_id: int) -> str:
+    return f'org:{org_id}:sessions'
+
+
+def org_active_key(org_id: int) -> str:
+    return f'org:{org_id}:active'
+
+
+@dataclasses.dataclass
+class Session:
+    __slots__ = ('id', 'status', 'org_id', 'addr', 'pod', 'version', 'created', 'updated')
+    id: str
+    status: Status
+    # numeric org id from x-rh-identity header
+    org_id: int
+    # packed session container address; empty while provisioning
+    addr: bytes
+    # name of the session pod/container
+    pod: str
+    # monotonically increasing per-session update counter
+    version: int
+    # Unix time of creation and of the last update
+    created: int
+    updated: int
+
+    @property
+    def ip(self) -> str:
+        return str(ipaddress.ip_address(self.addr)) if self.addr else ''
+
+    def encode(self) -> bytes:
+        return b''.join((
+            _HEADER.pack(self.version, self.org_id, self.created, self.updated, _STATUSES.index(self.status),
+                         len(self.addr)),
+            self.addr,
+            self.id.encode(), b'\0', self.pod.encode()))
+
+    @classmethod
+    def decode(cls, data: bytes) -> 'Session':
+        version, org_id, created, updated, status, addr_len = _HEADER.unpack_from(data)
+        start = _HEADER.size + addr_len
+        session_id, pod = data[start:].decode().split('\0')
+        return cls(session_id, _STATUSES[status], org_id, data[_HEADER.size:start], pod, version, created, updated)
+
+
+def pack_address(ip: str) -> bytes:
+    return ipaddress.ip_address(ip).packed if ip else b''
+
+
+class SessionRegistry:
+    """Sessions by id, with indexes by org and by status
+
+    Sessions must not be changed in place; put() a new Session object instead, so that the indexes stay
+    current.
+    """
+    def __init__(self):
+        self._sessions: Dict[str, Session] = {}
+        self._by_org: DefaultDict[int, Set[str]] = collections.defaultdict(set)
+        self._by_status: Dict[Status, Set[str]] = {status: set() for status in Status}
+
+    def get(self, session_id: str) -> Optional[Session]:
+        return self._sessions.get(session_id)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._sessions)
+
+    def values(self) -> Iterable[Session]:
+        return self._sessions.values()
+
+    def put(self, session: Session) -> None:
+        old = self._sessions.get(session.id)
+        if old is not None:
+            if old.status != session.status:
+                self._by_status[old.status].discard(old.id)
+            if old.org_id != session.org_id:
+                self._drop_org(old)
+        self._sessions[session.id] = session
+        self._by_status[session.status].add(session.id)
+        self._by_org[session.org_id].add(session.id)
+
+    def remove(self, session_id: str) -> Optional[Session]:
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._by_status[session.status].discard(session_id)
+            self._drop_org(session)
+        return session
+
+    def _drop_org(self, session: Session) -> None:
+        ids = self._by_org[session.org_id]
+        ids.discard(session.id)
+        if not ids:
+            del self._by_org[session.org_id]
+
+    def by_org(self, org_id: int) -> List[Session]:
+        return [self._sessions[session_id] for session_id in self._by_org.get(org_id, ())]
+
+    def by_status(self, status: Status) -> List[Session]:
+        return [self._sessions[session_id] for session_id in self._by_status[status]]
+
+    def count_by_status(self) -> Dict[Status, int]:
+        return {status: len(ids) for status, ids in self._by_status.items()}
+
+
+class SessionStore:
+    """Redis backed session store with a local cache
+
+    Each session lives in its own Redis key. Updates are written together with an event with the new state in
+    a MULTI/EXEC transaction; every replica applies these events to its local `sessions` registry, so that
+    an update costs O(1) instead of O(all sessions). Several replicas can update the same session: updates
+    are compare-and-set on the session's version (WATCH), and get retried on conflicts.
+
+    `on_change(session_id)` gets called whenever a session changes, both for local updates and remote
+    ones.
+    """
+    def __init__(self, redis_client: redis.asyncio.Redis, load_batch: int = 500,
+                 on_change: Optional[Callable[[str], None]] = None):
+        self.redis = redis_client
+        self.load_batch = load_batch
+        self.on_change = on_change or (lambda session_id: None)
+        self.sessions = SessionRegistry()
+        # while load() runs: the registry it fills, which replaces `sessions` at the end
+        self._loading: Optional[SessionRegistry] = None
+        self.loaded = False
+
+    def get(self, session_id: str) -> Optional[Session]:
+        return self.sessions.get(session_id)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self.sessions
+
+    @property
+    def loading(self) -> bool:
+        """Whether load() is running, i.e. `sessions` may miss sessions which got created elsewhere"""
+        return self._loading is not None
+
+    @staticmethod
+    def _put_newer(registry: SessionRegistry, session: Session) -> bool:
+        local = registry.get(session.id)
+        if local is not None and local.version >= session.version:
+            return False
+        registry.put(session)
+        return True
+
+    def _merge(self, session: Session) -> bool:
+        """Put session into the local registry, unless we already have that version or a newer one"""
+        if self._loading is not None:
+            self._put_newer(self._loading, session)
+        return self._put_newer(self.sessions, session)
+
+    def _remove(self, session_id: str) -> Optional[Session]:
+        if self._loading is not None:
+            self._loading.remove(session_id)
+        return self.sessions.remove(session_id)
+
+    async def _fetch_batch(self, session_ids: Iterable[str], registry: Optional[SessionRegistry] = None) -> None:
+        """Get sessions from Redis into the local registry, or only into the given one"""
+        session_ids = list(session_ids)
+        results = await self.redis.mget([session_key(session_id) for session_id in session_ids])
+        for session_id, data in zip(session_ids, results):
+            if data:
+                # a newer event may have arrived while we were waiting for the reply
+                if registry is None:
+                    self._merge(Session.decode(data))
+                else:
+                    self._put_newer(registry, Session.decode(data))
+            elif registry is None:
+                # got removed in the meantime
+                self._remove(session_id)
+            else:
+                registry.remove(session_id)
+
+    async def load(self) -> List[str]:
+        """(Re-)load all sessions from Redis
+
+        This uses SCAN and batched MGETs, to avoid blocking Redis with one huge reply. Meanwhile, `sessions`
+        keeps the previous state (plus changes which happen during loading), and gets replaced at the end.
+        Returns the IDs of all sessions which changed compared to the previous local state.
+        """
+        loading = self._loading = SessionRegistry()
+        try:
+            batch = []
+            async for key in self.redis.scan_iter(match=SESSION_KEY_PREFIX + '*', count=self.load_batch):
+                batch.append(key.decode()[len(SESSION_KEY_PREFIX):])
+                if len(batch) >= self.load_batch:
+                    await self._fetch_batch(batch, loading)
+                    batch = []
+            if batch:
+                await self._fetch_batch(batch, loading)
+        finally:
+            self._loading = None
+        old_sessions, self.sessions = self.sessions, loading
+        self.loaded = True
+
+        logger.debug('loaded %i sessions', len(self.sessions))
+
+        changed = [session.id for session in self.sessions.values()
+                   if getattr(old_sessions.get(session.id), 'version', None) != session.version]
+        changed += [session_id for session_id in old_sessions if session_id not in self.sessions]
+        for session_id in changed:
+            self.on_change(session_id)
+        return changed
+
+    async def lookup(self, session_id: str) -> Optional[Session]:
+        """Get a session, asking Redis if it is not known locally
+
+        A session which another replica just created may not have arrived here yet.
+        """
+        session = self.sessions.get(session_id)
+        if session is None:
+            await self._fetch_batch([session_id])
+            session = self.sessions.get(session_id)
+        return session
+
+    async def lookup_many(self, session_ids: Iterable[str]) -> Dict[str, Optional[Session]]:
+        """Get several sessions, with one Redis round trip for all the ones which are not known locally"""
+        session_ids = list(session_ids)
+        missing = [session_id for session_id in session_ids if session_id not in self.sessions]
+        if missing:
+            await self._fetch_batch(missing)
+        return {session_id: self.sessions.get(session_id) for session_id in session_ids}
+
+    async def update(self, session_id: str, if_version: Optional[int] = None,
+                     **fields: Union[str, int, Status]) -> Optional[Session]:
+        """Create or update a session
+
+        Only the given fields get changed; `ip` sets the address. New sessions must specify status, org_id, ip,
+        and pod. A status change must be allowed by TRANSITIONS for the current status in Redis, and with
+        if_version, the session must still be at that version; otherwise nothing changes, and this returns None.
+        """
+        if 'status' in fields:
+            fields['status'] = Status(fields['status'])
+        if 'ip' in fields:
+            fields['addr'] = pack_address(fields.pop('ip'))
+        key = session_key(session_id)
+        with PUBLISH_TIME.time():
+            async with self.redis.pipeline(transaction=True) as pipe:
+                while True:
+                    try:
+                        await pipe.watch(key)
+                        data = await pipe.get(key)
+                        current = Session.decode(data) if data else None
+                        status = current.status if current else None
+                        if if_version is not None and (current is None or current.version != if_version):
+                            logger.debug('session %s changed since version %i, not updating', session_id, if_version)
+                            await pipe.unwatch()
+                            return None
+                        if 'status' in fields and fields['status'] != status and \
+                                fields['status'] not in TRANSITIONS.get(status, ()):
+                            logger.debug('session %s: not changing status from %s to %s',
+                                         session_id, status, fields['status'].value)
+                            REJECTED.inc()
+                            await pipe.unwatch()
+                            return None
+
+                        now = int(time.time())
+                        if current is None:
+                            session = Session(id=session_id, version=1, created=now, updated=now, **fields)
+                        else:
+                            session = dataclasses.replace(current, version=current.version + 1, updated=now,
+                                                          **fields)
+                        data = session.encode()
+                        pipe.multi()
+                        pipe.set(key, data)
+                        if current is None:
+                            pipe.sadd(org_index_key(session.org_id), session_id)
+                            pipe.sadd(org_active_key(session.org_id), session_id)
+                        if session.status == Status.CLOSED and status != Status.CLOSED:
+                            pipe.srem(org_active_key(session.org_id), session_id)
+                        pipe.publish(CHANNEL, b'S' + data)
+                        await pipe.execute()
+                        break
+                    except redis.exceptions.WatchError:
+                        CONFLICTS.inc()
+
+        # the event may already have arrived
+        self._merge(session)
+        self.on_change(session_id)
+        return self.sessions.get(session_id)
+
+    async def delete(self, session_id: str, version: int) -> bool:
+        """Remove a session, if it is still at the given version
+
+        Returns False if the session changed or got removed in the meantime.
+        """
+        key = session_key(session_id)
+        with PUBLISH_TIME.time():
+            async with self.redis.pipeline(transaction=True) as pipe:
+                while True:
+                    try:
+                        await pipe.watch(key)
+                        data = await pipe.get(key)
+                        current = Session.decode(data) if data else None
+                        if current is None or current.version != version:
+                            await pipe.unwatch()
+                            return False
+                        pipe.multi()
+                        pipe.delete(key)
+                        pipe.srem(org_index_key(current.org_id), session_id)
+                        pipe.srem(org_active_key(current.org_id), session_id)
+                        pipe.publish(CHANNEL, b'D' + _DELETED.pack(version + 1) + session_id.encode())
+                        await pipe.execute()
+                        break
+                    except redis.exceptions.WatchError:
+                        CONFLICTS.inc()
+
+        if self._remove(session_id) is not None:
+            self.on_change(session_id)
+        return True
+
+    async def apply(self, data: bytes) -> Optional[str]:
+        """Apply an event from the sessions channel to the local cache
+
+        Returns the changed session ID, or None if the event was invalid or already known (e.g. our own
+        update).
+        """
+        try:
+            if data[:1] == b'D':
+                version, = _DELETED.unpack_from(data, 1)
+                session_id = data[1 + _DELETED.size:].decode()
+                local = self.sessions.get(session_id)
+                if local is None or local.version >= version:
+                    return None
+                self._remove(session_id)
+            elif data[:1] == b'S':
+                session = Session.decode(data[1:])
+                session_id = session.id
+                if not self._merge(session):
+                    return None
+            else:
+                raise ValueError('unknown event type')
+        except (ValueError, IndexError, struct.error) as e:
+            logger.warning('ignoring invalid session event %r: %s', data, e)
+            return None
+
+        self.on_change(session_id)
+        return session_id
+
+    async def subscribe(self) -> redis.asyncio.client.PubSub:
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(CHANNEL)
+        return pubsub
+
+    async def watch(self, pubsub: redis.asyncio.client.PubSub) -> None:
+        """Apply events from the sessions channel as they arrive
+
+        This blocks on the subscription socket, so it only wakes up for actual messages. After losing the
+        connection to Redis it reconnects with exponential backoff, and reloads all sessions to catch up
+        with the events it missed in the meantime.
+        """
+        while True:
+            try:
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        with APPLY_TIME.time():
+                            await self.apply(message['data'])
+                logger.warning('Redis subscription ended, reconnecting')
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+                logger.warning('Lost connection to Redis, reconnecting: %s', e)
+
+            await pubsub.reset()
+            retry = 0
+            while True:
+                try:
+                    pubsub = await self.subscribe()
+                    changed = await self.load()
+                    break
+                except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+                    delay = min(2 ** retry, 30)
+                    logger.warning('Failed to reconnect to Redis, retry %i in %is: %s', retry, delay, e)
+                    retry += 1
+                    await asyncio.sleep(delay)
+            logger.info('Reconnected to Redis, %i sessions changed in the meantime', len(changed))
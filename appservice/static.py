@@ -0,0 +1,114 @@
+"""Static files served by the multiplexer itself: the session placeholder pages and patternfly.css
+
+The files get loaded once at startup, together with precomputed gzip and (if the brotli module is available)
+brotli variants. Each variant has a strong ETag; responses pick the best variant from Accept-Encoding and
+answer matching If-None-Match requests with 304.
+
+Files which are referenced with their version (`?v=<version>`) get long-lived immutable cache headers; all
+others need to be revalidated by the browser on every use.
+"""
+
+import gzip
+import hashlib
+import os
+from typing import Dict, NamedTuple, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Cache-Control for versioned and unversioned responses
+CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
+CACHE_REVALIDATE = 'no-cache'
+
+CONTENT_TYPES = {
+    '.html': 'text/html',
+    '.css': 'text/css',
+}
+
+
+class Variant(NamedTuple):
+    body: bytes
+    etag: str
+
+
+def _accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    """Parse Accept-Encoding into {coding: q}"""
+    result = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        result[coding] = q
+    return result
+
+
+class StaticFile:
+    def __init__(self, name: str, content: bytes, content_type: Optional[str] = None):
+        self.name = name
+        self.content_type = content_type or CONTENT_TYPES.get(os.path.splitext(name)[1], 'application/octet-stream')
+        self.version = hashlib.sha256(content).hexdigest()[:16]
+
+        # content coding → variant, in order of preference; only keep variants which are actually smaller
+        self.variants: Dict[str, Variant] = {}
+        if brotli is not None:
+            compressed = brotli.compress(content, quality=11)
+            if len(compressed) < len(content):
+                self.variants['br'] = Variant(compressed, f'"{self.version}-br"')
+        compressed = gzip.compress(content, compresslevel=9, mtime=0)
+        if len(compressed) < len(content):
+            self.variants['gzip'] = Variant(compressed, f'"{self.version}-gz"')
+        self.variants['identity'] = Variant(content, f'"{self.version}"')
+
+    @classmethod
+    def load(cls, path: str) -> 'StaticFile':
+        with open(path, 'rb') as f:
+            content = f.read()
+        # accept pre-compressed files as well
+        if content[:2] == b'\x1f\x8b':
+            content = gzip.decompress(content)
+        return cls(os.path.basename(path), content)
+
+    def select(self, accept_encoding: str) -> str:
+        """Content coding of the best variant for an Accept-Encoding header"""
+        accepted = _accepted_encodings(accept_encoding)
+        wildcard = accepted.get('*', 0.0)
+        for coding in self.variants:
+            if coding != 'identity' and accepted.get(coding, wildcard) > 0:
+                return coding
+        return 'identity'
+
+    def response(self, request: Request) -> Response:
+        """Response for a GET/HEAD request
+
+        Requests with the current version in the `v` query parameter get long-lived cache headers.
+        """
+        coding = self.select(request.headers.get('accept-encoding', ''))
+        variant = self.variants[coding]
+        cache_control = CACHE_IMMUTABLE if request.query_params.get('v') == self.version else CACHE_REVALIDATE
+        headers = {'etag': variant.etag, 'cache-control': cache_control, 'vary': 'Accept-Encoding'}
+
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match and (
+                if_none_match.strip() == '*' or
+                variant.etag in (tag.strip() for tag in if_none_match.split(','))):
+            return Response(status_code=304, headers=headers)
+
+        if coding != 'identity':
+            headers['content-encoding'] = coding
+        # Response computes Content-Length from the body, so set it explicitly for HEAD
+        headers['content-length'] = str(len(variant.body))
+        return Response(b'' if request.method == 'HEAD' else variant.body, headers=headers,
+                        media_type=self.content_type)
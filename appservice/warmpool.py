@@ -0,0 +1,273 @@
+"""Pool of pre-provisioned, idle session pods
+
+Pool pods run cockpit-ws-session.sh without a SESSION_ID, which waits in session-bind.py until the multiplexer
+binds the pod to a session. With that, creating a session only needs one bind request, a short wait until the
+pod's bridge websocket port listens, and a Redis write, instead of creating a pod and waiting for it to come up.
+
+The pool size follows a configured minimum plus the observed demand: it tries to keep as many idle pods as
+get requested during the time it takes to provision one.
+
+Each pool claims its unbound pods in Redis, in a set which expires unless the pool keeps refreshing it. The
+reaper deletes pool pods which neither a session uses nor a live pool claims, so that the pods of a crashed
+replica or worker don't stay around.
+"""
+
+import asyncio
+import collections
+import logging
+import math
+import os
+import secrets
+import socket
+import time
+import uuid
+from typing import Deque, Dict, NamedTuple, Optional, Set
+
+import httpx
+import redis.asyncio
+import redis.exceptions
+
+import metrics
+from orchestrator import Orchestrator, probe
+
+logger = logging.getLogger(__name__)
+
+# minimum number of idle pods; 0 disables the pool
+WARM_POOL_SIZE = int(os.getenv('WARM_POOL_SIZE', '0'))
+# upper limit of idle + provisioning pods
+WARM_POOL_MAX = int(os.getenv('WARM_POOL_MAX', str(max(WARM_POOL_SIZE * 4, 10))))
+# how many pods to provision at the same time
+WARM_POOL_CONCURRENCY = int(os.getenv('WARM_POOL_CONCURRENCY', '4'))
+# time window for measuring the demand rate, in seconds
+DEMAND_WINDOW = 300
+# how long a bound pod may take to start its bridge websocket on :8080, in seconds
+WARM_POOL_BIND_TIMEOUT = float(os.getenv('WARM_POOL_BIND_TIMEOUT', '10'))
+# seconds between refreshing the pool's claim on its pods; claims of pools which stop doing that expire
+CLAIM_INTERVAL = float(os.getenv('WARM_POOL_CLAIM_INTERVAL', '30'))
+CLAIM_TTL = 3 * CLAIM_INTERVAL
+
+# warmpool:<owner>: set of the names of the pods which that pool provisions or holds
+CLAIM_KEY_PREFIX = 'warmpool:'
+
+IDLE = metrics.Gauge('webconsole_warm_pool_idle_pods', 'Idle warm pool pods ready for binding')
+ACQUIRED = metrics.Counter('webconsole_warm_pool_acquired_total',
+                           'Session creations, by whether they got a warm pool pod', ['result'])
+
+
+class PoolPod(NamedTuple):
+    name: str
+    ip: str
+    token: str
+
+
+async def claimed_pods(redis_client: redis.asyncio.Redis) -> Set[str]:
+    """Names of the pods which live pools claim"""
+    keys = [key async for key in redis_client.scan_iter(match=CLAIM_KEY_PREFIX + '*')]
+    return {name.decode() for name in await redis_client.sunion(keys)} if keys else set()
+
+
+class WarmPool:
+    def __init__(self, backend: Orchestrator, redis_client: redis.asyncio.Redis, size: int = WARM_POOL_SIZE,
+                 max_size: int = WARM_POOL_MAX, concurrency: int = WARM_POOL_CONCURRENCY,
+                 owner: Optional[str] = None):
+        self.backend = backend
+        self.redis = redis_client
+        self.claim_key = CLAIM_KEY_PREFIX + (owner or f'{socket.gethostname()}/{os.getpid()}')
+        self.size = size
+        self.max_size = max_size
+        self.concurrency = concurrency
+        self.idle: Deque[PoolPod] = collections.deque()
+        self.provisioning: Set[asyncio.Task] = set()
+        # discard() tasks of broken pods
+        self.discarding: Set[asyncio.Task] = set()
+        # names of the idle and provisioning pods
+        self.pods: Set[str] = set()
+        # name → time of acquire() of recently bound pods; they stay claimed until their session is surely in
+        # Redis
+        self.bound: Dict[str, float] = {}
+        # time stamps of recent acquire() calls
+        self.demand: Deque[float] = collections.deque()
+        # moving average of the provisioning time of a pod, in seconds
+        self.provision_time = 10.0
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.claim_task: Optional[asyncio.Task] = None
+        self.http: Optional[httpx.AsyncClient] = None
+
+    def start(self) -> None:
+        # create this in the event loop; with Python 3.9 it binds to the current loop on construction
+        self.wakeup = asyncio.Event()
+        self.http = httpx.AsyncClient(timeout=5)
+        self.task = asyncio.create_task(self.refill())
+        self.claim_task = asyncio.create_task(self.keep_claims())
+
+    async def stop(self) -> None:
+        """Stop refilling, and delete the idle and provisioning pods"""
+        for task in (self.task, self.claim_task):
+            if task is not None:
+                task.cancel()
+        self.task = self.claim_task = None
+        for task in self.provisioning:
+            task.cancel()
+        # provision() deletes the pods of cancelled tasks
+        await asyncio.gather(*self.provisioning, *self.discarding, return_exceptions=True)
+        await asyncio.gather(*(self.backend.delete_pod(pod.name) for pod in self.idle), return_exceptions=True)
+        self.idle.clear()
+        self.pods.clear()
+        IDLE.set(0)
+        try:
+            await self.redis.delete(self.claim_key)
+        except redis.exceptions.RedisError as e:
+            logger.warning('failed to drop warm pool claims: %s', e)
+        await self.http.aclose()
+
+    async def claim(self) -> None:
+        """Replace our claims in Redis with the current pods, and refresh their expiry"""
+        now = time.monotonic()
+        self.bound = {name: since for name, since in self.bound.items() if now - since < CLAIM_TTL}
+        names = self.pods | self.bound.keys()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self.claim_key)
+            if names:
+                pipe.sadd(self.claim_key, *names)
+                pipe.expire(self.claim_key, round(CLAIM_TTL))
+            await pipe.execute()
+
+    async def keep_claims(self) -> None:
+        while True:
+            try:
+                await self.claim()
+            except redis.exceptions.RedisError as e:
+                logger.warning('refreshing warm pool claims failed: %s', e)
+            await asyncio.sleep(CLAIM_INTERVAL)
+
+    async def discard(self, name: str) -> None:
+        """Delete a pod of ours; if that fails, the reaper deletes it once our claim is gone"""
+        self.pods.discard(name)
+        try:
+            status, content = await self.backend.delete_pod(name)
+        except httpx.HTTPError as e:
+            logger.warning('deleting pool pod %s failed: %s', name, e)
+            return
+        if status != 404 and not 200 <= status < 300:
+            logger.warning('deleting pool pod %s failed with %i: %s', name, status, content)
+
+    def target(self) -> int:
+        """Desired number of idle and provisioning pods"""
+        now = time.monotonic()
+        while self.demand and self.demand[0] < now - DEMAND_WINDOW:
+            self.demand.popleft()
+        rate = len(self.demand) / DEMAND_WINDOW
+        return min(self.max_size, max(self.size, math.ceil(rate * self.provision_time)))
+
+    async def refill(self) -> None:
+        while True:
+            missing = self.target() - len(self.idle) - len(self.provisioning)
+            for _ in range(min(missing, self.concurrency - len(self.provisioning))):
+                task = asyncio.create_task(self.provision())
+                self.provisioning.add(task)
+                task.add_done_callback(self._provisioned)
+
+            self.wakeup.clear()
+            # re-evaluate the demand from time to time, so that the target shrinks again
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=30)
+            except asyncio.TimeoutError:
+                pass
+
+    def _provisioned(self, task: asyncio.Task) -> None:
+        self.provisioning.discard(task)
+        self.wakeup.set()
+
+    async def provision(self) -> None:
+        name = f'session-pool-{uuid.uuid4()}'
+        token = secrets.token_urlsafe()
+        start = time.monotonic()
+
+        # claim the pod before it exists, so that the reaper never sees it unclaimed
+        self.pods.add(name)
+        try:
+            await self.claim()
+        except redis.exceptions.RedisError as e:
+            # the next refresh will do; the reaper leaves new pods alone for a while anyway
+            logger.warning('claiming pool pod %s failed: %s', name, e)
+
+        try:
+            status, content = await self.backend.create_pod(name, {'BIND_TOKEN': token}, pool=True)
+            if status < 200 or status >= 300:
+                logger.warning('creating pool pod %s failed with %i: %s', name, status, content)
+                self.pods.discard(name)
+                # don't hammer a failing API server
+                await asyncio.sleep(10)
+                return
+
+            # pool pods only listen on the cockpit-ws port for binding
+            ip = await self.backend.wait_ready(name, port=9090)
+        except httpx.HTTPError as e:
+            logger.warning('creating pool pod %s failed: %s', name, e)
+            await self.discard(name)
+            await asyncio.sleep(10)
+            return
+        except asyncio.CancelledError:
+            # stop(); the API call may have created the pod even if it got cancelled
+            await self.discard(name)
+            raise
+
+        if ip is None:
+            logger.warning('pool pod %s did not come up, deleting', name)
+            await self.discard(name)
+            return
+
+        self.provision_time = 0.8 * self.provision_time + 0.2 * (time.monotonic() - start)
+        logger.debug('pool pod %s is ready at %s', name, ip)
+        self.idle.append(PoolPod(name, ip, token))
+        IDLE.set(len(self.idle))
+
+    async def bind(self, pod: PoolPod, sessionid: str) -> bool:
+        try:
+            response = await self.http.post(f'http://{pod.ip}:9090/bind',
+                                            headers={'Authorization': f'Bearer {pod.token}'},
+                                            json={'session_id': sessionid})
+        except httpx.HTTPError as e:
+            logger.warning('binding pool pod %s failed: %s', pod.name, e)
+            return False
+
+        if response.status_code != 200:
+            logger.warning('binding pool pod %s failed with %i: %s', pod.name, response.status_code, response.text)
+            return False
+
+        return True
+
+    async def ready(self, pod: PoolPod) -> bool:
+        """Wait until a bound pod listens for the bridge websocket"""
+        try:
+            await asyncio.wait_for(probe(pod.ip, 8080), WARM_POOL_BIND_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning('bound pool pod %s did not start listening on port 8080', pod.name)
+            return False
+        return True
+
+    async def acquire(self, sessionid: str) -> Optional[PoolPod]:
+        """Bind an idle pod to sessionid, and wait until it is ready for the bridge connection
+
+        Returns None if there is no usable idle pod.
+        """
+        self.demand.append(time.monotonic())
+        self.wakeup.set()
+
+        while self.idle:
+            pod = self.idle.popleft()
+            IDLE.set(len(self.idle))
+            self.pods.discard(pod.name)
+            self.bound[pod.name] = time.monotonic()
+            if await self.bind(pod, sessionid) and await self.ready(pod):
+                logger.debug('bound pool pod %s to session %s', pod.name, sessionid)
+                ACQUIRED.labels('hit').inc()
+                return pod
+            # broken pod, throw it away
+            task = asyncio.create_task(self.discard(pod.name))
+            self.discarding.add(task)
+            task.add_done_callback(self.discarding.discard)
+
+        ACQUIRED.labels('miss').inc()
+        return None
@@ -0,0 +1,91 @@
+"""Run the multiplexer in several worker processes
+
+With MULTIPLEXER_WORKERS > 1, the main process forks that many workers and supervises them; each worker binds
+its own listening socket with SO_REUSEPORT, so that the kernel spreads incoming connections across them.
+Workers don't share any memory: each one initializes its own Redis connections, session subscription, and
+caches after the fork. Session state stays consistent across workers for the same reason as across replicas
+(see sessionstore): all updates go through Redis. Metrics get merged through a directory, see metrics.
+
+Workers which exit unexpectedly get restarted. SIGTERM/SIGINT to the main process stop all workers.
+"""
+
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import time
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+# number of worker processes; 0 means one per CPU
+WORKERS = int(os.getenv('MULTIPLEXER_WORKERS', '1')) or os.cpu_count() or 1
+# don't restart workers more often than that, in seconds
+RESTART_DELAY = 1.0
+
+
+def listen_socket(host: str, port: int, reuse_port: bool) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run(target: Callable[[int, int], None], worker: int, workers: int) -> None:
+    # the server installs its own handlers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    target(worker, workers)
+
+
+def supervise(target: Callable[[int, int], None], workers: int = WORKERS) -> None:
+    """Run target(worker, workers) in `workers` processes until SIGTERM/SIGINT
+
+    With a single worker, run target in this process.
+    """
+    if workers <= 1:
+        target(0, 1)
+        return
+
+    # fork, so that workers don't need to re-import the application; the main process must not have
+    # created any event loop or connection at this point
+    context = multiprocessing.get_context('fork')
+    processes: Dict[int, multiprocessing.Process] = {}
+    stopping = False
+
+    def start(worker: int) -> None:
+        process = context.Process(target=_run, args=(target, worker, workers), name=f'worker-{worker}')
+        process.start()
+        logger.info('started worker %i, pid %i', worker, process.pid)
+        processes[worker] = process
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for process in list(processes.values()):
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for worker in range(workers):
+        start(worker)
+
+    while processes:
+        multiprocessing.connection.wait([process.sentinel for process in processes.values()])
+        for worker, process in list(processes.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del processes[worker]
+            if not stopping:
+                logger.warning('worker %i exited with code %s, restarting', worker, process.exitcode)
+                time.sleep(RESTART_DELAY)
+            if not stopping:
+                start(worker)
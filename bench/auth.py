@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Benchmark x-rh-identity authentication
+
+Runs XRHIdentityAuthBackend.authenticate() with the same header over and over, like during a Cockpit page load,
+and compares it to uncached parsing of the header. Prints the results as JSON.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import sys
+import time
+
+from starlette.requests import HTTPConnection
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'appservice'))
+# only needed for importing, the benchmark does not talk to the API
+os.environ.setdefault('API_URL', 'http://localhost')
+import multiplexer  # noqa: E402
+
+
+def make_header(entitlements: int) -> str:
+    identity = {
+        'identity': {
+            'org_id': '1234',
+            'type': 'User',
+            'user': {'user_id': '5678', 'username': 'someone', 'email': 'someone@example.com'},
+            'internal': {'org_id': '1234'},
+        },
+        'entitlements': {f'service{i}': {'is_entitled': True, 'is_trial': False} for i in range(entitlements)},
+    }
+    return base64.b64encode(json.dumps(identity).encode()).decode()
+
+
+def connection(header: str) -> HTTPConnection:
+    return HTTPConnection({
+        'type': 'http',
+        'method': 'GET',
+        'path': '/',
+        'headers': [(b'x-rh-identity', header.encode())],
+    })
+
+
+async def measure(authenticate, header: str, count: int) -> dict:
+    # every request gets its own connection object, like in the real app
+    conns = [connection(header) for _ in range(count)]
+    start = time.perf_counter()
+    for conn in conns:
+        await authenticate(conn)
+    elapsed = time.perf_counter() - start
+    return {'requests_per_second': round(count / elapsed), 'us_per_request': round(elapsed / count * 1e6, 2)}
+
+
+async def run(args) -> dict:
+    header = make_header(args.entitlements)
+
+    async def uncached(conn):
+        return multiplexer.parse_identity(conn.headers['x-rh-identity'])
+
+    return {
+        'uncached': await measure(uncached, header, args.requests),
+        'cached': await measure(multiplexer.XRHIdentityAuthBackend().authenticate, header, args.requests),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark x-rh-identity authentication')
+    parser.add_argument('--requests', type=int, default=100000, help='Number of authenticated requests')
+    parser.add_argument('--entitlements', type=int, default=20, help='Number of entitlements in the header')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(run(args))
+    json.dump({'benchmark': 'auth', 'parameters': vars(args), 'results': results}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
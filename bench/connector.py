@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""Benchmark cockpit-bridge-websocket-connector
+
+Runs the connector in-process against a websocket server (standing in for the session pod) and a fake
+cockpit-bridge which either dumps a lot of output (like a file download), or echoes its input (like interactive
+use). Measures bulk throughput, the number of websocket frames that took, and echo latency, for the current
+connector and its previous fixed 4096 byte reads, with and without compression. Prints the results as JSON.
+"""
+
+import argparse
+import asyncio
+import importlib.machinery
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import websockets
+
+CONNECTOR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'server', 'cockpit-bridge-websocket-connector')
+PORT = 18082
+
+# the fake bridge: BENCH_BULK=n writes n bytes in BENCH_CHUNK sized writes and exits, otherwise echo stdin
+FAKE_BRIDGE = '''
+import os, sys
+bulk = int(os.environ.get('BENCH_BULK', '0'))
+if bulk:
+    # compressible, like most of the Cockpit protocol
+    chunk = (b'{"channel": "4:1", "payload": "line of journal output"}\\n' * 1000)[:int(os.environ['BENCH_CHUNK'])]
+    while bulk > 0:
+        os.write(1, chunk[:bulk])
+        bulk -= len(chunk)
+else:
+    while True:
+        data = os.read(0, 65536)
+        if not data:
+            break
+        os.write(1, data)
+'''
+
+
+def load_connector():
+    loader = importlib.machinery.SourceFileLoader('connector', CONNECTOR)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader('connector', loader))
+    loader.exec_module(module)
+    return module
+
+
+connector = load_connector()
+
+
+# bridge2ws() before adaptive reads, for comparison
+async def legacy_bridge2ws(bridge_output, ws):
+    while True:
+        message = await bridge_output.read(4096)
+        if not message:
+            break
+        connector.logger.debug('bridge -> ws: %s', message)
+        await ws.send(message)
+
+
+def connector_args(compression: str):
+    return argparse.Namespace(url=f'ws://127.0.0.1:{PORT}', basic_auth=None, extra_ca_cert=None, insecure=False,
+                              tls_cert=None, tls_key=None, compression=compression, reconnect=False,
+                              reconnect_timeout=0)
+
+
+async def measure_bulk(args, compression: str) -> dict:
+    done = asyncio.get_running_loop().create_future()
+
+    async def receive(ws, path=None):
+        received = frames = 0
+        async for message in ws:
+            received += len(message)
+            frames += 1
+        done.set_result((received, frames))
+
+    os.environ['BENCH_BULK'] = str(args.bulk_size)
+    try:
+        async with websockets.serve(receive, '127.0.0.1', PORT, max_size=None,
+                                    compression='deflate' if compression == 'deflate' else None):
+            start = time.perf_counter()
+            await connector.bridge(connector_args(compression))
+            received, frames = await done
+            elapsed = time.perf_counter() - start
+    finally:
+        del os.environ['BENCH_BULK']
+
+    assert received == args.bulk_size, received
+    return {'mbytes_per_second': round(received / elapsed / 1e6, 2), 'frames': frames}
+
+
+async def measure_latency(args, compression: str) -> dict:
+    latencies = []
+    payload = b'x' * args.size
+
+    async def ping(ws, path=None):
+        for _ in range(args.pings):
+            start = time.perf_counter()
+            await ws.send(payload)
+            received = b''
+            while len(received) < len(payload):
+                received += await ws.recv()
+            latencies.append(time.perf_counter() - start)
+
+    async with websockets.serve(ping, '127.0.0.1', PORT,
+                                compression='deflate' if compression == 'deflate' else None):
+        await connector.bridge(connector_args(compression))
+
+    latencies.sort()
+    return {
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+    }
+
+
+async def run(args) -> dict:
+    results = {}
+    current_bridge2ws = connector.bridge2ws
+    for name, bridge2ws in [('legacy', legacy_bridge2ws), ('adaptive', current_bridge2ws)]:
+        connector.bridge2ws = bridge2ws
+        for compression in ('none', 'deflate'):
+            results[f'{name}_{compression}'] = {
+                'bulk': await measure_bulk(args, compression),
+                'latency': await measure_latency(args, compression),
+            }
+    connector.bridge2ws = current_bridge2ws
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cockpit-bridge websocket connector')
+    parser.add_argument('--bulk-size', type=int, default=50 * 1024 * 1024, help='Bytes of bulk bridge output')
+    parser.add_argument('--chunk', type=int, default=16384, help='Size of the fake bridge\'s writes')
+    parser.add_argument('--pings', type=int, default=1000, help='Number of echo round trips')
+    parser.add_argument('--size', type=int, default=256, help='Echo message size in bytes')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fake_bridge = os.path.join(tmpdir, 'cockpit-bridge')
+        with open(fake_bridge, 'w') as f:
+            f.write(f'#!{sys.executable}\n{FAKE_BRIDGE}')
+        os.chmod(fake_bridge, 0o755)
+        connector.BRIDGE = fake_bridge
+        os.environ['BENCH_CHUNK'] = str(args.chunk)
+        results = asyncio.run(run(args))
+
+    json.dump({'benchmark': 'connector', 'parameters': vars(args), 'results': results}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
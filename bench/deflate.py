@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Benchmark permessage-deflate settings for the multiplexer's websockets (appservice/deflate.py)
+
+Compresses and decompresses a stream of Cockpit-protocol-like messages with the negotiated extension of
+websockets, for zlib's defaults (what uvicorn accepts without a policy) and the given window bits and memory
+level. Measures the zlib memory per connection (with tracemalloc), the compression ratio, and the CPU time
+per MB in each direction. Prints the results as JSON.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from websockets.frames import OP_TEXT, Frame
+
+
+def messages(count: int):
+    """JSON control and payload messages, roughly like a Cockpit page's channel traffic"""
+    rng = random.Random(0)
+    units = ['cockpit.service', 'sshd.service', 'NetworkManager.service', 'podman.socket', 'crond.service']
+    for i in range(count):
+        if i % 10 == 0:
+            message = {'command': 'open', 'channel': f'1:{i}', 'payload': 'dbus-json3',
+                       'name': 'org.freedesktop.systemd1'}
+        else:
+            message = {'channel': f'1:{i % 50}', 'payload': {
+                'MESSAGE': f'Started {rng.choice(units)} (pid {rng.randrange(1, 65536)})',
+                '__REALTIME_TIMESTAMP': str(1700000000000000 + i * rng.randrange(1000, 100000)),
+                'PRIORITY': str(rng.randrange(0, 7)),
+            }}
+        yield json.dumps(message).encode()
+
+
+def measure(window_bits: int, mem_level: int, payloads) -> dict:
+    frames = [Frame(OP_TEXT, payload) for payload in payloads]
+
+    # our side of one connection, which has a compressor and a decompressor; the browser's side only
+    # provides and consumes messages. zlib allocates all of its state for the first message.
+    peer = PerMessageDeflate(False, False, window_bits, window_bits)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    ours = PerMessageDeflate(False, False, window_bits, window_bits, {'memLevel': mem_level})
+    first = ours.encode(frames[0])
+    ours.decode(peer.encode(frames[0]))
+    memory = tracemalloc.get_traced_memory()[0] - before - sys.getsizeof(first.data)
+    tracemalloc.stop()
+    peer.decode(first)
+
+    start = time.process_time()
+    compressed = [ours.encode(frame) for frame in frames]
+    compress_time = time.process_time() - start
+    start = time.process_time()
+    for frame in compressed:
+        peer.decode(frame)
+    decompress_time = time.process_time() - start
+
+    size = sum(len(payload) for payload in payloads)
+    return {
+        'memory_kib_per_connection': round(memory / 1024, 1),
+        'ratio': round(size / sum(len(frame.data) for frame in compressed), 2),
+        'compress_ms_per_mb': round(compress_time / size * 1e9, 1),
+        'decompress_ms_per_mb': round(decompress_time / size * 1e9, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark permessage-deflate settings')
+    parser.add_argument('--messages', type=int, default=20000, help='Number of messages')
+    parser.add_argument('--window-bits', type=int, default=int(os.getenv('WS_DEFLATE_WINDOW_BITS', '12')),
+                        help='LZ77 window bits to compare with the defaults')
+    parser.add_argument('--mem-level', type=int, default=int(os.getenv('WS_DEFLATE_MEM_LEVEL', '5')),
+                        help='zlib memory level to compare with the default')
+    args = parser.parse_args()
+
+    payloads = list(messages(args.messages))
+    results = {
+        'zlib_defaults': measure(15, 8, payloads),
+        f'window_{args.window_bits}_mem_{args.mem_level}': measure(args.window_bits, args.mem_level, payloads),
+    }
+    json.dump({'benchmark': 'deflate', 'parameters': vars(args), 'results': results}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
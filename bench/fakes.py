@@ -0,0 +1,587 @@
+"""Local stand-ins for the services around the multiplexer, for benchmarks
+
+ - FakeRedis: in-memory Redis server which speaks enough RESP for redis-py and SessionStore (hashes, sets,
+   strings with expiry, SCAN, MULTI/EXEC/WATCH, pub/sub)
+ - FakePodman: libpod REST API on a Unix socket; "containers" are FakePods
+ - FakePod: a session pod on its own loopback address (127.1.x.y), with a websocket echo server on :8080
+   (the bridge side of cockpit-ws) and a static HTTP server on :9090 (cockpit-ws' web server)
+
+Everything runs in the calling asyncio event loop.
+"""
+
+import asyncio
+import fnmatch
+import hashlib
+import ipaddress
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+import uvicorn
+import websockets
+import websockets.exceptions
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+
+class StreamServer:
+    """asyncio stream server which also closes its open connections on stop()"""
+    def __init__(self, handler: Callable[[asyncio.StreamReader, asyncio.StreamWriter], Awaitable[None]]):
+        self.handler = handler
+        self.connections: Dict[asyncio.StreamWriter, asyncio.Task] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str, port: int) -> None:
+        self.server = await asyncio.start_server(self._handle, host, port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections[writer] = asyncio.current_task()
+        try:
+            await self.handler(reader, writer)
+        finally:
+            self.connections.pop(writer, None)
+
+    async def stop(self) -> None:
+        self.server.close()
+        for writer in list(self.connections):
+            writer.close()
+        await asyncio.gather(*self.connections.values(), return_exceptions=True)
+        await self.server.wait_closed()
+
+
+class RedisError(Exception):
+    pass
+
+
+class FakeRedis:
+    """In-memory Redis server
+
+    Start with `await FakeRedis().start(port)`.
+    """
+    def __init__(self):
+        self.data: Dict[bytes, Any] = {}
+        # key → expiry time (monotonic)
+        self.expiry: Dict[bytes, float] = {}
+        # key → modification counter, for WATCH
+        self.versions: Dict[bytes, int] = {}
+        self.subscribers: Dict[bytes, Set['_RedisConnection']] = {}
+        self.server = StreamServer(lambda reader, writer: _RedisConnection(self, reader, writer).run())
+
+    async def start(self, port: int, host: str = '127.0.0.1') -> None:
+        await self.server.start(host, port)
+
+    async def stop(self) -> None:
+        await self.server.stop()
+
+    def _touch(self, key: bytes) -> None:
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _get(self, key: bytes, kind: type, create: bool = False) -> Any:
+        self._exists(key)
+        value = self.data.get(key)
+        if value is None:
+            if not create:
+                return kind()
+            value = self.data[key] = kind()
+        if not isinstance(value, kind):
+            raise RedisError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def _exists(self, key: bytes) -> bool:
+        expires = self.expiry.get(key)
+        if expires is not None and expires < time.monotonic():
+            self._delete(key)
+        return key in self.data
+
+    def _delete(self, key: bytes) -> bool:
+        self.expiry.pop(key, None)
+        if self.data.pop(key, None) is None:
+            return False
+        self._touch(key)
+        return True
+
+    def _cleanup(self, key: bytes) -> None:
+        """Drop emptied containers, like Redis does"""
+        if key in self.data and not self.data[key]:
+            self._delete(key)
+
+    # commands; each gets the arguments as bytes and returns a RESP-encodable value
+
+    def cmd_ping(self, *args):
+        return args[0] if args else 'PONG'
+
+    def cmd_echo(self, message):
+        return message
+
+    def cmd_select(self, db):
+        return 'OK'
+
+    def cmd_client(self, *args):
+        return 'OK'
+
+    def cmd_flushall(self, *args):
+        for key in list(self.data):
+            self._delete(key)
+        return 'OK'
+
+    def cmd_get(self, key):
+        value = self._get(key, bytes)
+        return value or None
+
+    def cmd_set(self, key, value, *options):
+        options = [o.upper() for o in options]
+        exists = self._exists(key)
+        if (b'NX' in options and exists) or (b'XX' in options and not exists):
+            return None
+        self.data[key] = value
+        self.expiry.pop(key, None)
+        for unit, factor in ((b'EX', 1), (b'PX', 0.001)):
+            if unit in options:
+                self.expiry[key] = time.monotonic() + int(options[options.index(unit) + 1]) * factor
+        self._touch(key)
+        return 'OK'
+
+    def cmd_mget(self, *keys):
+        return [self.cmd_get(key) for key in keys]
+
+    def cmd_incrby(self, key, amount):
+        value = int(self._get(key, bytes) or 0) + int(amount)
+        self.data[key] = str(value).encode()
+        self._touch(key)
+        return value
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, b'1')
+
+    def cmd_del(self, *keys):
+        return sum(self._delete(key) for key in keys)
+
+    def cmd_exists(self, *keys):
+        return sum(bool(self._exists(key)) for key in keys)
+
+    def cmd_expire(self, key, seconds, *options):
+        if not self._exists(key):
+            return 0
+        self.expiry[key] = time.monotonic() + int(seconds)
+        return 1
+
+    def cmd_pexpire(self, key, milliseconds, *options):
+        return self.cmd_expire(key, int(milliseconds) / 1000)
+
+    def cmd_ttl(self, key):
+        if not self._exists(key):
+            return -2
+        expires = self.expiry.get(key)
+        return -1 if expires is None else round(expires - time.monotonic())
+
+    def cmd_hset(self, key, *pairs):
+        h = self._get(key, dict, create=True)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in h
+            h[field] = value
+        self._touch(key)
+        return added
+
+    def cmd_hget(self, key, field):
+        return self._get(key, dict).get(field)
+
+    def cmd_hgetall(self, key):
+        return _Map(self._get(key, dict))
+
+    def cmd_hdel(self, key, *fields):
+        h = self._get(key, dict)
+        removed = sum(h.pop(field, None) is not None for field in fields)
+        self._touch(key)
+        self._cleanup(key)
+        return removed
+
+    def cmd_hincrby(self, key, field, amount):
+        h = self._get(key, dict, create=True)
+        value = int(h.get(field, 0)) + int(amount)
+        h[field] = str(value).encode()
+        self._touch(key)
+        return value
+
+    def cmd_sadd(self, key, *members):
+        s = self._get(key, set, create=True)
+        added = len(set(members) - s)
+        s.update(members)
+        self._touch(key)
+        return added
+
+    def cmd_srem(self, key, *members):
+        s = self._get(key, set)
+        removed = len(s & set(members))
+        s.difference_update(members)
+        self._touch(key)
+        self._cleanup(key)
+        return removed
+
+    def cmd_smembers(self, key):
+        return list(self._get(key, set))
+
+    def cmd_scard(self, key):
+        return len(self._get(key, set))
+
+    def cmd_sismember(self, key, member):
+        return int(member in self._get(key, set))
+
+    def cmd_sunion(self, *keys):
+        return list(set().union(*(self._get(key, set) for key in keys)))
+
+    def cmd_zadd(self, key, *pairs):
+        z = self._get(key, _SortedSet, create=True)
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in z
+            z[member] = float(score)
+        self._touch(key)
+        return added
+
+    def cmd_zrem(self, key, *members):
+        z = self._get(key, _SortedSet)
+        removed = sum(z.pop(member, None) is not None for member in members)
+        self._touch(key)
+        self._cleanup(key)
+        return removed
+
+    def cmd_zcard(self, key):
+        return len(self._get(key, _SortedSet))
+
+    def cmd_zremrangebyscore(self, key, low, high):
+        # only inclusive bounds
+        z = self._get(key, _SortedSet)
+        low, high = float(low), float(high)
+        members = [member for member, score in z.items() if low <= score <= high]
+        for member in members:
+            del z[member]
+        self._touch(key)
+        self._cleanup(key)
+        return len(members)
+
+    def cmd_keys(self, pattern):
+        return [key for key in list(self.data) if fnmatch.fnmatchcase(key, pattern) and self._exists(key)]
+
+    def cmd_scan(self, cursor, *options):
+        options = list(options)
+        upper = [o.upper() for o in options]
+        pattern = options[upper.index(b'MATCH') + 1] if b'MATCH' in upper else b'*'
+        count = int(options[upper.index(b'COUNT') + 1]) if b'COUNT' in upper else 10
+        # the key order is stable as long as there are no deletions, which is good enough here
+        keys = sorted(self.data)
+        start = int(cursor)
+        batch = keys[start:start + count]
+        next_cursor = start + count if start + count < len(keys) else 0
+        return [str(next_cursor).encode(),
+                [key for key in batch if fnmatch.fnmatchcase(key, pattern) and self._exists(key)]]
+
+    def cmd_publish(self, channel, message):
+        subscribers = self.subscribers.get(channel, ())
+        for connection in subscribers:
+            connection.write(_Push([b'message', channel, message]))
+        return len(subscribers)
+
+
+class _RedisConnection:
+    def __init__(self, server: FakeRedis, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.channels: Set[bytes] = set()
+        self.queue: Optional[List[List[bytes]]] = None
+        self.watched: Dict[bytes, int] = {}
+        self.protocol = 2
+
+    def write(self, value: Any) -> None:
+        self.writer.write(_encode(value, self.protocol))
+
+    def hello(self, protover: bytes = b'2', *options) -> Any:
+        if protover not in (b'2', b'3'):
+            return RedisError('NOPROTO unsupported protocol version')
+        self.protocol = int(protover)
+        return _Map({b'server': b'redis', b'version': b'7.2.0', b'proto': self.protocol, b'id': id(self),
+                     b'mode': b'standalone', b'role': b'master', b'modules': []})
+
+    async def read_command(self) -> Optional[List[bytes]]:
+        line = await self.reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            # inline command
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int((await self.reader.readline())[1:])
+            args.append((await self.reader.readexactly(length + 2))[:-2])
+        return args
+
+    def execute(self, args: List[bytes]) -> Any:
+        name = args[0].decode().lower()
+        handler = getattr(self.server, f'cmd_{name}', None)
+        if handler is None:
+            return RedisError(f"ERR unknown command '{name}'")
+        try:
+            return handler(*args[1:])
+        except RedisError as e:
+            return e
+        except (TypeError, ValueError, IndexError) as e:
+            return RedisError(f'ERR {name}: {e}')
+
+    def subscription_command(self, name: str, channels: List[bytes]) -> None:
+        subscribe = name == 'subscribe'
+        if not subscribe and not channels:
+            channels = list(self.channels)
+        for channel in channels:
+            if subscribe:
+                self.channels.add(channel)
+                self.server.subscribers.setdefault(channel, set()).add(self)
+            else:
+                self.channels.discard(channel)
+                self.server.subscribers.get(channel, set()).discard(self)
+            self.write(_Push([name.encode(), channel, len(self.channels)]))
+
+    async def run(self) -> None:
+        try:
+            while True:
+                args = await self.read_command()
+                if args is None:
+                    break
+                if not args:
+                    continue
+                name = args[0].decode().lower()
+
+                if name == 'hello':
+                    self.write(self.hello(*args[1:]))
+                elif name in ('subscribe', 'unsubscribe'):
+                    self.subscription_command(name, args[1:])
+                elif name == 'multi':
+                    self.queue = []
+                    self.write('OK')
+                elif name == 'discard':
+                    self.queue = None
+                    self.watched = {}
+                    self.write('OK')
+                elif name == 'watch':
+                    self.watched.update({key: self.server.versions.get(key, 0) for key in args[1:]})
+                    self.write('OK')
+                elif name == 'unwatch':
+                    self.watched = {}
+                    self.write('OK')
+                elif name == 'exec':
+                    queue, self.queue = self.queue or [], None
+                    if any(self.server.versions.get(key, 0) != version for key, version in self.watched.items()):
+                        self.write(None)
+                    else:
+                        self.write([self.execute(command) for command in queue])
+                    self.watched = {}
+                elif self.queue is not None:
+                    self.queue.append(args)
+                    self.write(_Status('QUEUED'))
+                else:
+                    self.write(self.execute(args))
+
+                await self.writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in self.channels:
+                self.server.subscribers.get(channel, set()).discard(self)
+            self.writer.close()
+
+
+class _Status(str):
+    pass
+
+
+class _Map(dict):
+    """Map reply; a flat array in RESP2"""
+
+
+class _Push(list):
+    """Out-of-band reply (pub/sub); an array in RESP2"""
+
+
+class _SortedSet(dict):
+    """member → score"""
+
+
+def _encode(value: Any, protocol: int = 2) -> bytes:
+    if value is None:
+        return b'_\r\n' if protocol == 3 else b'$-1\r\n'
+    if isinstance(value, RedisError):
+        return b'-' + str(value).encode() + b'\r\n'
+    if isinstance(value, str):
+        return b'+' + value.encode() + b'\r\n'
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b':%i\r\n' % value
+    if isinstance(value, bytes):
+        return b'$%i\r\n%s\r\n' % (len(value), value)
+    if isinstance(value, dict):
+        if protocol == 3:
+            return b'%%%i\r\n' % len(value) + b''.join(
+                _encode(k, protocol) + _encode(v, protocol) for k, v in value.items())
+        return _encode([item for pair in value.items() for item in pair], protocol)
+    if isinstance(value, (list, tuple)):
+        prefix = b'>' if protocol == 3 and isinstance(value, _Push) else b'*'
+        return prefix + b'%i\r\n' % len(value) + b''.join(_encode(item, protocol) for item in value)
+    raise TypeError(f'cannot encode {value!r}')
+
+
+class FakePod:
+    """Session pod: websocket echo on addr:8080, static files on addr:9090
+
+    The HTTP server returns `asset_size` bytes for every path, with an ETag and the given Cache-Control.
+    """
+    def __init__(self, addr: str, asset_size: int = 16384, cache_control: str = 'max-age=86400'):
+        self.addr = addr
+        self.asset_size = asset_size
+        self.cache_control = cache_control
+        self.ws_server = None
+        self.http_server = StreamServer(self.serve_http)
+
+    async def start(self) -> None:
+        self.ws_server = await websockets.serve(self.echo, self.addr, 8080, compression=None, max_size=None)
+        await self.http_server.start(self.addr, 9090)
+
+    async def stop(self) -> None:
+        self.ws_server.close()
+        await self.ws_server.wait_closed()
+        await self.http_server.stop()
+
+    @staticmethod
+    async def echo(ws, path=None) -> None:
+        try:
+            async for message in ws:
+                await ws.send(message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def serve_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Minimal HTTP/1.1 server with keep-alive; ignores request bodies"""
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                method, path, _ = head.split(b'\r\n', 1)[0].split(b' ', 2)
+                etag = b'"%s"' % hashlib.md5(path).hexdigest().encode()
+                body = (path * (self.asset_size // len(path) + 1))[:self.asset_size]
+                writer.write(b'HTTP/1.1 200 OK\r\n'
+                             b'Content-Type: application/javascript\r\n'
+                             b'Content-Length: %i\r\n'
+                             b'ETag: %s\r\n'
+                             b'Cache-Control: %s\r\n'
+                             b'\r\n' % (len(body), etag, self.cache_control.encode()))
+                if method != b'HEAD':
+                    writer.write(body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+class FakePodman:
+    """libpod REST API (the parts which PodmanOrchestrator uses) on a Unix socket
+
+    Started containers become FakePods on consecutive 127.1.x.y addresses. `start_delay` simulates the
+    container start time, in seconds.
+    """
+    def __init__(self, socket_path: str, start_delay: float = 0.0, **pod_args):
+        self.socket_path = socket_path
+        self.start_delay = start_delay
+        self.pod_args = pod_args
+        # name → {'status': ..., 'addr': ..., 'env': ..., 'labels': ..., 'created': ...}
+        self.containers: Dict[str, Dict[str, Any]] = {}
+        self.pods: Dict[str, FakePod] = {}
+        self.addresses = (str(addr) for addr in ipaddress.ip_network('127.1.0.0/16').hosts())
+        self.changed = asyncio.Condition()
+        prefix = '/v1.12/libpod'
+        self.app = Starlette(routes=[
+            Route(f'{prefix}/containers/create', self.create, methods=['POST']),
+            Route(f'{prefix}/containers/json', self.list),
+            Route(f'{prefix}/containers/{{name}}/start', self.start_container, methods=['POST']),
+            Route(f'{prefix}/containers/{{name}}/json', self.inspect),
+            Route(f'{prefix}/containers/{{name}}', self.delete, methods=['DELETE']),
+            Route(f'{prefix}/events', self.events),
+        ])
+        self.server: Optional[uvicorn.Server] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        config = uvicorn.Config(self.app, uds=self.socket_path, log_level='warning', lifespan='off')
+        self.server = uvicorn.Server(config)
+        self.task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+
+    async def stop(self) -> None:
+        self.server.should_exit = True
+        await self.task
+        await asyncio.gather(*(pod.stop() for pod in self.pods.values()))
+
+    async def _notify(self) -> None:
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def create(self, request: Request) -> Response:
+        body = await request.json()
+        name = body['name']
+        if name in self.containers:
+            return JSONResponse({'cause': 'that name is already in use'}, status_code=409)
+        self.containers[name] = {'status': 'created', 'addr': None, 'env': body.get('env', {}),
+                                 'labels': body.get('labels', {}), 'created': int(time.time())}
+        return JSONResponse({'Id': name, 'Warnings': []}, status_code=201)
+
+    async def start_container(self, request: Request) -> Response:
+        name = request.path_params['name']
+        container = self.containers.get(name)
+        if container is None:
+            return JSONResponse({'cause': 'no such container'}, status_code=404)
+        if self.start_delay:
+            await asyncio.sleep(self.start_delay)
+        pod = FakePod(next(self.addresses), **self.pod_args)
+        await pod.start()
+        self.pods[name] = pod
+        container.update(status='running', addr=pod.addr)
+        await self._notify()
+        return Response(status_code=204)
+
+    async def list(self, request: Request) -> Response:
+        # only supports filtering by label name
+        labels = json.loads(request.query_params.get('filters', '{}')).get('label', [])
+        return JSONResponse([{'Names': [name], 'Labels': container['labels'], 'Created': container['created']}
+                             for name, container in self.containers.items()
+                             if all(label in container['labels'] for label in labels)])
+
+    async def inspect(self, request: Request) -> Response:
+        container = self.containers.get(request.path_params['name'])
+        if container is None:
+            return JSONResponse({'cause': 'no such container'}, status_code=404)
+        return JSONResponse({
+            'State': {'Status': container['status']},
+            'Config': {'Labels': container['labels']},
+            'NetworkSettings': {'IPAddress': '', 'Networks': {'consoledot': {'IPAddress': container['addr'] or ''}}},
+        })
+
+    async def delete(self, request: Request) -> Response:
+        name = request.path_params['name']
+        if self.containers.pop(name, None) is None:
+            return JSONResponse({'cause': 'no such container'}, status_code=404)
+        pod = self.pods.pop(name, None)
+        if pod is not None:
+            await pod.stop()
+        await self._notify()
+        return JSONResponse([{'Id': name}])
+
+    async def events(self, request: Request) -> Response:
+        async def stream():
+            while True:
+                async with self.changed:
+                    await self.changed.wait()
+                yield json.dumps({'Type': 'container', 'Action': 'update', 'time': int(time.time())}) + '\n'
+
+        return StreamingResponse(stream(), media_type='application/json')
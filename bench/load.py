@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""Load test the multiplexer against local stand-ins for podman, Redis, and session pods
+
+Runs multiplexer.app under uvicorn (in a separate process, or with --in-process in the same event loop as the
+load generator; or several replicas with --replicas, each with --workers processes), with FakePodman, FakeRedis
+and FakePods from fakes.py, and drives these scenarios:
+
+ - create: burst of concurrent /sessions/new requests
+ - batch: the same number of sessions with one streaming /sessions/batch request
+ - bridge: concurrent bridge websockets streaming data through to the session pods' echo server
+ - pageload: Cockpit page loads, i.e. a fan-out of concurrent asset requests per running session
+ - wait: many wait-running requests which all get resolved by their sessions' bridges connecting
+
+Prints throughput and p50/p99 latencies per scenario as JSON.
+"""
+
+import argparse
+import asyncio
+import base64
+import functools
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import statistics
+import struct
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+import uvicorn
+import websockets
+import websockets.exceptions
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'appservice'))
+import config  # noqa: E402
+from fakes import FakePodman, FakeRedis  # noqa: E402
+
+SCENARIOS = ('create', 'batch', 'bridge', 'pageload', 'wait')
+IDENTITY = base64.b64encode(json.dumps({
+    'identity': {'org_id': '1234', 'type': 'User', 'user': {'user_id': '5678'}},
+}).encode()).decode()
+HEADERS = {'x-rh-identity': IDENTITY}
+
+
+def latency_stats(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'count': 0}
+    return {
+        'count': len(latencies),
+        'per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p99_ms': round(latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000, 3),
+    }
+
+
+def multiplexer_env(args, replica: int) -> Dict[str, str]:
+    return {
+        'API_URL': f'http://127.0.0.1:{args.port}',
+        'REDIS_SERVICE_HOST': '127.0.0.1',
+        'REDIS_SERVICE_PORT': str(args.redis_port),
+        'PODMAN_SOCKET': args.podman_socket,
+        'SESSION_AFFINITY': '1',
+        'REPLICA_ID': f'replica{replica}',
+        'REPLICA_ADDRESS': f'127.0.0.1:{args.port + replica}',
+        # so that /metrics soon shows the other workers' values
+        'METRICS_SHARE_INTERVAL': '0.2',
+    }
+
+
+def multiplexer_server(args, replica: int = 0) -> uvicorn.Server:
+    # the multiplexer reads its configuration from the environment on import
+    os.environ.update(multiplexer_env(args, replica))
+    import deflate
+    import multiplexer
+
+    multiplexer.init()
+    server_config = uvicorn.Config(multiplexer.app, host='127.0.0.1', port=args.port + replica, log_level='warning',
+                                   ws=deflate.WebSocketProtocol)
+    return uvicorn.Server(server_config)
+
+
+def run_multiplexer(args, replica: int) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    if args.workers == 1:
+        asyncio.run(multiplexer_server(args, replica).serve())
+        return
+
+    os.environ.update(multiplexer_env(args, replica))
+    import deflate
+    import metrics
+    import multiplexer
+    import workers
+
+    def run_worker(worker: int, worker_count: int, metrics_dir: str) -> None:
+        multiplexer.init(worker, worker_count)
+        metrics.share(metrics_dir, worker)
+        server = uvicorn.Server(uvicorn.Config(multiplexer.app, log_level='warning', ws=deflate.WebSocketProtocol))
+        server.run(sockets=[workers.listen_socket('127.0.0.1', args.port + replica, reuse_port=True)])
+
+    with tempfile.TemporaryDirectory(prefix='multiplexer-metrics-') as metrics_dir:
+        workers.supervise(functools.partial(run_worker, metrics_dir=metrics_dir), args.workers)
+
+
+class Client:
+    """Load generator; spreads requests round-robin over all replicas
+
+    Consecutive requests for the same session usually go to different replicas.
+    """
+    def __init__(self, args):
+        self.replicas = [f'127.0.0.1:{args.port + replica}' for replica in range(args.replicas)]
+        self._next_replica = itertools.cycle(self.replicas)
+        self.http = httpx.AsyncClient(headers=HEADERS, timeout=60,
+                                      limits=httpx.Limits(max_connections=None, max_keepalive_connections=1000))
+
+    @property
+    def api(self) -> str:
+        return f'http://{next(self._next_replica)}{config.ROUTE_API}'
+
+    @property
+    def wss(self) -> str:
+        return f'ws://{next(self._next_replica)}{config.ROUTE_WSS}'
+
+    @property
+    def web(self) -> str:
+        return f'http://{next(self._next_replica)}{config.ROUTE_WSS}'
+
+    async def wait_up(self) -> None:
+        for replica in self.replicas:
+            for _ in range(100):
+                try:
+                    if (await self.http.get(f'http://{replica}{config.ROUTE_API}/ping')).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError(f'multiplexer {replica} did not come up')
+
+    async def new_session(self) -> str:
+        response = await self.http.post(f'{self.api}/sessions/new')
+        response.raise_for_status()
+        return response.json()['id']
+
+    async def new_sessions(self, count: int, concurrency: int) -> List[str]:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                return await self.new_session()
+
+        return await asyncio.gather(*(one() for _ in range(count)))
+
+    def connect_bridge(self, sessionid: str):
+        return websockets.connect(f'{self.wss}/sessions/{sessionid}/ws', extra_headers=HEADERS,
+                                  compression=None, max_size=None)
+
+    async def wait_running(self, sessionid: str) -> str:
+        response = await self.http.get(f'{self.api}/sessions/{sessionid}/wait-running')
+        response.raise_for_status()
+        return response.text
+
+    async def metric(self, name: str) -> float:
+        """Sum of a metric over all replicas, and all label values (e.g. a gauge's workers)"""
+        total = 0.0
+        for replica in self.replicas:
+            for line in (await self.http.get(f'http://{replica}{config.ROUTE_API}/metrics')).text.splitlines():
+                if line.startswith((name + ' ', name + '{')):
+                    total += float(line.split()[-1])
+        return total
+
+
+async def scenario_create(client: Client, args) -> dict:
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await client.new_session()
+            except httpx.HTTPError:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(args.sessions)))
+    return dict(latency_stats(latencies, time.perf_counter() - start), errors=errors)
+
+
+async def scenario_batch(client: Client, args) -> dict:
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    async with client.http.stream('POST', f'{client.api}/sessions/batch', json={'count': args.sessions}) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if 'error' in json.loads(line):
+                errors += 1
+            else:
+                # time until this session's result arrived
+                latencies.append(time.perf_counter() - start)
+    return dict(latency_stats(latencies, time.perf_counter() - start), errors=errors)
+
+
+async def scenario_bridge(client: Client, args) -> dict:
+    sessions = await client.new_sessions(args.bridges, args.concurrency)
+    # every message starts with its send time, to measure the round trip through multiplexer and echo server
+    padding = os.urandom(max(args.message_size - 8, 0))
+    latencies = []
+    nbytes = 0
+
+    async def stream(sessionid: str):
+        async with client.connect_bridge(sessionid) as ws:
+            async def receive():
+                nonlocal nbytes
+                pending = b''
+                expected = args.messages * (len(padding) + 8)
+                received = 0
+                while received < expected:
+                    data = await ws.recv()
+                    received += len(data)
+                    pending += data
+                    now = time.perf_counter()
+                    # the bridge websocket may coalesce frames, so split them up again
+                    while len(pending) >= len(padding) + 8:
+                        latencies.append(now - struct.unpack('d', pending[:8])[0])
+                        pending = pending[len(padding) + 8:]
+                nbytes += received
+
+            receiver = asyncio.create_task(receive())
+            for _ in range(args.messages):
+                await ws.send(struct.pack('d', time.perf_counter()) + padding)
+            await receiver
+
+    start = time.perf_counter()
+    await asyncio.gather(*(stream(sessionid) for sessionid in sessions))
+    elapsed = time.perf_counter() - start
+    return dict(latency_stats(latencies, elapsed), mbytes_per_second=round(nbytes / elapsed / 1e6, 2))
+
+
+async def scenario_pageload(client: Client, args) -> dict:
+    sessions = await client.new_sessions(args.pageload_sessions, args.concurrency)
+    latencies = []
+    page_latencies = []
+    errors = 0
+
+    async def load_page(sessionid: str):
+        async def get(path: str):
+            nonlocal errors
+            start = time.perf_counter()
+            response = await client.http.get(f'{client.web}/sessions/{sessionid}/web/{path}')
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+        start = time.perf_counter()
+        await get('shell/index.html')
+        # content-addressed package files, which the multiplexer can cache
+        await asyncio.gather(*(get(f'cockpit/$0123abcd/base1/asset{i}.js') for i in range(args.assets)))
+        page_latencies.append(time.perf_counter() - start)
+
+    async def session(sessionid: str):
+        # a connected bridge makes the session running
+        async with client.connect_bridge(sessionid):
+            await client.wait_running(sessionid)
+            for _ in range(args.page_loads):
+                await load_page(sessionid)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(session(sessionid) for sessionid in sessions))
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': dict(latency_stats(latencies, elapsed), errors=errors),
+        'pages': latency_stats(page_latencies, elapsed),
+    }
+
+
+async def scenario_wait(client: Client, args) -> dict:
+    sessions = await client.new_sessions(args.wait_sessions, args.concurrency)
+    # session → time when its bridge started connecting
+    connecting: Dict[str, float] = {}
+    latencies: List[float] = []
+
+    async def wait(sessionid: str):
+        await client.wait_running(sessionid)
+        latencies.append(time.perf_counter() - connecting[sessionid])
+
+    waiters = [asyncio.create_task(wait(sessionid)) for sessionid in sessions for _ in range(args.waiters)]
+    # wait until all requests arrived
+    while await client.metric('webconsole_status_waiters') < len(waiters):
+        await asyncio.sleep(0.05)
+
+    async def connect(sessionid: str):
+        connecting[sessionid] = time.perf_counter()
+        return await client.connect_bridge(sessionid)
+
+    start = time.perf_counter()
+    bridges = await asyncio.gather(*(connect(sessionid) for sessionid in sessions))
+    await asyncio.gather(*waiters)
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*(ws.close() for ws in bridges))
+    return latency_stats(latencies, elapsed)
+
+
+async def run(args) -> dict:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.podman_socket = os.path.join(tmpdir, 'podman.sock')
+        redis = FakeRedis()
+        await redis.start(args.redis_port)
+        podman = FakePodman(args.podman_socket, start_delay=args.pod_start_delay,
+                            cache_control='no-cache' if args.uncacheable else 'max-age=86400')
+        await podman.start()
+
+        if args.in_process:
+            server = multiplexer_server(args)
+            server_task = asyncio.create_task(server.serve())
+        else:
+            context = multiprocessing.get_context('spawn')
+            # daemonic processes can't fork workers
+            servers = [context.Process(target=run_multiplexer, args=(args, replica), daemon=args.workers == 1)
+                       for replica in range(args.replicas)]
+            for server in servers:
+                server.start()
+
+        client = Client(args)
+        try:
+            await client.wait_up()
+            results = {}
+            for name in args.scenarios:
+                results[name] = await globals()[f'scenario_{name}'](client, args)
+            return results
+        finally:
+            await client.http.aclose()
+            if args.in_process:
+                server.should_exit = True
+                await server_task
+            else:
+                for server in servers:
+                    server.terminate()
+                # keep the fakes running while the replicas shut down
+                for server in servers:
+                    await asyncio.get_running_loop().run_in_executor(None, server.join, 10)
+            await podman.stop()
+            await redis.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the multiplexer with fake podman, Redis, and pods')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'Comma separated list of scenarios to run (default: {",".join(SCENARIOS)})')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Run the multiplexer in the same process and event loop as the load generator')
+    parser.add_argument('--replicas', type=int, default=1, help='Number of multiplexer processes')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes per replica')
+    parser.add_argument('--port', type=int, default=18090, help='Port of the first multiplexer replica')
+    parser.add_argument('--redis-port', type=int, default=16379, help='Fake Redis port')
+    parser.add_argument('--concurrency', type=int, default=20, help='Concurrent /sessions/new requests')
+    parser.add_argument('--pod-start-delay', type=float, default=0, help='Simulated container start time (s)')
+    parser.add_argument('--sessions', type=int, default=200, help='create, batch: number of sessions')
+    parser.add_argument('--bridges', type=int, default=20, help='bridge: number of concurrent bridge websockets')
+    parser.add_argument('--messages', type=int, default=2000, help='bridge: messages per websocket')
+    parser.add_argument('--message-size', type=int, default=1024, help='bridge: message size in bytes')
+    parser.add_argument('--pageload-sessions', type=int, default=20, help='pageload: number of sessions')
+    parser.add_argument('--page-loads', type=int, default=5, help='pageload: page loads per session')
+    parser.add_argument('--assets', type=int, default=30, help='pageload: asset requests per page load')
+    parser.add_argument('--uncacheable', action='store_true',
+                        help='pageload: let the session pods mark assets as no-cache')
+    parser.add_argument('--wait-sessions', type=int, default=100, help='wait: number of sessions')
+    parser.add_argument('--waiters', type=int, default=5, help='wait: wait-running requests per session')
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name}')
+    if args.in_process and (args.replicas != 1 or args.workers != 1):
+        parser.error('--in-process only supports one replica and worker')
+
+    # every websocket and HTTP connection needs file descriptors on both ends
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(run(args))
+    parameters = {name: value for name, value in vars(args).items() if name != 'podman_socket'}
+    json.dump({'benchmark': 'load', 'parameters': parameters, 'results': results}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
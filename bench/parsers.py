@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Benchmark the multiplexer's HTTP request throughput with the h11 and httptools protocol implementations
+
+Runs multiplexer.app (without startup, so without Redis or an orchestrator) under uvicorn in a separate process,
+once per HTTP implementation, and sends /ping requests over keep-alive connections. The requests carry an
+x-rh-identity header and 3scale's broken "Connection: Upgrade" header, so that authentication and the header
+fix are part of the measurement. Prints requests per second and p50/p99 latencies as JSON.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+import uvicorn
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'appservice'))
+# only needed for importing, the benchmark does not talk to the API
+os.environ.setdefault('API_URL', 'http://localhost')
+import config  # noqa: E402
+from auth import make_header  # noqa: E402
+
+PARSERS = ('h11', 'httptools')
+
+
+def run_server(http: str, port: int) -> None:
+    import multiplexer
+
+    logging.basicConfig(level=logging.WARNING)
+    uvicorn.run(multiplexer.app, host='127.0.0.1', port=port, http=http, lifespan='off', log_level='warning',
+                access_log=False)
+
+
+async def wait_up(port: int) -> None:
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError('server did not come up')
+
+
+async def client(port: int, request: bytes, deadline: float, latencies: list) -> None:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        writer.write(request)
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = 0
+        for line in head.split(b'\r\n'):
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':')[1])
+        await reader.readexactly(length)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def measure(http: str, args) -> dict:
+    context = multiprocessing.get_context('spawn')
+    server = context.Process(target=run_server, args=(http, args.port), daemon=True)
+    server.start()
+    try:
+        await wait_up(args.port)
+        request = (f'GET {config.ROUTE_API}/ping HTTP/1.1\r\n'
+                   'Host: localhost\r\n'
+                   f'x-rh-identity: {make_header(20)}\r\n'
+                   'Connection: Upgrade\r\n'
+                   '\r\n').encode()
+        latencies = []
+        start = time.perf_counter()
+        await asyncio.gather(*(client(args.port, request, start + args.duration, latencies)
+                               for _ in range(args.connections)))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.join()
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+    }
+
+
+async def run(args) -> dict:
+    return {http: await measure(http, args) for http in args.parsers}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark HTTP request throughput with h11 and httptools')
+    parser.add_argument('--parsers', default=','.join(PARSERS),
+                        help=f'Comma separated list of HTTP implementations (default: {",".join(PARSERS)})')
+    parser.add_argument('--connections', type=int, default=20, help='Number of concurrent keep-alive connections')
+    parser.add_argument('--duration', type=float, default=5, help='Duration per HTTP implementation, in seconds')
+    parser.add_argument('--port', type=int, default=18099, help='Port of the multiplexer')
+    args = parser.parse_args()
+    args.parsers = [name.strip() for name in args.parsers.split(',') if name.strip()]
+    for name in args.parsers:
+        if name not in PARSERS:
+            parser.error(f'unknown HTTP implementation {name}')
+
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(run(args))
+    json.dump({'benchmark': 'parsers', 'parameters': vars(args), 'results': results}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Benchmark the multiplexer websocket relay
+
+Runs a websocket echo server (standing in for a session pod) and an ASGI app with the current relay
+(relay.WebSocketRelay) and the previous one-message-at-a-time relay, then measures streaming throughput and
+ping-pong latency through each of them. Prints the results as JSON.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+import uvicorn
+import websockets
+import websockets.exceptions
+from starlette.applications import Starlette
+from starlette.concurrency import run_until_first_complete
+from starlette.routing import WebSocketRoute
+from starlette.websockets import WebSocket
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'appservice'))
+from relay import WebSocketRelay  # noqa: E402
+
+ECHO_PORT = 18080
+RELAY_PORT = 18081
+
+
+# relay implementation before the WebSocketRelay rewrite, for comparison
+async def legacy_up2down(recv_ws: WebSocket, send_ws):
+    while True:
+        msg = await recv_ws.receive()
+        if msg['type'] == 'websocket.receive':
+            data = msg.get('text') or msg.get('bytes')
+            await send_ws.send(data)
+        elif msg['type'] == 'websocket.disconnect':
+            break
+
+
+async def legacy_down2up(recv_ws, send_ws: WebSocket):
+    while True:
+        try:
+            data = await recv_ws.recv()
+        except websockets.exceptions.ConnectionClosed:
+            break
+
+        if isinstance(data, str):
+            await send_ws.send_text(data)
+        else:
+            await send_ws.send_bytes(data)
+
+
+async def handle_legacy(websocket: WebSocket):
+    await websocket.accept()
+    downstream = await websockets.connect(f'ws://127.0.0.1:{ECHO_PORT}', compression=None)
+    await run_until_first_complete(
+        (legacy_up2down, {'recv_ws': websocket, 'send_ws': downstream}),
+        (legacy_down2up, {'recv_ws': downstream, 'send_ws': websocket}),
+    )
+    await downstream.close()
+
+
+async def handle_relay(websocket: WebSocket):
+    await websocket.accept()
+    downstream = await websockets.connect(f'ws://127.0.0.1:{ECHO_PORT}', compression=None)
+    try:
+        await WebSocketRelay(websocket, downstream, coalesce=websocket.path_params['mode'] == 'coalesce').run()
+    finally:
+        await downstream.close()
+
+
+async def echo(ws, path=None):
+    async for message in ws:
+        await ws.send(message)
+
+
+def run_servers():
+    app = Starlette(routes=[
+        WebSocketRoute('/legacy', handle_legacy),
+        WebSocketRoute('/relay/{mode}', handle_relay),
+    ])
+
+    async def main():
+        async with websockets.serve(echo, '127.0.0.1', ECHO_PORT, compression=None):
+            config = uvicorn.Config(app, host='127.0.0.1', port=RELAY_PORT, log_level='warning',
+                                    ws_per_message_deflate=False)
+            await uvicorn.Server(config).serve()
+
+    asyncio.run(main())
+
+
+async def measure_throughput(url: str, count: int, size: int) -> dict:
+    payload = os.urandom(size)
+    async with websockets.connect(url, compression=None, max_size=None) as ws:
+        async def receive():
+            received = 0
+            while received < count * size:
+                received += len(await ws.recv())
+
+        start = time.perf_counter()
+        receiver = asyncio.create_task(receive())
+        for _ in range(count):
+            await ws.send(payload)
+        await receiver
+        elapsed = time.perf_counter() - start
+
+    return {'messages_per_second': round(count / elapsed), 'mbytes_per_second': round(count * size / elapsed / 1e6, 2)}
+
+
+async def measure_latency(url: str, count: int, size: int) -> dict:
+    payload = os.urandom(size)
+    latencies = []
+    async with websockets.connect(url, compression=None) as ws:
+        for _ in range(count):
+            start = time.perf_counter()
+            await ws.send(payload)
+            await ws.recv()
+            latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    return {
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+    }
+
+
+async def run(args) -> dict:
+    results = {}
+    for name, path in [('legacy', '/legacy'), ('relay', '/relay/plain'), ('relay_coalesce', '/relay/coalesce')]:
+        url = f'ws://127.0.0.1:{RELAY_PORT}{path}'
+        results[name] = {
+            'throughput': await measure_throughput(url, args.messages, args.size),
+            'latency': await measure_latency(url, args.pings, args.size),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the websocket relay')
+    parser.add_argument('--messages', type=int, default=20000, help='Number of streamed messages')
+    parser.add_argument('--pings', type=int, default=2000, help='Number of ping-pong round trips')
+    parser.add_argument('--size', type=int, default=256, help='Message size in bytes')
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(target=run_servers, daemon=True)
+    server.start()
+    try:
+        time.sleep(1)
+        results = asyncio.run(run(args))
+    finally:
+        server.terminate()
+
+    json.dump({'benchmark': 'relay', 'parameters': vars(args), 'results': results}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""Benchmark the session pod's stdio pump (appservice/scripts/websocket-session.py)
+
+Runs websocket-session.py in a subprocess with its stdin/stdout connected to this process, which plays
+cockpit-ws, and a websocket client which plays the bridge connection. Measures throughput in both
+directions, the round trip latency (websocket → stdout → stdin → websocket), and how long stdin → websocket
+traffic waits while cockpit-ws does not read stdout for a while. Does that for the current pump and the
+previous one with blocking writes and fixed 4096 byte reads. Prints the results as JSON.
+
+websocket-session.py listens on port 8080, which must be free.
+"""
+
+import argparse
+import asyncio
+import importlib.machinery
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import time
+
+import websockets
+import websockets.exceptions
+
+SESSION_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'appservice', 'scripts', 'websocket-session.py')
+URL = 'ws://127.0.0.1:8080'
+
+
+# pump before the PipeWriter rewrite, for comparison
+async def legacy_ws2out(ws):
+    try:
+        async for message in ws:
+            os.write(1, message)
+    except websockets.exceptions.ConnectionClosed:
+        return
+
+
+async def legacy_in2ws(reader, ws):
+    while True:
+        message = await reader.read(4096)
+        if not message:
+            await ws.close()
+            break
+        await ws.send(message)
+
+
+def serve(mode: str) -> None:
+    loader = importlib.machinery.SourceFileLoader('websocket_session', SESSION_SCRIPT)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader('websocket_session', loader))
+    loader.exec_module(module)
+    if mode == 'legacy':
+        module.ws2out = legacy_ws2out
+        module.in2ws = legacy_in2ws
+    asyncio.run(module.main())
+
+
+async def connect():
+    for _ in range(100):
+        try:
+            return await websockets.connect(URL, compression=None, max_size=None)
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError('websocket-session.py did not come up')
+
+
+async def receive(ws, size: int) -> int:
+    """Receive size bytes; returns the number of messages"""
+    received = messages = 0
+    while received < size:
+        received += len(await ws.recv())
+        messages += 1
+    return messages
+
+
+async def measure(mode: str, args) -> dict:
+    proc = await asyncio.create_subprocess_exec(sys.executable, __file__, '--serve', mode,
+                                                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                                                limit=1024 * 1024)
+    ws = await connect()
+    results = {}
+    payload = os.urandom(args.size)
+    total = args.messages * args.size
+
+    # websocket → stdout
+    async def read_stdout():
+        received = 0
+        while received < total:
+            received += len(await proc.stdout.read(1024 * 1024))
+
+    start = time.perf_counter()
+    reader = asyncio.create_task(read_stdout())
+    for _ in range(args.messages):
+        await ws.send(payload)
+    await reader
+    elapsed = time.perf_counter() - start
+    results['ws_to_stdout'] = {'mbytes_per_second': round(total / elapsed / 1e6, 2)}
+
+    # stdin → websocket
+    start = time.perf_counter()
+    receiver = asyncio.create_task(receive(ws, total))
+    for _ in range(args.messages):
+        proc.stdin.write(payload)
+        await proc.stdin.drain()
+    messages = await receiver
+    elapsed = time.perf_counter() - start
+    results['stdin_to_ws'] = {'mbytes_per_second': round(total / elapsed / 1e6, 2), 'messages': messages}
+
+    # round trips
+    latencies = []
+    ping = os.urandom(args.ping_size)
+    for _ in range(args.pings):
+        start = time.perf_counter()
+        await ws.send(ping)
+        proc.stdin.write(await proc.stdout.readexactly(len(ping)))
+        await receive(ws, len(ping))
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    results['round_trip'] = {
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+    }
+
+    # fill stdout while cockpit-ws does not read it, and see how long stdin → websocket takes meanwhile
+    backlog = 4 * 1024 * 1024 // args.size
+
+    async def send_backlog():
+        for _ in range(backlog):
+            await ws.send(payload)
+
+    sender = asyncio.create_task(send_backlog())
+    await asyncio.sleep(0.2)
+    start = time.perf_counter()
+    received_at = []
+    receiver = asyncio.create_task(receive(ws, len(ping)))
+    receiver.add_done_callback(lambda _: received_at.append(time.perf_counter()))
+    proc.stdin.write(ping)
+    await proc.stdin.drain()
+    await asyncio.wait([receiver], timeout=args.stall)
+    await proc.stdout.readexactly(backlog * args.size)
+    await asyncio.gather(sender, receiver)
+    results['stdin_to_ws_while_stdout_full'] = {'latency_ms': round((received_at[0] - start) * 1000, 3)}
+
+    await ws.close()
+    proc.stdin.close()
+    await proc.wait()
+    return results
+
+
+async def run(args) -> dict:
+    return {mode: await measure(mode, args) for mode in ('legacy', 'current')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the websocket-session.py stdio pump')
+    parser.add_argument('--messages', type=int, default=20000, help='Number of messages per direction')
+    parser.add_argument('--size', type=int, default=1024, help='Message size in bytes')
+    parser.add_argument('--pings', type=int, default=2000, help='Number of round trips')
+    parser.add_argument('--ping-size', type=int, default=64, help='Round trip message size in bytes')
+    parser.add_argument('--stall', type=float, default=1.0,
+                        help='Seconds to not read stdout while measuring stdin → websocket latency')
+    parser.add_argument('--serve', choices=['legacy', 'current'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    results = asyncio.run(run(args))
+    parameters = {name: value for name, value in vars(args).items() if name != 'serve'}
+    json.dump({'benchmark': 'session', 'parameters': parameters, 'results': results}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'appservice'))
+
+from assetcache import AssetCache  # noqa: E402
+
+HEADERS = [('ETag', '"1"'), ('Content-Length', '4')]
+
+
+class AssetCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        # room for two 4 byte assets in memory
+        self.cache = AssetCache(memory_size=8, disk_dir=self.dir.name, disk_size=8)
+
+    async def spilled(self):
+        await asyncio.gather(*self.cache.spill_tasks)
+
+    async def testSpillAndReload(self):
+        for name in ('a', 'b', 'c'):
+            self.cache.store(('v', name, ''), HEADERS, name.encode() * 4)
+        # 'a' got evicted, and is still served while its file gets written
+        self.assertIn(('v', 'a', ''), self.cache.spilling)
+        await self.spilled()
+        self.assertEqual(self.cache.spilling, {})
+        self.assertEqual(len(os.listdir(self.dir.name)), 1)
+
+        asset = await self.cache.lookup(('v', 'a', ''))
+        self.assertEqual(asset.body, b'aaaa')
+        self.assertEqual(asset.etag, '"1"')
+        # moved back to memory, which evicted 'b' to disk
+        await self.spilled()
+        self.assertNotIn(('v', 'a', ''), self.cache.disk)
+        self.assertIn(('v', 'b', ''), self.cache.disk)
+        self.assertEqual(len(os.listdir(self.dir.name)), 1)
+
+    async def testLookupWhileSpilling(self):
+        for name in ('a', 'b', 'c'):
+            self.cache.store(('v', name, ''), HEADERS, name.encode() * 4)
+        asset = await self.cache.lookup(('v', 'a', ''))
+        self.assertEqual(asset.body, b'aaaa')
+        await self.spilled()
+        # back in memory, so the finished write does not add a disk entry for it
+        self.assertNotIn(('v', 'a', ''), self.cache.disk)
+        self.assertEqual((await self.cache.lookup(('v', 'a', ''))).body, b'aaaa')
+
+    async def testMiss(self):
+        self.assertIsNone(await self.cache.lookup(('v', 'a', '')))
+
+
+if __name__ == '__main__':
+    unittest.main()
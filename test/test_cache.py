@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import unittest
+import unittest.mock
+
+from appservice.cache import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def testCountBounded(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        # access makes 'a' the most recently used entry
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def testSizeBounded(self):
+        evicted = []
+        cache = LRUCache(10, sizeof=len, on_evict=lambda k, v: evicted.append(k))
+        cache.put('a', b'12345')
+        cache.put('b', b'1234')
+        self.assertEqual(cache.size, 9)
+        cache.put('c', b'12')
+        self.assertEqual(evicted, ['a'])
+        self.assertEqual(cache.size, 6)
+
+        # replacing an entry updates the size
+        cache.put('b', b'1')
+        self.assertEqual(cache.size, 3)
+
+        # too big values don't get stored, and don't evict anything
+        cache.put('d', b'12345678901')
+        self.assertNotIn('d', cache)
+        self.assertEqual(evicted, ['a'])
+
+    def testPop(self):
+        cache = LRUCache(10, sizeof=len)
+        cache.put('a', b'123')
+        self.assertEqual(cache.pop('a'), b'123')
+        self.assertIsNone(cache.pop('a'))
+        self.assertEqual(cache.size, 0)
+
+    def testTTL(self):
+        cache = LRUCache(10, ttl=5)
+        with unittest.mock.patch('time.monotonic', return_value=100):
+            cache.put('a', 1)
+        with unittest.mock.patch('time.monotonic', return_value=104):
+            self.assertEqual(cache.get('a'), 1)
+        with unittest.mock.patch('time.monotonic', return_value=106):
+            self.assertIsNone(cache.get('a'))
+        self.assertNotIn('a', cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import unittest
+import unittest.mock
+
+import fakeredis
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'appservice'))
+
+from limiter import FULL_RETRY_AFTER, OrgLimiter, org_pending_key  # noqa: E402
+from sessionstore import org_active_key  # noqa: E402
+
+# 15 seconds into a rate window
+NOW = 1000 * 60 + 15
+
+
+class OrgLimiterTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeAsyncRedis(server=self.server)
+        self.now = NOW
+        patcher = unittest.mock.patch('limiter.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.redis.aclose()
+
+    async def pending(self, org_id=1):
+        return await self.redis.zcard(org_pending_key(org_id))
+
+    async def testDisabled(self):
+        self.server.connected = False
+        admission = await OrgLimiter(self.redis, max_sessions=0, rate=0).admit(1, 5)
+        self.assertIsNone(admission.retry_after)
+        self.assertEqual(admission.slots, [])
+
+    async def testRate(self):
+        limiter = OrgLimiter(self.redis, rate=3, window=60)
+        for _ in range(3):
+            self.assertIsNone((await limiter.admit(1)).retry_after)
+        # until the end of the window
+        self.assertEqual((await limiter.admit(1)).retry_after, 45)
+        # other orgs have their own limit
+        self.assertIsNone((await limiter.admit(2)).retry_after)
+        # a batch counts with its size
+        self.assertEqual((await limiter.admit(2, 3)).retry_after, 45)
+
+        self.now += 40
+        self.assertEqual((await limiter.admit(1)).retry_after, 5)
+        # the next window
+        self.now += 10
+        self.assertIsNone((await limiter.admit(1)).retry_after)
+        self.assertEqual(await self.pending(), 0)
+
+    async def testMaxSessions(self):
+        limiter = OrgLimiter(self.redis, max_sessions=3)
+        await self.redis.sadd(org_active_key(1), 'a1', 'a2')
+
+        first = await limiter.admit(1)
+        self.assertIsNone(first.retry_after)
+        self.assertEqual(len(first.slots), 1)
+        self.assertEqual(await self.pending(), 1)
+
+        # two active, one being created
+        rejected = await limiter.admit(1)
+        self.assertEqual(rejected.retry_after, FULL_RETRY_AFTER)
+        self.assertEqual(rejected.slots, [])
+        self.assertEqual(await self.pending(), 1)
+        self.assertEqual((await limiter.admit(1, 2)).retry_after, FULL_RETRY_AFTER)
+
+        # the session got created, and is active now
+        await self.redis.sadd(org_active_key(1), 'a3')
+        await limiter.release(first)
+        self.assertEqual(first.slots, [])
+        self.assertEqual(await self.pending(), 0)
+        self.assertEqual((await limiter.admit(1)).retry_after, FULL_RETRY_AFTER)
+
+        # all sessions got closed
+        await self.redis.srem(org_active_key(1), 'a1', 'a2', 'a3')
+        batch = await limiter.admit(1, 3)
+        self.assertIsNone(batch.retry_after)
+        self.assertEqual(await self.pending(), 3)
+        await limiter.release(batch)
+        self.assertEqual((len(batch.slots), await self.pending()), (2, 2))
+        await limiter.release(batch, 2)
+        self.assertEqual((batch.slots, await self.pending()), ([], 0))
+        # releasing more than reserved is harmless
+        await limiter.release(batch)
+
+    async def testReservationExpiry(self):
+        limiter = OrgLimiter(self.redis, max_sessions=1, reservation_ttl=600)
+        self.assertIsNone((await limiter.admit(1)).retry_after)
+        self.now += 300
+        self.assertEqual((await limiter.admit(1)).retry_after, FULL_RETRY_AFTER)
+        # the replica which reserved the slot died
+        self.now += 301
+        self.assertIsNone((await limiter.admit(1)).retry_after)
+        self.assertEqual(await self.pending(), 1)
+
+    async def testRedisFailure(self):
+        limiter = OrgLimiter(self.redis, max_sessions=1, rate=1)
+        self.server.connected = False
+        for _ in range(3):
+            admission = await limiter.admit(1)
+            self.assertIsNone(admission.retry_after)
+            self.assertEqual(admission.slots, [])
+        self.server.connected = True
+        self.assertIsNone((await limiter.admit(1)).retry_after)
+
+        # failing to release leaves the slot to expire
+        admission = await limiter.admit(2)
+        self.server.connected = False
+        await limiter.release(admission)
+        self.assertEqual(admission.slots, [])
+        self.server.connected = True
+        self.assertEqual(await self.pending(2), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
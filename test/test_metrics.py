@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'appservice'))
+
+import metrics  # noqa: E402
+
+
+class SharedMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = list(metrics.REGISTRY)
+        metrics.REGISTRY.clear()
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+        self.requests = metrics.Counter('test_requests_total', 'Requests', ['status'])
+        self.idle = metrics.Gauge('test_idle', 'Idle things')
+        self.latency = metrics.Histogram('test_latency_seconds', 'Latency', buckets=(0.1, 1))
+
+    def tearDown(self):
+        metrics.REGISTRY[:] = self.registry
+        metrics._share = None
+
+    def testSingleWorker(self):
+        self.requests.labels(200).inc(3)
+        self.idle.set(2)
+        self.latency.observe(0.5)
+        self.assertEqual(metrics.render(), '\n'.join([
+            '# HELP test_requests_total Requests',
+            '# TYPE test_requests_total counter',
+            'test_requests_total{status="200"} 3',
+            '# HELP test_idle Idle things',
+            '# TYPE test_idle gauge',
+            'test_idle 2',
+            '# HELP test_latency_seconds Latency',
+            '# TYPE test_latency_seconds histogram',
+            'test_latency_seconds_bucket{le="0.1"} 0',
+            'test_latency_seconds_bucket{le="1"} 1',
+            'test_latency_seconds_bucket{le="+Inf"} 1',
+            'test_latency_seconds_sum 0.5',
+            'test_latency_seconds_count 1',
+        ]) + '\n')
+
+    def testMergeWorkers(self):
+        # what worker 1 published
+        self.requests.labels(200).inc(3)
+        self.requests.labels(404).inc()
+        self.idle.set(2)
+        self.latency.observe(0.05)
+        metrics.share(self.dir.name, 1)
+        asyncio.run(self.publish_once())
+        self.assertEqual(os.listdir(self.dir.name), ['1.json'])
+
+        # now be worker 0
+        metrics.REGISTRY.clear()
+        self.requests = metrics.Counter('test_requests_total', 'Requests', ['status'])
+        self.idle = metrics.Gauge('test_idle', 'Idle things')
+        self.latency = metrics.Histogram('test_latency_seconds', 'Latency', buckets=(0.1, 1))
+        self.requests.labels(200).inc()
+        self.idle.set(5)
+        self.latency.observe(0.5)
+        metrics.share(self.dir.name, 0)
+
+        others = metrics.read_shared()
+        self.assertEqual(list(others), ['1'])
+        lines = metrics.render(others).splitlines()
+        self.assertIn('test_requests_total{status="200"} 4', lines)
+        self.assertIn('test_requests_total{status="404"} 1', lines)
+        self.assertIn('test_idle{worker="0"} 5', lines)
+        self.assertIn('test_idle{worker="1"} 2', lines)
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_latency_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('test_latency_seconds_sum 0.55', lines)
+        self.assertIn('test_latency_seconds_count 2', lines)
+
+    async def publish_once(self):
+        task = asyncio.create_task(metrics.publish())
+        while not os.listdir(self.dir.name) or any(name != '1.json' for name in os.listdir(self.dir.name)):
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import unittest
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.testclient import TestClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'appservice'))
+# the orchestrator reads this on import
+os.environ.setdefault('API_URL', 'http://localhost:8080')
+
+import multiplexer  # noqa: E402
+from multiplexer import ConnectionHeaderFixMiddleware  # noqa: E402
+
+
+async def echo_headers(request):
+    return JSONResponse([[name.decode(), value.decode()] for name, value in request.scope['headers']])
+
+
+async def echo_ws_headers(websocket):
+    await websocket.accept()
+    await websocket.send_json([[name.decode(), value.decode()] for name, value in websocket.scope['headers']])
+    await websocket.close()
+
+
+class ConnectionHeaderFixMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        app = Starlette(routes=[Route('/', echo_headers), WebSocketRoute('/ws', echo_ws_headers)])
+        self.client = TestClient(ConnectionHeaderFixMiddleware(app))
+
+    def headers(self, headers):
+        return [(name, value) for name, value in self.client.get('/', headers=headers).json()
+                if name in ('connection', 'upgrade')]
+
+    def testBrokenUpgrade(self):
+        # 3scale's header without an Upgrade: header gets dropped
+        self.assertEqual(self.headers({'Connection': 'Upgrade'}), [])
+        self.assertEqual(self.headers({'Connection': 'keep-alive, Upgrade'}), [('connection', 'keep-alive')])
+        self.assertEqual(self.headers({'Connection': 'UPGRADE,close'}), [('connection', 'close')])
+
+    def testRealUpgrade(self):
+        self.assertEqual(self.headers({'Connection': 'Upgrade', 'Upgrade': 'h2c'}),
+                         [('connection', 'Upgrade'), ('upgrade', 'h2c')])
+
+    def testPlainRequest(self):
+        self.assertEqual(self.headers({'Connection': 'keep-alive'}), [('connection', 'keep-alive')])
+        self.assertEqual(self.headers({'Connection': 'close'}), [('connection', 'close')])
+
+    def testWebSocket(self):
+        # TestClient sends "Connection: upgrade" without an Upgrade: header; websocket scopes stay as they are
+        with self.client.websocket_connect('/ws') as websocket:
+            headers = dict(websocket.receive_json())
+        self.assertNotIn('upgrade', headers)
+        self.assertEqual(headers['connection'], 'upgrade')
+
+    def testInstalled(self):
+        # outermost, so that no other middleware or route sees the broken header
+        self.assertIs(multiplexer.app.user_middleware[0].cls, ConnectionHeaderFixMiddleware)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import unittest
+import unittest.mock
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'appservice'))
+
+from proxy import SessionProxy  # noqa: E402
+
+
+class SessionProxyTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.received = []
+
+        def handler(request):
+            self.received.append(request.headers.get('Cookie'))
+            return httpx.Response(200, headers={'Set-Cookie': 'cockpit=secret; Path=/'}, text='ok')
+
+        # every per-pod pool is a mock transport
+        patcher = unittest.mock.patch('proxy.httpx.AsyncHTTPTransport',
+                                      lambda limits: httpx.MockTransport(handler))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.proxy = SessionProxy()
+        self.proxy.start()
+
+    async def asyncTearDown(self):
+        await self.proxy.stop()
+
+    async def get(self, headers=None):
+        response = await self.proxy.send(self.proxy.client.build_request('GET', 'http://10.0.0.1:9090/cockpit/',
+                                                                         headers=headers))
+        await response.aclose()
+        return response
+
+    async def testNoCookieReplay(self):
+        response = await self.get()
+        self.assertEqual(response.headers['Set-Cookie'], 'cockpit=secret; Path=/')
+        # the next request to the same pod does not get the cookie which the previous response set
+        await self.get()
+        self.assertEqual(self.received, [None, None])
+        self.assertEqual(len(self.proxy.client.cookies.jar), 0)
+
+    async def testForwardBrowserCookie(self):
+        await self.get()
+        await self.get({'Cookie': 'cockpit=mine'})
+        await self.get()
+        self.assertEqual(self.received, [None, 'cockpit=mine', None])
+
+
+if __name__ == '__main__':
+    unittest.main()
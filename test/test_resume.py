@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import asyncio
+import importlib.machinery
+import importlib.util
+import os
+import unittest
+
+import websockets.exceptions
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_script(name, path):
+    loader = importlib.machinery.SourceFileLoader(name, os.path.join(TOP_DIR, path))
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(name, loader))
+    loader.exec_module(module)
+    return module
+
+
+# both ends of a resumable bridge connection have their own copy of ResumableStream
+connector = load_script('connector', 'server/cockpit-bridge-websocket-connector')
+websocket_session = load_script('websocket_session', 'appservice/scripts/websocket-session.py')
+
+
+class FakeWebSocket:
+    """One end of an in-memory websocket connection, see connect()"""
+
+    def __init__(self):
+        self.messages = asyncio.Queue()
+        self.peer = None
+        self.closed = False
+
+    async def send(self, message):
+        if self.closed:
+            raise websockets.exceptions.ConnectionClosedOK(None, None)
+        self.peer.messages.put_nowait(message)
+
+    async def recv(self):
+        message = await self.messages.get()
+        if message is None:
+            raise websockets.exceptions.ConnectionClosedOK(None, None)
+        return message
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except websockets.exceptions.ConnectionClosedOK:
+            raise StopAsyncIteration
+
+    def drop(self):
+        for end in (self, self.peer):
+            end.closed = True
+            end.messages.put_nowait(None)
+
+
+def connect():
+    a, b = FakeWebSocket(), FakeWebSocket()
+    a.peer, b.peer = b, a
+    return a, b
+
+
+async def until(condition):
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('timed out')
+
+
+class ResumableStreamTests:
+    module = None
+
+    def testAck(self):
+        stream = self.module.ResumableStream()
+        stream.chunks.extend([b'abc', b'defg', b'hi'])
+        stream.size = 9
+
+        # partial chunk
+        stream.ack(2)
+        self.assertEqual(list(stream.chunks), [b'c', b'defg', b'hi'])
+        self.assertEqual((stream.acked, stream.size), (2, 7))
+        # whole chunks and part of the next one
+        stream.ack(8)
+        self.assertEqual(list(stream.chunks), [b'i'])
+        self.assertEqual((stream.acked, stream.size), (8, 1))
+        # acking the same offset again does nothing
+        stream.ack(8)
+        self.assertEqual((stream.acked, stream.size), (8, 1))
+
+        # offsets outside of the buffered data
+        self.assertRaises(ValueError, stream.ack, 7)
+        self.assertRaises(ValueError, stream.ack, 10)
+        stream.ack(9)
+        self.assertEqual(list(stream.chunks), [])
+        self.assertEqual(stream.size, 0)
+
+    def testBuffered(self):
+        stream = self.module.ResumableStream()
+        stream.chunks.extend([b'abc', b'defg', b'hi'])
+        stream.size = 9
+        stream.ack(1)
+
+        self.assertEqual(stream.buffered(1, 100), b'bcdefghi')
+        self.assertEqual(stream.buffered(1, 3), b'bcd')
+        self.assertEqual(stream.buffered(3, 4), b'defg')
+        self.assertEqual(stream.buffered(4, 2), b'ef')
+        self.assertEqual(stream.buffered(8, 100), b'i')
+        self.assertEqual(stream.buffered(9, 100), b'')
+
+    def testLimit(self):
+        async def run():
+            stream = self.module.ResumableStream(limit=4)
+            await stream.send(b'abcd')
+            blocked = asyncio.create_task(stream.send(b'e'))
+            await asyncio.sleep(0.01)
+            self.assertFalse(blocked.done())
+            stream.ack(2)
+            await asyncio.wait_for(blocked, 1)
+            self.assertEqual(list(stream.chunks), [b'cd', b'e'])
+
+        asyncio.run(run())
+
+    def testReplay(self):
+        async def run():
+            sender = self.module.ResumableStream()
+            receiver = connector.ResumableStream()
+            received = []
+
+            async def deliver(data):
+                received.append(data)
+
+            async def nothing(data):
+                self.fail('unexpected data %r' % data)
+
+            # queued while not connected
+            await sender.send(b'hello')
+
+            ws_sender, ws_receiver = connect()
+            tasks = [asyncio.create_task(sender.run(ws_sender, nothing)),
+                     asyncio.create_task(receiver.run(ws_receiver, deliver))]
+            await until(lambda: b''.join(received) == b'hello')
+            # sent right away once the connection caught up
+            await until(lambda: sender.ws is ws_sender)
+            await sender.send(b' world')
+            await until(lambda: b''.join(received) == b'hello world')
+            # below ACK_INTERVAL, so the receiver did not acknowledge anything yet
+            self.assertEqual((sender.acked, sender.size), (0, 11))
+
+            ws_sender.drop()
+            await asyncio.gather(*tasks)
+            self.assertIsNone(sender.ws)
+            # goes into the buffer only
+            await sender.send(b'!')
+
+            # the handshake acknowledges what the receiver got, so only the rest gets replayed
+            ws_sender, ws_receiver = connect()
+            tasks = [asyncio.create_task(sender.run(ws_sender, nothing)),
+                     asyncio.create_task(receiver.run(ws_receiver, deliver))]
+            await until(lambda: b''.join(received) == b'hello world!')
+            self.assertEqual((sender.acked, sender.size), (11, 1))
+            self.assertEqual(receiver.received, 12)
+
+            ws_sender.drop()
+            await asyncio.gather(*tasks)
+            self.assertEqual(b''.join(received), b'hello world!')
+
+        asyncio.run(run())
+
+    def testResumeBeyondBuffer(self):
+        async def run():
+            stream = self.module.ResumableStream()
+            await stream.send(b'abc')
+            ws, peer = connect()
+            # the peer claims to have received more than was ever sent
+            await peer.send('{"ack": 5}')
+            with self.assertRaises(ValueError):
+                await stream.run(ws, None)
+
+        asyncio.run(run())
+
+
+class ConnectorResumableStreamTest(ResumableStreamTests, unittest.TestCase):
+    module = connector
+
+
+class SessionResumableStreamTest(ResumableStreamTests, unittest.TestCase):
+    module = websocket_session
+
+
+if __name__ == '__main__':
+    unittest.main()
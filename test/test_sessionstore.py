@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import unittest
+
+import fakeredis
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'appservice'))
+
+from sessionstore import (  # noqa: E402
+    CONFLICTS, Session, SessionStore, Status, org_active_key, org_index_key, session_key)
+
+
+class InterferingRedis:
+    """Redis client whose next transaction sees a concurrent change right after reading the watched key"""
+
+    def __init__(self, client, interfere):
+        self.client = client
+        self.interfere = interfere
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def pipeline(self, **kwargs):
+        pipe = self.client.pipeline(**kwargs)
+        get = pipe.get
+
+        async def get_and_interfere(key):
+            result = await get(key)
+            interfere, self.interfere = self.interfere, None
+            if interfere is not None:
+                await interfere()
+            return result
+
+        pipe.get = get_and_interfere
+        return pipe
+
+
+class SessionTest(unittest.TestCase):
+
+    def testEncodeDecode(self):
+        for addr in (b'', bytes([10, 0, 0, 1]), bytes(15) + b'\1'):
+            session = Session(id='1234-abcd', status=Status.RECONNECTING, org_id=2 ** 40, addr=addr,
+                              pod='session-1234-abcd', version=7, created=1700000000, updated=1700000100)
+            self.assertEqual(Session.decode(session.encode()), session)
+        self.assertEqual(session.ip, '::1')
+        self.assertEqual(Session.decode(Session('a', Status.CLOSED, 1, b'', '', 1, 0, 0).encode()).pod, '')
+
+
+class SessionStoreTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeAsyncRedis(server=self.server)
+        self.changed = []
+        self.store = SessionStore(self.redis, load_batch=2, on_change=self.changed.append)
+
+    async def asyncTearDown(self):
+        await self.redis.aclose()
+
+    async def create(self, session_id, org_id=1, status=Status.WAIT_TARGET, store=None):
+        return await (store or self.store).update(session_id, status=status, org_id=org_id, ip='10.0.0.1',
+                                                  pod=f'session-{session_id}')
+
+    async def testCreateAndUpdate(self):
+        session = await self.create('s1')
+        self.assertEqual((session.status, session.version, session.ip, session.pod),
+                         (Status.WAIT_TARGET, 1, '10.0.0.1', 'session-s1'))
+        self.assertEqual(Session.decode(await self.redis.get(session_key('s1'))), session)
+
+        session = await self.store.update('s1', status=Status.RUNNING)
+        self.assertEqual((session.status, session.version, session.org_id), (Status.RUNNING, 2, 1))
+        self.assertEqual(self.store.get('s1'), session)
+        self.assertEqual(self.changed, ['s1', 's1'])
+
+    async def testTransitions(self):
+        # new sessions start in provisioning or wait_target
+        self.assertIsNone(await self.create('s1', status=Status.RUNNING))
+        self.assertIsNone(await self.redis.get(session_key('s1')))
+
+        await self.create('s1', status=Status.PROVISIONING)
+        self.assertIsNone(await self.store.update('s1', status=Status.RUNNING))
+        for status in (Status.WAIT_TARGET, Status.RUNNING, Status.RECONNECTING, Status.RUNNING, Status.CLOSED):
+            self.assertEqual((await self.store.update('s1', status=status)).status, status)
+        # closed is final
+        for status in Status:
+            if status != Status.CLOSED:
+                self.assertIsNone(await self.store.update('s1', status=status))
+        session = Session.decode(await self.redis.get(session_key('s1')))
+        self.assertEqual((session.status, session.version), (Status.CLOSED, 6))
+        # setting the same status again is not a transition
+        self.assertEqual((await self.store.update('s1', status=Status.CLOSED)).version, 7)
+
+    async def testIfVersion(self):
+        await self.create('s1')
+        await self.store.update('s1', status=Status.RUNNING)
+        self.assertIsNone(await self.store.update('s1', if_version=1, status=Status.CLOSED))
+        self.assertIsNone(await self.store.update('s2', if_version=1, status=Status.CLOSED))
+        self.assertEqual((await self.store.update('s1', if_version=2, status=Status.CLOSED)).version, 3)
+
+    async def testConflictRetry(self):
+        other = SessionStore(fakeredis.FakeAsyncRedis(server=self.server))
+        await self.create('s1', store=other)
+
+        conflicts = CONFLICTS._unlabelled().value
+        self.store.redis = InterferingRedis(self.redis, lambda: other.update('s1', ip='10.0.0.2'))
+        session = await self.store.update('s1', status=Status.RUNNING)
+        self.assertEqual(CONFLICTS._unlabelled().value, conflicts + 1)
+        # the retry built on the other replica's change
+        self.assertEqual((session.version, session.status, session.ip), (3, Status.RUNNING, '10.0.0.2'))
+        self.assertEqual(Session.decode(await self.redis.get(session_key('s1'))), session)
+
+        # if_version is checked again on the retry
+        self.store.redis = InterferingRedis(self.redis, lambda: other.update('s1', ip='10.0.0.3'))
+        self.assertIsNone(await self.store.update('s1', if_version=3, status=Status.CLOSED))
+        self.assertEqual(Session.decode(await self.redis.get(session_key('s1'))).status, Status.RUNNING)
+
+    async def testConflictingDelete(self):
+        other = SessionStore(fakeredis.FakeAsyncRedis(server=self.server))
+        await self.create('s1', store=other)
+        self.store.redis = InterferingRedis(self.redis, lambda: other.update('s1', status=Status.RUNNING))
+        self.assertFalse(await self.store.delete('s1', 1))
+        self.assertIsNotNone(await self.redis.get(session_key('s1')))
+        self.assertTrue(await self.store.delete('s1', 2))
+        self.assertIsNone(await self.redis.get(session_key('s1')))
+
+    async def testOrgIndexes(self):
+        await self.create('s1', org_id=5)
+        await self.create('s2', org_id=5)
+        self.assertEqual(await self.redis.smembers(org_index_key(5)), {b's1', b's2'})
+        self.assertEqual(await self.redis.smembers(org_active_key(5)), {b's1', b's2'})
+
+        await self.store.update('s1', status=Status.CLOSED)
+        self.assertEqual(await self.redis.smembers(org_index_key(5)), {b's1', b's2'})
+        self.assertEqual(await self.redis.smembers(org_active_key(5)), {b's2'})
+
+        await self.store.delete('s2', 1)
+        self.assertEqual(await self.redis.smembers(org_index_key(5)), {b's1'})
+        self.assertEqual(await self.redis.smembers(org_active_key(5)), set())
+        self.assertEqual([session.id for session in self.store.sessions.by_org(5)], ['s1'])
+
+    async def testApply(self):
+        other = SessionStore(fakeredis.FakeAsyncRedis(server=self.server))
+        pubsub = await self.store.subscribe()
+        await self.create('s1', store=other)
+        await other.update('s1', status=Status.RUNNING)
+        await other.delete('s1', 2)
+
+        events = []
+        for _ in range(10):
+            # None for the ignored subscription confirmation
+            message = await pubsub.get_message(timeout=1)
+            if message is not None:
+                events.append(message['data'])
+            if len(events) == 3:
+                break
+        self.assertEqual(len(events), 3)
+        await pubsub.aclose()
+
+        self.assertEqual(await self.store.apply(events[1]), 's1')
+        self.assertEqual(self.store.get('s1').status, Status.RUNNING)
+        # older state
+        self.assertIsNone(await self.store.apply(events[0]))
+        self.assertEqual(self.store.get('s1').version, 2)
+        self.assertEqual(await self.store.apply(events[2]), 's1')
+        self.assertIsNone(self.store.get('s1'))
+        self.assertIsNone(await self.store.apply(b'Xgarbage'))
+        self.assertIsNone(await self.store.apply(b'S\0'))
+        self.assertEqual(self.changed, ['s1', 's1'])
+
+    async def testLoad(self):
+        other = SessionStore(fakeredis.FakeAsyncRedis(server=self.server))
+        for i in range(5):
+            await self.create(f's{i}', org_id=i % 2, store=other)
+        await other.update('s0', status=Status.CLOSED)
+
+        self.assertFalse(self.store.loaded)
+        self.assertEqual(sorted(await self.store.load()), ['s0', 's1', 's2', 's3', 's4'])
+        self.assertTrue(self.store.loaded)
+        self.assertFalse(self.store.loading)
+        self.assertEqual(len(self.store.sessions), 5)
+        self.assertEqual(sorted(session.id for session in self.store.sessions.by_org(0)), ['s0', 's2', 's4'])
+        self.assertEqual([session.id for session in self.store.sessions.by_status(Status.CLOSED)], ['s0'])
+        self.assertEqual(self.store.get('s0').version, 2)
+
+        # only what changed since the last load
+        await other.update('s1', status=Status.RUNNING)
+        await other.delete('s2', 1)
+        self.changed.clear()
+        self.assertEqual(sorted(await self.store.load()), ['s1', 's2'])
+        self.assertEqual(sorted(self.changed), ['s1', 's2'])
+        self.assertNotIn('s2', self.store)
+        self.assertEqual(self.store.get('s1').status, Status.RUNNING)
+        self.assertEqual(sorted(session.id for session in self.store.sessions.by_org(0)), ['s0', 's4'])
+
+
+if __name__ == '__main__':
+    unittest.main()